@@ -0,0 +1,284 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+"""Benchmark the ways vcversioner can find a version.
+
+Synthetic git repositories of various shapes are generated with ``git
+fast-import``, and then each way of resolving a version is timed against each
+repository. Results are written out as JSON so that they can be compared
+between releases::
+
+  python bench_vcversioner.py --shape commits=1000,tags=100 \\
+      --shape commits=100000,tags=50000,refs=loose --output bench.json
+
+A shape is a comma-separated list of ``key=value`` pairs:
+
+``commits``
+  The number of commits on the main branch.
+
+``tags``
+  The number of tags, spread evenly over the commits. Every other tag is
+  annotated.
+
+``refs``
+  ``packed`` (the default) to pack the refs with ``git pack-refs``, or
+  ``loose`` to leave one file per tag.
+
+``depth``
+  If nonzero, benchmark a shallow clone of this depth instead.
+
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import vcversioner
+
+
+default_shapes = [
+    'commits=10,tags=10',
+    'commits=1000,tags=100',
+    'commits=1000,tags=100,refs=loose',
+    'commits=10000,tags=1000',
+    'commits=10000,tags=1000,depth=50',
+]
+
+_git_env = dict(
+    os.environ,
+    GIT_AUTHOR_NAME='bench', GIT_AUTHOR_EMAIL='bench@example.com',
+    GIT_COMMITTER_NAME='bench', GIT_COMMITTER_EMAIL='bench@example.com',
+    GIT_CONFIG_NOSYSTEM='1')
+
+
+def parse_shape(spec):
+    "Parse a ``key=value,...`` shape into a dict, filling in defaults."
+    shape = {'commits': 100, 'tags': 10, 'refs': 'packed', 'depth': 0}
+    for item in spec.split(','):
+        key, _, value = item.partition('=')
+        if key not in shape:
+            raise ValueError('unknown shape key %r' % (key,))
+        shape[key] = value if key == 'refs' else int(value)
+    if shape['refs'] not in ('packed', 'loose'):
+        raise ValueError("refs must be 'packed' or 'loose'")
+    return shape
+
+
+def _git(repo, *args, **kwargs):
+    return subprocess.check_output(
+        ('git',) + args, cwd=repo, env=_git_env, **kwargs)
+
+
+def _fast_import_stream(commits, tags):
+    "Generate a ``git fast-import`` stream for a linear history."
+    # leave a few untagged commits at the end so there's a .dev version. the
+    # tags are spread out so that the last one is just before those, so even
+    # a shallow clone has one.
+    tagged_commits = commits - min(3, commits - 1)
+    tagged = 0
+    when = 1500000000
+    for n in range(1, commits + 1):
+        yield (
+            'commit refs/heads/master\n'
+            'mark :%d\n'
+            'committer bench <bench@example.com> %d +0000\n'
+            'data <<EOF\ncommit %d\nEOF\n'
+            'M 644 inline file\ndata <<EOF\n%d\nEOF\n\n' % (n, when + n, n, n))
+        while tagged < tags * min(n, tagged_commits) // tagged_commits:
+            tagged += 1
+            name = '%d.%d.%d' % (tagged // 10000, tagged // 100 % 100,
+                                 tagged % 100)
+            if tagged % 2:
+                yield 'reset refs/tags/%s\nfrom :%d\n\n' % (name, n)
+            else:
+                yield (
+                    'tag %s\nfrom :%d\n'
+                    'tagger bench <bench@example.com> %d +0000\n'
+                    'data <<EOF\nrelease %s\nEOF\n\n' % (
+                        name, n, when + n, name))
+
+
+def make_repo(path, shape):
+    "Create a repository of the given *shape* at *path*."
+    os.makedirs(path)
+    _git(path, 'init', '-q')
+    proc = subprocess.Popen(
+        ['git', 'fast-import', '--quiet'], cwd=path, env=_git_env,
+        stdin=subprocess.PIPE)
+    for chunk in _fast_import_stream(shape['commits'], shape['tags']):
+        proc.stdin.write(chunk.encode())
+    proc.stdin.close()
+    if proc.wait():
+        raise RuntimeError('git fast-import failed')
+    _git(path, 'reset', '-q', '--hard')
+    if shape['refs'] == 'packed':
+        _git(path, 'pack-refs', '--all')
+    if shape['depth']:
+        clone = path + '-shallow'
+        _git(os.path.dirname(path), 'clone', '-q', '--no-local',
+             '--depth', str(shape['depth']), path, clone,
+             stderr=subprocess.DEVNULL)
+        path = clone
+    return path
+
+
+def _time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return {
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'mean': sum(times) / len(times),
+        'max': times[-1],
+        'repeat': repeat,
+    }
+
+
+def _attempt(func):
+    """Call *func*, catching a failure to find a version.
+
+    Returns ``(result, None)``, or ``(None, messages)`` if no version was
+    found. Anything vcversioner prints is captured, so it doesn't end up in
+    the JSON results.
+
+    """
+
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            return func(), None
+    except vcversioner.VersionNotFound as e:
+        return None, e.messages
+    except SystemExit:
+        return None, output.getvalue().splitlines()
+
+
+def resolution_paths(root):
+    """Return a dict mapping names to callables which each find a version.
+
+    Each callable resolves the version of *root* a different way.
+
+    """
+
+    base = dict(root=root, version_module_paths=())
+    cache_file = os.path.join(root, 'version.cache')
+    session = vcversioner.GitSession(root)
+    vcversioner.find_version(**base)
+    vcversioner.find_version(cache_file=cache_file, **base)
+    return {
+        'subprocess': lambda: vcversioner.find_version(**base),
+        'in_process': lambda: vcversioner.find_version(
+            in_process=True, **base),
+        'version_file': lambda: vcversioner.find_version(
+            git_args=['vcversioner-bench-no-such-git'], **base),
+        'cache': lambda: vcversioner.find_version(
+            cache_file=cache_file, **base),
+        'session': lambda: session.find_version(**base),
+        'memo': lambda: vcversioner.find_version(
+            **dict(base, memoize=True)),
+    }, session
+
+
+def run(shapes, repeat=10, paths=None, workdir=None):
+    """Benchmark each of *shapes*, returning a JSON-serializable dict.
+
+    :param shapes: A list of shape specifications, as strings.
+    :param repeat: How many times to time each resolution path.
+    :param paths: If specified, only time these resolution paths.
+    :param workdir: Where to generate repositories; by default, a temporary
+                    directory which is removed afterward.
+
+    """
+
+    cleanup = workdir is None
+    if cleanup:
+        workdir = tempfile.mkdtemp(prefix='vcversioner-bench-')
+    results = []
+    try:
+        for n, spec in enumerate(shapes):
+            shape = parse_shape(spec)
+            start = time.perf_counter()
+            root = make_repo(os.path.join(workdir, 'repo%d' % (n,)), shape)
+            setup_time = time.perf_counter() - start
+            prepared, error = _attempt(lambda: resolution_paths(root))
+            if error is not None:
+                # one bad shape shouldn't throw away the other results.
+                results.append({
+                    'shape': shape,
+                    'path': None,
+                    'error': error,
+                    'setup_seconds': setup_time,
+                })
+                continue
+            funcs, session = prepared
+            with session:
+                for name, func in sorted(funcs.items()):
+                    if paths and name not in paths:
+                        continue
+                    result = {
+                        'shape': shape,
+                        'path': name,
+                        'setup_seconds': setup_time,
+                    }
+                    found, error = _attempt(func)
+                    if error is not None:
+                        result['error'] = error
+                    else:
+                        result['version'] = found.version
+                        result.update(_time(func, repeat))
+                    results.append(result)
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+    own_root = os.path.dirname(os.path.abspath(__file__))
+    own_version = vcversioner.find_versions(
+        [own_root], read_only=True)[own_root]
+    return {
+        'vcversioner': getattr(own_version, 'version', None),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'git': _git('.', '--version').decode().strip(),
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--shape', action='append', dest='shapes',
+        help='a repository shape to benchmark; may be given more than once')
+    parser.add_argument(
+        '--repeat', type=int, default=10,
+        help='how many times to time each resolution path')
+    parser.add_argument(
+        '--path', action='append', dest='paths',
+        help='only time this resolution path; may be given more than once')
+    parser.add_argument(
+        '--output', metavar='PATH',
+        help='where to write the JSON results, instead of stdout')
+    args = parser.parse_args(argv)
+    results = run(args.shapes or default_shapes, args.repeat, args.paths)
+    # the output is only opened once there's something to write to it.
+    text = json.dumps(results, indent=2, sort_keys=True) + '\n'
+    if args.output is None:
+        sys.stdout.write(text)
+    else:
+        with open(args.output, 'w') as outfile:
+            outfile.write(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,23 @@
 
 from __future__ import unicode_literals
 
+import asyncio
+import contextlib
+import hashlib
+import itertools
+import json
 import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+import types
 
 import pytest
 
 import vcversioner
+import vcversioner_hg
 
 
 class FakePopen(object):
@@ -41,6 +53,14 @@ class FakeOpen(object):
         raise OSError('hi!')
 
 
+@pytest.fixture(autouse=True)
+def forget_versions():
+    "Don't let versions remembered by one test leak into another."
+    vcversioner.clear_memo()
+    yield
+    vcversioner.clear_memo()
+
+
 def test_astounding_success(tmpdir):
     "Successful output from git is cached and returned."
     tmpdir.chdir()
@@ -209,6 +229,9 @@ def test_version_module_paths(tmpdir):
 # This file is automatically generated by setup.py.
 __version__ = '1.0'
 __sha__ = 'gbeef'
+__version_info__ = (1, 0)
+__commits__ = 0
+__version_key__ = (0, (1,), (1,), (-1,), (1,), (0,))
 """
 
 def test_git_arg_path_translation(monkeypatch):
@@ -302,3 +325,1969 @@ def test_setup_astounding_success():
         {str('Popen'): basic_version, str('version_file'): None})
     assert dist.version == '1.0'
     assert dist.metadata.version == '1.0'
+
+
+def _git_available():
+    try:
+        subprocess.check_output(['git', '--version'])
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return True
+
+needs_git = pytest.mark.skipif(
+    not _git_available(), reason='git is not installed')
+
+_git_env = dict(
+    os.environ,
+    GIT_AUTHOR_NAME='vcversioner', GIT_AUTHOR_EMAIL='vcversioner@example.com',
+    GIT_COMMITTER_NAME='vcversioner',
+    GIT_COMMITTER_EMAIL='vcversioner@example.com',
+    GIT_CONFIG_NOSYSTEM='1', HOME=os.devnull)
+
+def git(repo, *args):
+    return subprocess.check_output(
+        ('git',) + args, cwd=str(repo), env=_git_env).decode().strip()
+
+def git_commit(repo, message='commit'):
+    git(repo, 'commit', '-q', '--allow-empty', '-m', message)
+
+@pytest.fixture
+def git_repo(tmpdir):
+    git(tmpdir, 'init', '-q')
+    git_commit(tmpdir)
+    git(tmpdir, 'tag', '1.0')
+    git_commit(tmpdir)
+    git(tmpdir, 'tag', '-a', '-m', 'release', '1.1')
+    git_commit(tmpdir)
+    git_commit(tmpdir)
+    return tmpdir
+
+def describe(repo):
+    return git(repo, 'describe', '--tags', '--long')
+
+
+@needs_git
+def test_in_process_matches_git(git_repo):
+    "Reading the repository in-process gives the same answer as git."
+    assert describe(git_repo).startswith('1.1-2-g')
+    assert vcversioner._describe_in_process(
+        git_repo.join('.git').strpath) == describe(git_repo)
+
+@needs_git
+def test_in_process_exact_tag(git_repo):
+    "A tagged HEAD is described with zero commits."
+    git(git_repo, 'tag', '2.0')
+    assert vcversioner._describe_in_process(
+        git_repo.join('.git').strpath) == describe(git_repo)
+
+@needs_git
+def test_in_process_packed(git_repo):
+    "Packed refs and objects are read just like loose ones."
+    git(git_repo, 'gc', '-q', '--aggressive')
+    assert not git_repo.join('.git', 'refs', 'tags', '1.1').check()
+    assert vcversioner._describe_in_process(
+        git_repo.join('.git').strpath) == describe(git_repo)
+
+@needs_git
+def test_in_process_loose_objects(git_repo):
+    "Loose objects don't make abbreviations longer than git's."
+    import hashlib
+    import zlib
+    objects = git_repo.join('.git', 'objects')
+    for n in range(20000):
+        data = b'blob %d\0%d' % (len(str(n)), n)
+        sha = hashlib.sha1(data).hexdigest()
+        objects.join(sha[:2], sha[2:]).write_binary(
+            zlib.compress(data), ensure=True)
+    assert vcversioner._describe_in_process(
+        git_repo.join('.git').strpath) == describe(git_repo)
+
+@needs_git
+def test_in_process_alternates_loose_objects(git_repo, tmpdir_factory):
+    "Loose objects in alternates can make abbreviations longer, as in git."
+    alternate = tmpdir_factory.mktemp('alternate')
+    git_repo.join('.git', 'objects', 'info', 'alternates').write(
+        alternate.strpath + '\n', ensure=True)
+    head = git(git_repo, 'rev-parse', 'HEAD')
+    other = head[:7] + ('0' if head[7] != '0' else '1') * 33
+    alternate.join(other[:2], other[2:]).write('', ensure=True)
+    assert len(describe(git_repo).rsplit('-g', 1)[1]) == 8
+    assert vcversioner._describe_in_process(
+        git_repo.join('.git').strpath) == describe(git_repo)
+
+@needs_git
+def test_in_process_merges(git_repo):
+    "The nearest tag is found across merges."
+    git(git_repo, 'checkout', '-q', '-b', 'side', '1.0')
+    git_commit(git_repo)
+    git(git_repo, 'tag', '1.0.1')
+    git(git_repo, 'checkout', '-q', '-')
+    git(git_repo, 'merge', '-q', '--no-ff', '-m', 'merge', 'side')
+    assert vcversioner._describe_in_process(
+        git_repo.join('.git').strpath) == describe(git_repo)
+
+@needs_git
+def test_in_process_no_tags(tmpdir):
+    "A repository without tags can't be described."
+    git(tmpdir, 'init', '-q')
+    git_commit(tmpdir)
+    assert vcversioner._describe_in_process(tmpdir.join('.git').strpath) is None
+
+@needs_git
+def test_in_process_doesnt_spawn(git_repo):
+    "git isn't spawned when the repository can be read in-process."
+    version = vcversioner.find_version(
+        root=git_repo.strpath, Popen=RaisingFakePopen(), in_process=True)
+    assert version.version == '1.1.dev2'
+    assert version.sha == 'g' + git(git_repo, 'rev-parse', '--short', 'HEAD')
+
+def test_in_process_falls_back_to_git(tmpdir):
+    "git is still run if there's no repository to read."
+    tmpdir.chdir()
+    version = vcversioner.find_version(Popen=basic_version, in_process=True)
+    assert version == ('1.0', '0', 'gbeef')
+
+@needs_git
+def test_cache_hit(git_repo, monkeypatch):
+    "A cached version is used without running git when nothing has changed."
+    monkeypatch.setattr(vcversioner, 'cache_stats', {'hits': 0, 'misses': 0})
+    kwargs = dict(
+        root=git_repo.strpath, cache_file='%(root)s/version.cache',
+        memoize=False)
+    first = vcversioner.find_version(**kwargs)
+    assert git_repo.join('version.cache').check()
+    second = vcversioner.find_version(Popen=RaisingFakePopen(), **kwargs)
+    assert first == second
+    assert vcversioner.cache_stats == {'hits': 1, 'misses': 1}
+
+def test_cache_stats_concurrent(tmpdir, monkeypatch):
+    "Lookups on several threads at once are all counted."
+    monkeypatch.setattr(vcversioner, 'cache_stats', {'hits': 0, 'misses': 0})
+    roots = [tmpdir.join('p%d' % (n,)).ensure(dir=True).strpath
+             for n in range(200)]
+    vcversioner.find_versions(
+        roots, max_workers=16, Popen=basic_version, version_file=None,
+        cache_file='%(root)s/version.cache', read_only=True)
+    assert vcversioner.cache_stats == {'hits': 0, 'misses': 200}
+
+@needs_git
+def test_cache_miss_on_new_commit(git_repo, monkeypatch):
+    "The cache is refreshed once HEAD moves."
+    monkeypatch.setattr(vcversioner, 'cache_stats', {'hits': 0, 'misses': 0})
+    kwargs = dict(
+        root=git_repo.strpath, cache_file='%(root)s/version.cache',
+        memoize=False)
+    assert vcversioner.find_version(**kwargs).commits == '2'
+    git_commit(git_repo)
+    assert vcversioner.find_version(**kwargs).commits == '3'
+    assert vcversioner.cache_stats == {'hits': 0, 'misses': 2}
+
+@needs_git
+def test_cache_miss_on_new_tag(git_repo):
+    "The cache is refreshed once tags change."
+    kwargs = dict(
+        root=git_repo.strpath, cache_file='%(root)s/version.cache',
+        memoize=False)
+    assert vcversioner.find_version(**kwargs).version == '1.1.dev2'
+    git(git_repo, 'tag', '2.0')
+    assert vcversioner.find_version(**kwargs).version == '2.0'
+
+@needs_git
+def test_cache_miss_on_nested_tag(git_repo):
+    "Tags added to an existing directory of tags refresh the cache too."
+    kwargs = dict(
+        root=git_repo.strpath, cache_file='%(root)s/version.cache',
+        tag_prefix='svc/', memoize=False)
+    git(git_repo, 'tag', 'svc/1.0')
+    git_commit(git_repo)
+    assert vcversioner.find_version(**kwargs).version == '1.0.dev1'
+    git(git_repo, 'tag', 'svc/1.1')
+    assert vcversioner.find_version(**kwargs).version == '1.1'
+
+def test_cache_not_written_without_git(tmpdir):
+    "Versions from version.txt aren't cached."
+    tmpdir.chdir()
+    tmpdir.join('version.txt').write('1.0-0-gbeef')
+    version = vcversioner.find_version(
+        Popen=empty, cache_file='version.cache')
+    assert version == ('1.0', '0', 'gbeef')
+    assert not tmpdir.join('version.cache').check()
+
+
+class CountingFakePopen(FakePopen):
+    calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        return self
+
+def test_memoized(tmpdir):
+    "Repeated lookups with the same arguments don't run git again."
+    tmpdir.chdir()
+    popen = CountingFakePopen(b'1.0-0-gbeef')
+    first = vcversioner.find_version(Popen=popen, memoize=True)
+    tmpdir.join('version.txt').remove()
+    assert vcversioner.find_version(Popen=popen, memoize=True) is first
+    assert popen.calls == 1
+    assert not tmpdir.join('version.txt').check()
+
+def test_memoized_arguments(tmpdir):
+    "Different arguments are looked up separately."
+    tmpdir.chdir()
+    popen = CountingFakePopen(b'1.0-2-gfeeb')
+    assert vcversioner.find_version(
+        Popen=popen, memoize=True).version == '1.0.dev2'
+    assert vcversioner.find_version(
+        Popen=popen, memoize=True, include_dev_version=False).version == '1.0'
+    assert popen.calls == 2
+
+def test_memoize_disabled(tmpdir):
+    "By default, nothing is memoized."
+    tmpdir.chdir()
+    popen = CountingFakePopen(b'1.0-0-gbeef')
+    vcversioner.find_version(Popen=popen)
+    vcversioner.find_version(Popen=popen)
+    assert popen.calls == 2
+
+@needs_git
+def test_memoized_new_commit(git_repo):
+    "A remembered version is forgotten once HEAD moves."
+    kwargs = dict(root=git_repo.strpath, version_file=None, memoize=True)
+    assert vcversioner.find_version(**kwargs).version == '1.1.dev2'
+    git_commit(git_repo)
+    assert vcversioner.find_version(**kwargs).version == '1.1.dev3'
+    git(git_repo, 'tag', '2.0')
+    assert vcversioner.find_version(**kwargs).version == '2.0'
+
+def test_clear_memo(tmpdir):
+    "Remembered versions can be forgotten."
+    tmpdir.chdir()
+    popen = CountingFakePopen(b'1.0-0-gbeef')
+    vcversioner.find_version(Popen=popen, memoize=True)
+    vcversioner.clear_memo()
+    vcversioner.find_version(Popen=popen, memoize=True)
+    assert popen.calls == 2
+
+def test_clear_memo_root(tmpdir):
+    "Remembered versions can be forgotten for just one root."
+    popen = CountingFakePopen(b'1.0-0-gbeef')
+    spam, eggs = tmpdir.join('spam').strpath, tmpdir.join('eggs').strpath
+    kwargs = dict(Popen=popen, version_file=None, memoize=True)
+    vcversioner.find_version(root=spam, **kwargs)
+    vcversioner.find_version(root=eggs, **kwargs)
+    vcversioner.clear_memo(root=spam)
+    vcversioner.find_version(root=spam, **kwargs)
+    vcversioner.find_version(root=eggs, **kwargs)
+    assert popen.calls == 3
+
+def test_find_versions(tmpdir, capsys):
+    "Several roots can be looked up at once, failures included."
+    good, bad = tmpdir.join('good'), tmpdir.join('bad')
+    good.ensure('version.txt').write('1.0-2-gfeeb')
+    bad.ensure(dir=True)
+    versions = vcversioner.find_versions(
+        [good.strpath, bad.strpath], Popen=RaisingFakePopen())
+    assert versions[good.strpath] == ('1.0.dev2', '2', 'gfeeb')
+    assert isinstance(versions[bad.strpath], vcversioner.VersionNotFound)
+    assert "isn't present" in versions[bad.strpath].messages[0]
+    out, err = capsys.readouterr()
+    assert not out
+
+def test_find_versions_shares_git(tmpdir):
+    "git only runs once for roots sharing a .git directory."
+    popen = CountingFakePopen(b'1.0-0-gbeef')
+    roots = [tmpdir.join('pkg%d' % n).ensure(dir=True).strpath
+             for n in range(10)]
+    versions = vcversioner.find_versions(
+        roots, Popen=popen, version_file=None,
+        git_args=['git', '--git-dir', tmpdir.join('.git').strpath, 'describe'])
+    assert set(versions.values()) == set([('1.0', '0', 'gbeef')])
+    assert popen.calls == 1
+
+@needs_git
+def test_find_versions_subdirectories(git_repo):
+    "Projects in subdirectories of one repository can share its git process."
+    roots = [git_repo.join('pkg%d' % n).ensure(dir=True).strpath
+             for n in range(3)]
+    popen = CountingFakePopen(b'1.1-2-gbeef')
+    versions = vcversioner.find_versions(
+        roots + [git_repo.strpath], Popen=popen, version_file=None,
+        enclosing_repository=True)
+    assert set(versions.values()) == set([('1.1.dev2', '2', 'gbeef')])
+    assert popen.calls == 1
+    versions = vcversioner.find_versions(
+        roots, version_file=None, memoize=False, enclosing_repository=True)
+    assert set(v.version for v in versions.values()) == set(['1.1.dev2'])
+    versions = vcversioner.find_versions(
+        roots, version_file=None, memoize=False, in_process=True,
+        Popen=RaisingFakePopen(), enclosing_repository=True)
+    assert set(v.version for v in versions.values()) == set(['1.1.dev2'])
+
+@needs_git
+def test_find_versions_own_repository_by_default(git_repo):
+    "Without enclosing_repository, only a root's own .git is used."
+    root = git_repo.join('pkg').ensure(dir=True).strpath
+    versions = vcversioner.find_versions(
+        [root], version_file=None, memoize=False)
+    assert isinstance(versions[root], vcversioner.VersionNotFound)
+
+@needs_git
+@pytest.mark.parametrize('enclosing_repository', [False, True])
+def test_find_versions_subdirectory_version_file(
+        git_repo, enclosing_repository):
+    "A subdirectory's version file beats the repository containing it."
+    root = git_repo.join('pkg').ensure(dir=True)
+    root.join('version.txt').write('1.0-0-gbeef')
+    version = vcversioner.find_version(root=root.strpath, memoize=False)
+    versions = vcversioner.find_versions(
+        [root.strpath], memoize=False,
+        enclosing_repository=enclosing_repository)
+    assert version == versions[root.strpath] == ('1.0', '0', 'gbeef')
+    assert root.join('version.txt').read() == '1.0-0-gbeef'
+
+
+class FakeAsyncProcess(object):
+    def __init__(self, stdout, stderr=b'', delay=0):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.delay = delay
+        self.killed = False
+
+    async def communicate(self):
+        await asyncio.sleep(self.delay)
+        return self.stdout, self.stderr
+
+    def kill(self):
+        self.killed = True
+
+    async def wait(self):
+        return -9
+
+class FakeCreateSubprocessExec(object):
+    def __init__(self, process=None):
+        self.process = process
+
+    async def __call__(self, *args, **kwargs):
+        self.args = args
+        if self.process is None:
+            raise OSError('hi!')
+        return self.process
+
+def test_async_find_version(tmpdir):
+    "Versions can be found from asyncio, too."
+    tmpdir.chdir()
+    spawn = FakeCreateSubprocessExec(FakeAsyncProcess(b'1.0-2-gfeeb'))
+    version = asyncio.run(vcversioner.async_find_version(
+        create_subprocess_exec=spawn))
+    assert version == ('1.0.dev2', '2', 'gfeeb')
+    assert spawn.args[:2] == ('git', '--git-dir')
+    assert tmpdir.join('version.txt').read() == '1.0-2-gfeeb'
+
+def test_async_find_version_timeout(tmpdir):
+    "git is killed if it takes too long, and version.txt is used instead."
+    tmpdir.chdir()
+    tmpdir.join('version.txt').write('1.0-0-gbeef')
+    process = FakeAsyncProcess(b'2.0-0-gfeeb', delay=10)
+    version = asyncio.run(vcversioner.async_find_version(
+        timeout=0.01, create_subprocess_exec=FakeCreateSubprocessExec(process)))
+    assert version == ('1.0', '0', 'gbeef')
+    assert process.killed
+
+def test_async_find_version_failure(tmpdir, capsys):
+    "If no version can be found, VersionNotFound is raised."
+    tmpdir.chdir()
+    with pytest.raises(vcversioner.VersionNotFound) as excinfo:
+        asyncio.run(vcversioner.async_find_version(
+            create_subprocess_exec=FakeCreateSubprocessExec(),
+            version_file=None, git_args=[]))
+    assert excinfo.value.messages == ['[] failed.']
+    out, err = capsys.readouterr()
+    assert not out
+
+def test_async_find_version_bad_arguments():
+    "Unknown arguments are rejected, just like with find_version."
+    with pytest.raises(TypeError):
+        asyncio.run(vcversioner.async_find_version(spam='eggs'))
+
+class RecordingPopen(object):
+    def __init__(self):
+        self.commands = []
+
+    def __call__(self, args, **kwargs):
+        self.commands.append(args[3])
+        return subprocess.Popen(args, **kwargs)
+
+@needs_git
+def test_session(git_repo):
+    "A session describes the repository just like git does."
+    with vcversioner.GitSession(git_repo.strpath) as session:
+        assert session.describe() == describe(git_repo)
+        version = session.find_version()
+    assert version.version == '1.1.dev2'
+
+@needs_git
+def test_session_reuses_helper(git_repo):
+    "Repeated queries don't spawn anything new."
+    popen = RecordingPopen()
+    with vcversioner.GitSession(git_repo.strpath, Popen=popen) as session:
+        session.describe()
+        spawned = len(popen.commands)
+        session.describe()
+        assert len(popen.commands) == spawned
+        assert popen.commands.count('cat-file') == 1
+
+@needs_git
+def test_session_notices_changes(git_repo):
+    "New commits and tags are noticed by an open session."
+    with vcversioner.GitSession(git_repo.strpath) as session:
+        session.describe()
+        git_commit(git_repo)
+        assert session.describe() == describe(git_repo)
+        git(git_repo, 'tag', '2.0')
+        assert session.describe() == describe(git_repo)
+
+@needs_git
+def test_session_restarts_helper(git_repo):
+    "If the helper dies, it's restarted."
+    popen = RecordingPopen()
+    with vcversioner.GitSession(git_repo.strpath, Popen=popen) as session:
+        session.describe()
+        session._repo._proc.kill()
+        session._repo._proc.wait()
+        git_commit(git_repo)
+        assert session.describe() == describe(git_repo)
+        assert popen.commands.count('cat-file') == 2
+
+def colliding_blobs():
+    "Find two blobs whose object names share their first four digits."
+    seen = {}
+    for n in itertools.count():
+        content = str(n).encode()
+        header = ('blob %d\0' % (len(content),)).encode()
+        sha = hashlib.sha1(header + content).hexdigest()
+        if sha[:4] in seen:
+            return seen[sha[:4]], content
+        seen[sha[:4]] = content
+
+@needs_git
+def test_session_ambiguous_queries(git_repo):
+    "The helper can't block on complaints about ambiguous names."
+    shas = []
+    for content in colliding_blobs():
+        git_repo.join('blob').write_binary(content)
+        shas.append(git(git_repo, 'hash-object', '-w', 'blob'))
+    with vcversioner.GitSession(git_repo.strpath) as session:
+        session._repo._abbrev = 4
+        for _ in range(2000):
+            assert len(session._repo.abbreviate(shas[0])) > 4
+
+def test_session_falls_back_to_git(tmpdir):
+    "If the session can't describe the repository, git_args is run."
+    version = vcversioner.GitSession(
+        tmpdir.strpath, Popen=basic_version).find_version(version_file=None)
+    assert version == ('1.0', '0', 'gbeef')
+
+def test_unchanged_files_not_rewritten(tmpdir):
+    "Files whose contents wouldn't change are left alone."
+    tmpdir.chdir()
+    vcversioner.find_version(Popen=basic_version, version_module_paths=['spam.py'])
+    for name in ['version.txt', 'spam.py']:
+        tmpdir.join(name).setmtime(1000000000)
+    vcversioner.find_version(
+        Popen=basic_version, version_module_paths=['spam.py'], memoize=False)
+    for name in ['version.txt', 'spam.py']:
+        assert tmpdir.join(name).mtime() == 1000000000
+
+def test_changed_files_replaced(tmpdir):
+    "Files whose contents change are replaced, leaving no temporary files."
+    tmpdir.chdir()
+    tmpdir.join('version.txt').write('0.9-0-gdead')
+    vcversioner.find_version(Popen=basic_version, version_module_paths=['spam.py'])
+    assert tmpdir.join('version.txt').read() == '1.0-0-gbeef'
+    assert "__version__ = '1.0'" in tmpdir.join('spam.py').read()
+    assert sorted(tmpdir.listdir()) == [
+        tmpdir.join('spam.py'), tmpdir.join('version.txt')]
+
+def test_read_only(tmpdir):
+    "Nothing is written in read-only mode."
+    tmpdir.chdir()
+    version = vcversioner.find_version(
+        Popen=basic_version, version_module_paths=['spam.py'],
+        cache_file='version.cache', read_only=True)
+    assert version == ('1.0', '0', 'gbeef')
+    assert not tmpdir.listdir()
+
+@needs_git
+def test_benchmark_paths_agree(tmpdir):
+    "Every resolution path the benchmark times finds the same version."
+    import bench_vcversioner
+    results = bench_vcversioner.run(
+        ['commits=20,tags=5', 'commits=5,tags=20,refs=loose,depth=4'],
+        repeat=1, paths=['subprocess', 'in_process', 'session'],
+        workdir=tmpdir.strpath)
+    versions = {}
+    for result in results['results']:
+        versions.setdefault(result['shape']['commits'], set()).add(
+            result['version'])
+    assert versions == {20: set(['0.0.5.dev3']), 5: set(['0.0.12.dev3'])}
+
+@needs_git
+def test_benchmark_default_shapes(tmpdir):
+    "Every default shape, shallow clones included, has a tag to find."
+    import bench_vcversioner
+    results = bench_vcversioner.run(
+        bench_vcversioner.default_shapes, repeat=1,
+        paths=['subprocess', 'in_process'], workdir=tmpdir.strpath)
+    assert len(results['results']) == 2 * len(
+        bench_vcversioner.default_shapes)
+    for result in results['results']:
+        assert 'error' not in result
+        assert result['version'].endswith('.dev3')
+
+@needs_git
+def test_benchmark_failure(tmpdir):
+    "A shape with no version is reported without losing the others."
+    import bench_vcversioner
+    results = bench_vcversioner.run(
+        ['commits=5,tags=0', 'commits=5,tags=1'], repeat=1,
+        paths=['in_process'], workdir=tmpdir.strpath)
+    failed, found = results['results']
+    assert 'No names found' in failed['error'][-1]
+    assert 'version' not in failed
+    assert found['version'] == '0.0.1.dev3'
+
+def test_trace(tmpdir):
+    "The phases of a lookup can be traced."
+    tmpdir.chdir()
+    records = []
+    vcversioner.find_version(
+        Popen=basic_version, version_module_paths=['spam.py'],
+        trace=records.append, memoize=True)
+    vcversioner.find_version(
+        Popen=basic_version, version_module_paths=['spam.py'],
+        trace=records.append, memoize=True)
+    first, second = records
+    assert first['version'] == '1.0'
+    assert first['version_source'] == 'git'
+    assert first['root'] == tmpdir.strpath
+    assert set(first['phases']) == set([
+        'spawn', 'communicate', 'parse', 'write_version_file',
+        'write_version_modules'])
+    assert first['total'] >= sum(first['phases'].values())
+    assert second['version_source'] == 'memo'
+
+def test_trace_failure(tmpdir):
+    "Failed lookups are traced too."
+    tmpdir.chdir()
+    records = []
+    with pytest.raises(SystemExit):
+        vcversioner.find_version(Popen=git_failed, trace=records.append)
+    record, = records
+    assert record['version'] is None
+    assert record['version_source'] == 'git'
+    assert record['error'][-1] == 'fatal: whatever'
+
+def test_trace_environment(tmpdir, monkeypatch):
+    "Traces can be written to a file named in the environment."
+    tmpdir.chdir()
+    tmpdir.join('version.txt').write('1.0-0-gbeef')
+    monkeypatch.setenv('VCVERSIONER_TRACE', tmpdir.join('trace.jsonl').strpath)
+    vcversioner.find_version(Popen=RaisingFakePopen())
+    vcversioner.find_version(Popen=RaisingFakePopen(), include_dev_version=False)
+    lines = tmpdir.join('trace.jsonl').read().splitlines()
+    assert len(lines) == 2
+    record = json.loads(lines[0])
+    assert record['version_source'] == 'version_file'
+    assert 'read_version_file' in record['phases']
+
+def load_module(path):
+    import importlib.util
+    spec = importlib.util.spec_from_file_location('_version', str(path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def test_lazy_version_module_outside_root(tmpdir):
+    "Lazy version modules outside the root use the generated version."
+    root = tmpdir.join('root').ensure(dir=True)
+    module_path = tmpdir.join('_version.py')
+    vcversioner.find_version(
+        Popen=basic_version, root=root.strpath,
+        version_module_paths=[module_path.strpath], lazy_version_modules=True)
+    module = load_module(module_path)
+    assert '__version__' not in vars(module)
+    assert module.__version__ == '1.0'
+    assert module.__sha__ == 'gbeef'
+    with pytest.raises(AttributeError):
+        module.spam
+
+@needs_git
+def test_lazy_version_module_inside_root(git_repo):
+    "Lazy version modules inside the root find the version again."
+    module_path = git_repo.join('_version.py')
+    vcversioner.find_version(
+        root=git_repo.strpath, version_module_paths=[module_path.strpath],
+        lazy_version_modules=True)
+    git_commit(git_repo)
+    vcversioner.clear_memo()
+    module = load_module(module_path)
+    assert module.__version__ == '1.1.dev3'
+    assert module.__sha__ == 'g' + git(git_repo, 'rev-parse', '--short', 'HEAD')
+
+@needs_git
+def test_lazy_version_module_relative_root(git_repo, tmpdir_factory):
+    "Lazy version modules refresh from any directory, given a relative root."
+    git_repo.dirpath().chdir()
+    module_path = git_repo.join('_version.py')
+    vcversioner.find_version(
+        root=git_repo.basename, version_module_paths=[module_path.strpath],
+        lazy_version_modules=True)
+    git_commit(git_repo)
+    vcversioner.clear_memo()
+    tmpdir_factory.mktemp('elsewhere').chdir()
+    module = load_module(module_path)
+    assert module.__version__ == '1.1.dev3'
+    assert module.__sha__ == 'g' + git(git_repo, 'rev-parse', '--short', 'HEAD')
+
+@needs_git
+def test_tag_index(git_repo):
+    "The persistent tag index gives the same answers as git."
+    git_dir = git_repo.join('.git').strpath
+    assert vcversioner._describe_in_process(git_dir, True) == describe(git_repo)
+    assert git_repo.join('.git', 'vcversioner-index').check()
+    git_commit(git_repo)
+    assert vcversioner._describe_in_process(git_dir, True) == describe(git_repo)
+    git(git_repo, 'tag', '2.0')
+    assert vcversioner._describe_in_process(git_dir, True) == describe(git_repo)
+
+@needs_git
+def test_tag_index_nested_tag(git_repo):
+    "Tags added to an existing directory of tags refresh the index."
+    kwargs = dict(
+        root=git_repo.strpath, tag_index=True, tag_prefix='svc/',
+        version_file=None, memoize=False)
+    git(git_repo, 'tag', 'svc/1.0')
+    git_commit(git_repo)
+    assert vcversioner.find_version(**kwargs).version == '1.0.dev1'
+    git(git_repo, 'tag', 'svc/1.1')
+    assert vcversioner.find_version(**kwargs).version == '1.1'
+
+@needs_git
+def test_tag_index_read_only(git_repo):
+    "The tag index is used but not written in read-only mode."
+    version = vcversioner.find_version(
+        root=git_repo.strpath, tag_index=True, read_only=True,
+        version_file=None, memoize=False)
+    assert version.version == '1.1.dev2'
+    assert not git_repo.join('.git', 'vcversioner-index').check()
+
+@needs_git
+def test_lazy_version_module_tag_index(git_repo):
+    "Lazy version modules use the tag index without spawning git."
+    module_path = git_repo.join('_version.py')
+    vcversioner.find_version(
+        root=git_repo.strpath, version_module_paths=[module_path.strpath],
+        lazy_version_modules=True, tag_index=True, version_file=None,
+        git_args=['vcversioner-test-no-such-git'])
+    git_commit(git_repo)
+    vcversioner.clear_memo()
+    assert load_module(module_path).__version__ == '1.1.dev3'
+
+@needs_git
+def test_tag_index_walks_only_new_commits(git_repo, monkeypatch):
+    "Only commits added since the last indexed HEAD are walked."
+    git_dir = git_repo.join('.git').strpath
+    vcversioner._describe_in_process(git_dir, True)
+    for _ in range(3):
+        git_commit(git_repo)
+    walked = []
+    commit = vcversioner._GitRepository.commit
+    def recording_commit(self, sha):
+        walked.append(sha)
+        return commit(self, sha)
+    monkeypatch.setattr(vcversioner._GitRepository, 'commit', recording_commit)
+    assert vcversioner._describe_in_process(git_dir, True) == describe(git_repo)
+    assert len(set(walked)) == 3
+
+@needs_git
+def test_tag_index_find_version(git_repo):
+    "find_version can use the tag index without spawning git."
+    version = vcversioner.find_version(
+        root=git_repo.strpath, Popen=RaisingFakePopen(), tag_index=True)
+    assert version.version == '1.1.dev2'
+
+class RecordingFakePopen(FakePopen):
+    def __call__(self, args, **kwargs):
+        self.args = args
+        return self
+
+def test_tag_prefix(tmpdir):
+    "Tags are matched by their prefix, which is stripped off."
+    popen = RecordingFakePopen(b'v1.0-2-gfeeb')
+    version = vcversioner.find_version(
+        root=tmpdir.strpath, Popen=popen, tag_prefix='v')
+    assert version == ('1.0.dev2', '2', 'gfeeb')
+    assert popen.args[-2:] == ['--match', 'v*']
+    assert tmpdir.join('version.txt').read() == 'v1.0-2-gfeeb'
+
+def test_tag_pattern_and_candidates(tmpdir):
+    "tag_pattern and max_candidates are passed along to git describe."
+    popen = RecordingFakePopen(b'release/1.0-0-gbeef')
+    version = vcversioner.find_version(
+        root=tmpdir.strpath, Popen=popen, tag_prefix='release/',
+        tag_pattern='[0-9]*', max_candidates=3)
+    assert version.version == '1.0'
+    assert popen.args[-3:] == [
+        '--match', 'release/[0-9]*', '--candidates=3']
+
+def test_tag_prefix_glob_characters():
+    "Glob characters in tag_prefix only match themselves."
+    glob, regex = vcversioner._tag_filter('[v]', None)
+    assert glob == r'\[v]*'
+    assert regex.match('[v]1.0')
+    assert not regex.match('v1.0')
+
+@pytest.fixture
+def prefixed_repo(git_repo):
+    git(git_repo, 'tag', 'deploy-1')
+    git(git_repo, 'tag', '-a', '-m', 'release', 'v1.2', 'HEAD~1')
+    git(git_repo, 'tag', 'v-rc', 'HEAD~1')
+    return git_repo
+
+@needs_git
+@pytest.mark.parametrize('packed', [False, True])
+@pytest.mark.parametrize(['prefix', 'pattern'], [
+    ('', None), ('v', None), ('', '[0-9]*'), ('v', '[0-9]*')])
+def test_in_process_tag_filter(prefixed_repo, packed, prefix, pattern):
+    "Tags are filtered in-process just like git filters them."
+    if packed:
+        git(prefixed_repo, 'pack-refs', '--all')
+    glob, match = vcversioner._tag_filter(prefix, pattern)
+    args = ['--match', glob] if glob else []
+    expected = git(prefixed_repo, 'describe', '--tags', '--long', *args)
+    git_dir = prefixed_repo.join('.git').strpath
+    assert vcversioner._describe_in_process(
+        git_dir, match=match) == expected
+    assert vcversioner._describe_in_process(
+        git_dir, True, match=match) == expected
+    with vcversioner.GitSession(prefixed_repo.strpath) as session:
+        assert session.describe(prefix, pattern) == expected
+
+@needs_git
+def test_in_process_max_candidates(git_repo):
+    "With no candidates allowed, only an exact tag describes HEAD."
+    git_dir = git_repo.join('.git').strpath
+    assert vcversioner._describe_in_process(
+        git_dir, max_candidates=0) is None
+    assert vcversioner._describe_in_process(
+        git_dir, True, max_candidates=0) is None
+    git(git_repo, 'tag', '2.0')
+    assert vcversioner._describe_in_process(
+        git_dir, max_candidates=0) == describe(git_repo)
+
+@needs_git
+def test_in_process_tag_prefix(prefixed_repo):
+    "find_version strips tag_prefix off of in-process versions too."
+    version = vcversioner.find_version(
+        root=prefixed_repo.strpath, Popen=RaisingFakePopen(), in_process=True,
+        tag_prefix='v')
+    assert version.version == '1.2.dev1'
+
+@needs_git
+def test_packed_tags_not_read(git_repo, monkeypatch):
+    "Packed tags which are filtered out or not tied aren't read at all."
+    git(git_repo, 'pack-refs', '--all')
+    read = []
+    read_object = vcversioner._GitRepository.read_object
+    def recording_read_object(self, sha):
+        type, data = read_object(self, sha)
+        read.append(type)
+        return type, data
+    monkeypatch.setattr(
+        vcversioner._GitRepository, 'read_object', recording_read_object)
+    with vcversioner._GitRepository(git_repo.join('.git').strpath) as repo:
+        repo.tagged_commits()
+    assert b'tag' not in read
+
+@needs_git
+def test_lazy_version_module_tag_prefix(prefixed_repo):
+    "Lazy version modules find the version with the same tag options."
+    module_path = prefixed_repo.join('_version.py')
+    vcversioner.find_version(
+        root=prefixed_repo.strpath, version_module_paths=[module_path.strpath],
+        lazy_version_modules=True, tag_prefix='v', max_candidates=2)
+    vcversioner.clear_memo()
+    assert load_module(module_path).__version__ == '1.2.dev1'
+
+hanging_git = [sys.executable, '-c', 'import time; time.sleep(60)']
+
+def test_timeout(tmpdir, capsys):
+    "git is killed if it takes too long, and version.txt is used instead."
+    tmpdir.join('version.txt').write('1.0-0-gbeef')
+    start = time.perf_counter()
+    version = vcversioner.find_version(
+        root=tmpdir.strpath, git_args=hanging_git, timeout=0.5)
+    assert time.perf_counter() - start < 30
+    assert version == ('1.0', '0', 'gbeef')
+    out, err = capsys.readouterr()
+    assert 'timed out after 0.5 seconds' in out
+    assert repr(tmpdir.join('version.txt').strpath) in out
+
+def test_timeout_without_version_file(tmpdir, capsys):
+    "If git times out and there's no version.txt, abort."
+    with pytest.raises(SystemExit):
+        vcversioner.find_version(
+            root=tmpdir.strpath, git_args=hanging_git, timeout=0.1)
+    out, err = capsys.readouterr()
+    assert 'timed out after' in out
+
+def test_timeout_falls_back_to_stale_cache(tmpdir):
+    "Without version.txt, the last cached version is used instead."
+    cache_file = tmpdir.join('version.cache')
+    cache_file.write(json.dumps(
+        {'key': 'something else', 'raw_version': '1.0-2-gfeeb'}))
+    version = vcversioner.find_version(
+        root=tmpdir.strpath, git_args=hanging_git, timeout=0.1,
+        version_file=None, cache_file=cache_file.strpath, memoize=False)
+    assert version == ('1.0.dev2', '2', 'gfeeb')
+
+def test_timeout_find_versions(tmpdir):
+    "find_versions also gives up on git after the timeout."
+    tmpdir.join('version.txt').write('1.0-0-gbeef')
+    versions = vcversioner.find_versions(
+        [tmpdir.strpath], git_args=hanging_git, timeout=0.1)
+    assert versions[tmpdir.strpath] == ('1.0', '0', 'gbeef')
+
+def test_timeout_traced(tmpdir):
+    "How long git was waited for is traced."
+    tmpdir.join('version.txt').write('1.0-0-gbeef')
+    traces = []
+    vcversioner.find_version(
+        root=tmpdir.strpath, git_args=hanging_git, timeout=0.1,
+        trace=traces.append)
+    [trace] = traces
+    assert trace['version_source'] == 'version_file'
+    assert trace['phases']['timeout'] >= 0.1
+
+def test_manifest(tmpdir):
+    "Several projects can share one manifest instead of version files."
+    manifest = tmpdir.join('versions.txt')
+    roots = [tmpdir.join(name).ensure(dir=True) for name in ['spam', 'eggs']]
+    for root, popen in zip(roots, [basic_version, dev_version]):
+        vcversioner.find_version(
+            root=root.strpath, Popen=popen, version_file=None,
+            manifest_file=manifest.strpath)
+    assert manifest.read() == (
+        vcversioner._manifest_header
+        + 'eggs\t1.0-2-gfeeb\t1.0.dev2\n'
+        + 'spam\t1.0-0-gbeef\t1.0\n')
+
+@pytest.mark.parametrize('manifest_mmap', [False, True])
+def test_manifest_fallback(tmpdir, manifest_mmap):
+    "If git fails, the project's entry in the manifest is used."
+    manifest = tmpdir.join('versions.txt')
+    manifest.write(
+        vcversioner._manifest_header
+        + 'eggs\t1.0-2-gfeeb\t1.0.dev2\n'
+        + 'spam\t2.0-0-gbeef\t2.0\n')
+    version = vcversioner.find_version(
+        root=tmpdir.join('spam').strpath, Popen=git_failed,
+        version_file=None, manifest_file=manifest.strpath,
+        manifest_mmap=manifest_mmap)
+    assert version == ('2.0', '0', 'gbeef')
+
+@pytest.mark.parametrize('manifest_mmap', [False, True])
+def test_manifest_missing_entry(tmpdir, manifest_mmap):
+    "If git fails and the manifest doesn't have the project, abort."
+    manifest = tmpdir.join('versions.txt')
+    manifest.write(vcversioner._manifest_header)
+    with pytest.raises(SystemExit):
+        vcversioner.find_version(
+            root=tmpdir.join('spam').strpath, Popen=git_failed,
+            version_file=None, manifest_file=manifest.strpath,
+            manifest_mmap=manifest_mmap)
+
+@pytest.mark.parametrize('manifest_mmap', [False, True])
+def test_manifest_version_file_newline(tmpdir, manifest_mmap):
+    "A version file ending in a newline doesn't break the manifest."
+    manifest = tmpdir.join('versions.txt')
+    root = tmpdir.join('pkg').ensure(dir=True)
+    root.join('version.txt').write('1.0-0-gbeef\n')
+    kwargs = dict(
+        root=root.strpath, Popen=git_failed, manifest_file=manifest.strpath,
+        manifest_mmap=manifest_mmap, memoize=False)
+    assert vcversioner.find_version(**kwargs).version == '1.0'
+    assert manifest.read() == (
+        vcversioner._manifest_header + 'pkg\t1.0-0-gbeef\t1.0\n')
+    root.join('version.txt').remove()
+    assert vcversioner.find_version(**kwargs) == ('1.0', '0', 'gbeef')
+
+def test_manifest_skips_malformed_lines(tmpdir):
+    "Lines of a manifest which can't be parsed are ignored."
+    manifest = tmpdir.join('versions.txt')
+    manifest.write(
+        vcversioner._manifest_header
+        + 'eggs\t1.0-2-gfeeb\n\t1.0.dev2\n'
+        + 'spam\t2.0-0-gbeef\t2.0\n')
+    version = vcversioner.find_version(
+        root=tmpdir.join('spam').strpath, Popen=git_failed,
+        version_file=None, manifest_file=manifest.strpath)
+    assert version == ('2.0', '0', 'gbeef')
+
+def test_manifest_unchanged(tmpdir):
+    "The manifest isn't rewritten if this project's entry is the same."
+    manifest = tmpdir.join('versions.txt')
+    kwargs = dict(
+        root=tmpdir.join('spam').strpath, Popen=basic_version,
+        version_file=None, manifest_file=manifest.strpath, memoize=False)
+    vcversioner.find_version(**kwargs)
+    os.utime(manifest.strpath, (0, 0))
+    vcversioner.find_version(**kwargs)
+    assert manifest.mtime() == 0
+
+def test_manifest_parsed_once(tmpdir, monkeypatch):
+    "A manifest is only parsed once for as long as it's unchanged."
+    manifest = tmpdir.join('versions.txt')
+    roots = [tmpdir.join('p%d' % (n,)).strpath for n in range(5)]
+    vcversioner.find_versions(
+        roots, Popen=basic_version, version_file=None,
+        manifest_file=manifest.strpath)
+    parsed = []
+    parse_manifest = vcversioner._parse_manifest
+    def recording_parse_manifest(content):
+        parsed.append(content)
+        return parse_manifest(content)
+    monkeypatch.setattr(
+        vcversioner, '_parse_manifest', recording_parse_manifest)
+    vcversioner._manifests.clear()
+    versions = vcversioner.find_versions(
+        roots, Popen=git_failed, version_file=None,
+        manifest_file=manifest.strpath)
+    assert all(version == ('1.0', '0', 'gbeef')
+               for version in versions.values())
+    assert len(parsed) == 1
+
+@pytest.fixture
+def files_repo(git_repo):
+    git_repo.join('spam', 'eggs.py').write('eggs = 1\n', ensure=True)
+    git_repo.join('README').write('spam\n')
+    git(git_repo, 'add', '.')
+    git_commit(git_repo)
+    return git_repo
+
+def find_dirty_version(root, **kwargs):
+    return vcversioner.find_version(
+        root=root.strpath, version_file=None, memoize=False, dirty=True,
+        **kwargs)
+
+@needs_git
+def test_dirty_clean_tree(files_repo):
+    "A clean tree isn't dirty."
+    version = find_dirty_version(files_repo)
+    assert version == ('1.1.dev3', '3', version.sha)
+    assert not version.dirty
+
+@needs_git
+def test_dirty_modified_file(files_repo):
+    "Modifying a tracked file makes the version dirty."
+    files_repo.join('spam', 'eggs.py').write('eggs = 2\n')
+    version = find_dirty_version(files_repo)
+    assert version.version == '1.1.dev3+dirty'
+    assert version.dirty
+
+@needs_git
+def test_dirty_deleted_file(files_repo):
+    "Deleting a tracked file makes the version dirty."
+    files_repo.join('README').remove()
+    assert find_dirty_version(files_repo).dirty
+
+@needs_git
+def test_dirty_touched_file(files_repo):
+    "Touching a file without changing it doesn't make the version dirty."
+    os.utime(files_repo.join('README').strpath, (0, 0))
+    assert not find_dirty_version(files_repo).dirty
+
+@needs_git
+def test_dirty_untracked_file(files_repo):
+    "Untracked files don't make the version dirty."
+    files_repo.join('untracked').write('spam\n')
+    assert not find_dirty_version(files_repo).dirty
+
+@needs_git
+def test_dirty_staged_file(files_repo):
+    "Staging a change doesn't make the version clean, just as for git."
+    files_repo.join('spam', 'eggs.py').write('eggs = 2\n')
+    git(files_repo, 'add', '.')
+    assert git(files_repo, 'describe', '--dirty').endswith('-dirty')
+    assert find_dirty_version(files_repo).dirty
+    git(files_repo, 'reset', '-q', '--hard')
+    assert not find_dirty_version(files_repo).dirty
+
+@needs_git
+def test_dirty_staged_new_file(files_repo):
+    "Staging a new file makes the version dirty."
+    files_repo.join('spam', 'ham.py').write('ham = 1\n')
+    git(files_repo, 'add', '.')
+    assert find_dirty_version(files_repo).dirty
+
+@needs_git
+def test_dirty_clone(files_repo, tmpdir_factory):
+    "A fresh clone's index caches its tree, so it's clean."
+    clone = tmpdir_factory.mktemp('clone').join('clone')
+    git(files_repo, 'clone', '-q', files_repo.strpath, clone.strpath)
+    assert not vcversioner._is_dirty(clone.strpath)
+
+def test_dirty_namedtuple_helpers():
+    "Versions made or replaced with the namedtuple helpers keep dirty."
+    version = vcversioner.Version('1.0+dirty', '0', 'gbeef', dirty=True)
+    assert version._replace(version='1.0').dirty
+    assert version._replace(version='1.0').version == '1.0'
+    assert not version._replace(dirty=False).dirty
+    assert not vcversioner.Version._make(['1.0', '0', 'gbeef']).dirty
+    assert repr(version) == (
+        "Version(version='1.0+dirty', commits='0', sha='gbeef', dirty=True)")
+    assert repr(version._replace(dirty=False)) == (
+        "Version(version='1.0+dirty', commits='0', sha='gbeef')")
+
+@needs_git
+def test_dirty_root_only(files_repo):
+    "Changes outside the root can be ignored."
+    files_repo.join('README').write('eggs\n')
+    root = files_repo.join('spam')
+    git_args = ['git', '--git-dir', files_repo.join('.git').strpath,
+                'describe', '--tags', '--long']
+    assert find_dirty_version(root, git_args=git_args).dirty
+    assert not find_dirty_version(
+        root, git_args=git_args, dirty_root_only=True).dirty
+    git(files_repo, 'add', 'README')
+    assert find_dirty_version(root, git_args=git_args).dirty
+    assert not find_dirty_version(
+        root, git_args=git_args, dirty_root_only=True).dirty
+    root.join('eggs.py').write('eggs = 2\n')
+    git(files_repo, 'add', '.')
+    assert find_dirty_version(
+        root, git_args=git_args, dirty_root_only=True).dirty
+
+@needs_git
+def test_dirty_index_v4(files_repo):
+    "Path-compressed (version 4) indexes are understood."
+    git(files_repo, 'update-index', '--index-version', '4')
+    assert not find_dirty_version(files_repo).dirty
+    files_repo.join('spam', 'eggs.py').write('eggs = 2\n')
+    assert find_dirty_version(files_repo).dirty
+
+def test_dirty_local_version(tmpdir):
+    "A version with a local part already gets a .dirty suffix instead."
+    tmpdir.join('.git').ensure(dir=True)
+    index = tmpdir.join('.git', 'index')
+    index.write_binary(
+        b'DIRC\0\0\0\x02\0\0\0\x01'
+        + vcversioner._index_entry.pack(
+            0, 0, 0, 0, 0, 0, 0o100644, 0, 0, 0, b'\0' * 20, 4)
+        + b'gone\0\0\0\0\0\0')
+    version = find_dirty_version(tmpdir, Popen=FakePopen(b'1.0+spam-0-gbeef'))
+    assert version.version == '1.0+spam.dirty'
+
+@pytest.fixture
+def worktree(git_repo, tmpdir_factory):
+    path = tmpdir_factory.mktemp('worktrees').join('worktree')
+    git(git_repo, 'worktree', 'add', '-q', path.strpath)
+    git_commit(path)
+    return path
+
+@needs_git
+def test_worktree_git_dir(worktree):
+    "A worktree's .git file is followed to its git directory."
+    git_dir = vcversioner._resolve_git_dir(worktree.join('.git').strpath)
+    assert os.path.isdir(git_dir)
+    assert os.path.samefile(
+        vcversioner._common_dir(git_dir),
+        git(worktree, 'rev-parse', '--git-common-dir'))
+
+@needs_git
+def test_worktree_in_process(worktree):
+    "Worktrees can be read in-process."
+    assert describe(worktree).startswith('1.1-3-g')
+    git_dir = vcversioner._resolve_git_dir(worktree.join('.git').strpath)
+    assert vcversioner._describe_in_process(git_dir) == describe(worktree)
+    version = vcversioner.find_version(
+        root=worktree.strpath, Popen=RaisingFakePopen(), in_process=True)
+    assert version.version == '1.1.dev3'
+
+@needs_git
+def test_worktree_git_args(worktree):
+    "git is passed the worktree's git directory."
+    popen = RecordingFakePopen(b'1.0-0-gbeef')
+    vcversioner.find_version(root=worktree.strpath, Popen=popen)
+    git_dir = vcversioner._resolve_git_dir(worktree.join('.git').strpath)
+    assert popen.args[:3] == ['git', '--git-dir', git_dir]
+    version = vcversioner.find_version(
+        root=worktree.strpath, version_file=None, memoize=False)
+    assert version.version == '1.1.dev3'
+
+@needs_git
+def test_worktree_session_and_cache(worktree):
+    "Sessions and the cache fingerprint understand worktrees."
+    with vcversioner.GitSession(worktree.strpath) as session:
+        assert session.describe() == describe(worktree)
+    git_dir = vcversioner._resolve_git_dir(worktree.join('.git').strpath)
+    fingerprint = vcversioner._ref_fingerprint(git_dir)
+    assert fingerprint[1] == git(worktree, 'rev-parse', 'HEAD')
+    assert fingerprint[3] is not None
+
+@needs_git
+def test_worktree_dirty(worktree):
+    "A worktree's own index is checked for modifications."
+    worktree.join('spam').write('spam\n')
+    git(worktree, 'add', 'spam')
+    git_commit(worktree)
+    assert not vcversioner._is_dirty(worktree.strpath)
+    worktree.join('spam').write('eggs\n')
+    assert vcversioner._is_dirty(worktree.strpath)
+
+@needs_git
+def test_submodule(git_repo, tmpdir_factory):
+    "Submodules' .git files are followed too."
+    parent = tmpdir_factory.mktemp('parent')
+    git(parent, 'init', '-q')
+    git(parent, '-c', 'protocol.file.allow=always', 'submodule', 'add', '-q',
+        git_repo.strpath, 'sub')
+    sub = parent.join('sub')
+    assert sub.join('.git').check(file=True)
+    version = vcversioner.find_version(
+        root=sub.strpath, Popen=RaisingFakePopen(), in_process=True)
+    assert version.version == '1.1.dev2'
+    assert vcversioner.find_version(
+        root=sub.strpath, version_file=None, memoize=False) == version
+
+@contextlib.contextmanager
+def watching(root, **kwargs):
+    found = queue.Queue()
+    stop = threading.Event()
+    kwargs.setdefault('poll_interval', 0.05)
+    kwargs.setdefault('debounce', 0.05)
+    thread = threading.Thread(target=vcversioner.watch, kwargs=dict(
+        root=root.strpath, callback=found.put, stop=stop, **kwargs))
+    thread.start()
+    try:
+        yield found
+    finally:
+        stop.set()
+        thread.join()
+
+def wait_for_version(found, version):
+    while True:
+        latest = found.get(timeout=10)
+        if latest.version == version:
+            return latest
+
+@needs_git
+@pytest.mark.parametrize('use_inotify', [True, False])
+def test_watch(git_repo, use_inotify):
+    "Version modules are rewritten when the refs change."
+    module_path = git_repo.join('_version.py')
+    with watching(git_repo, version_module_paths=[module_path.strpath],
+                  use_inotify=use_inotify) as found:
+        wait_for_version(found, '1.1.dev2')
+        git_commit(git_repo)
+        wait_for_version(found, '1.1.dev3')
+        git(git_repo, 'tag', '2.0')
+        wait_for_version(found, '2.0')
+    assert load_module(module_path).__version__ == '2.0'
+    assert git_repo.join('version.txt').read().startswith('2.0-0-g')
+
+class ScriptedWatcher(object):
+    "A watcher whose waits return *events* in turn, then set *stop*."
+    def __init__(self, events, stop):
+        self.events = list(events)
+        self.stop = stop
+        self.waits = []
+        self.closed = False
+
+    def wait(self, timeout):
+        self.waits.append(timeout)
+        if not self.events:
+            self.stop.set()
+            return False
+        return self.events.pop(0)
+
+    def close(self):
+        self.closed = True
+
+def test_watch_debounces(tmpdir, monkeypatch):
+    "A burst of ref updates only finds the version once."
+    stop = threading.Event()
+    watcher = ScriptedWatcher([True] * 5 + [False], stop)
+    monkeypatch.setattr(
+        vcversioner, '_PollWatcher', lambda git_dir, interval: watcher)
+    popen = CountingFakePopen(b'1.0-0-gbeef')
+    found = []
+    vcversioner.watch(
+        debounce=0.5, poll_interval=2, use_inotify=False,
+        callback=found.append, stop=stop, root=tmpdir.strpath, Popen=popen,
+        version_file=None)
+    assert found == [('1.0', '0', 'gbeef')] * 2
+    assert popen.calls == 2
+    assert watcher.waits == [2] + [0.5] * 5 + [2]
+    assert watcher.closed
+
+@needs_git
+def test_watch_new_ref_directories(git_repo):
+    "Tags in new directories under refs/tags are noticed too."
+    with watching(git_repo) as found:
+        wait_for_version(found, '1.1.dev2')
+        git(git_repo, 'tag', 'release/3.0')
+        wait_for_version(found, 'release/3.0')
+        git_commit(git_repo)
+        git(git_repo, 'tag', 'release/3.1')
+        wait_for_version(found, 'release/3.1')
+
+def test_watch_failure(tmpdir):
+    "Failing to find a version doesn't stop watching."
+    tmpdir.join('.git').ensure(dir=True)
+    with watching(tmpdir, Popen=git_failed, version_file=None) as found:
+        assert isinstance(
+            found.get(timeout=10), vcversioner.VersionNotFound)
+
+def test_main_watch(monkeypatch):
+    "python -m vcversioner watch passes its arguments along to watch."
+    calls = []
+    monkeypatch.setattr(
+        vcversioner, 'watch', lambda **kwargs: calls.append(kwargs))
+    vcversioner.main([
+        'watch', '--root', 'spam', '--version-module', 'spam/_version.py',
+        '--no-version-file', '--poll'])
+    [kwargs] = calls
+    assert kwargs['root'] == 'spam'
+    assert kwargs['version_module_paths'] == ['spam/_version.py']
+    assert kwargs['version_file'] is None
+    assert not kwargs['use_inotify']
+
+
+def test_backend(tmpdir, monkeypatch):
+    "Roots without .git are handed to the backend for their directory."
+    tmpdir.join('.spam').ensure(dir=True)
+    backend = types.SimpleNamespace(
+        describe=lambda path, match: None,
+        command=lambda path, match: ['spam', path])
+    monkeypatch.setattr(
+        vcversioner, 'backends', [('.spam', 'vcversioner_spam')])
+    monkeypatch.setitem(sys.modules, 'vcversioner_spam', backend)
+    popen = RecordingFakePopen(b'1.0-0-sbeef')
+    version = vcversioner.find_version(
+        root=tmpdir.strpath, Popen=popen, version_file=None)
+    assert version == ('1.0', '0', 'sbeef')
+    assert popen.args == ['spam', tmpdir.join('.spam').strpath]
+
+def test_backend_describe(tmpdir, monkeypatch):
+    "A backend which can describe the repository itself spawns nothing."
+    tmpdir.join('.spam').ensure(dir=True)
+    backend = types.SimpleNamespace(
+        describe=lambda path, match: '1.0-2-sbeef',
+        command=lambda path, match: ['spam'])
+    monkeypatch.setattr(
+        vcversioner, 'backends', [('.spam', 'vcversioner_spam')])
+    monkeypatch.setitem(sys.modules, 'vcversioner_spam', backend)
+    version = vcversioner.find_version(
+        root=tmpdir.strpath, Popen=RaisingFakePopen(), version_file=None)
+    assert version == ('1.0.dev2', '2', 'sbeef')
+
+def test_backend_not_importable(tmpdir, monkeypatch):
+    "If a backend can't be imported, git is used after all."
+    tmpdir.join('.spam').ensure(dir=True)
+    monkeypatch.setattr(
+        vcversioner, 'backends', [('.spam', 'vcversioner_no_such_backend')])
+    version = vcversioner.find_version(
+        root=tmpdir.strpath, Popen=basic_version, version_file=None)
+    assert version == ('1.0', '0', 'gbeef')
+
+
+def _hg_available():
+    try:
+        subprocess.check_output(['hg', '--version'])
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return True
+
+needs_hg = pytest.mark.skipif(
+    not _hg_available(), reason='hg is not installed')
+
+_hg_env = dict(os.environ, HGRCPATH=os.devnull, HGUSER='vcversioner')
+
+def hg(repo, *args):
+    return subprocess.check_output(
+        ('hg',) + args, cwd=str(repo), env=_hg_env).decode().strip()
+
+def hg_commit(repo, message='commit'):
+    repo.join('file').write(message + '\n', mode='a')
+    hg(repo, 'commit', '-q', '-A', '-m', message)
+
+def hg_describe(repo, match=None):
+    "Describe *repo* by running hg, as vcversioner would."
+    command = vcversioner_hg.command(repo.join('.hg').strpath, match)
+    return hg(repo, *command[1:]) or None
+
+@pytest.fixture
+def hg_repo(tmpdir):
+    hg(tmpdir, 'init')
+    hg_commit(tmpdir)
+    hg(tmpdir, 'tag', '-r', '.', '1.0')
+    hg_commit(tmpdir)
+    hg(tmpdir, 'tag', '-r', '.', '1.1')
+    hg_commit(tmpdir)
+    hg(tmpdir, 'tags')
+    return tmpdir
+
+def find_hg_version(root, **kwargs):
+    kwargs.setdefault('version_file', None)
+    kwargs.setdefault('version_module_paths', ())
+    return vcversioner.find_version(root=root.strpath, **kwargs)
+
+@needs_hg
+def test_hg(hg_repo):
+    "Mercurial repositories are read without spawning hg."
+    node = hg(hg_repo, 'log', '-r', '.', '--template', '{node|short}')
+    version = find_hg_version(hg_repo, Popen=RaisingFakePopen())
+    assert version == ('1.1.dev2', '2', 'h' + node)
+    assert hg_describe(hg_repo) == '1.1-2-h' + node
+
+@needs_hg
+def test_hg_stale_tags(hg_repo):
+    "If hg's tag cache is out of date, hg is run instead."
+    hg_commit(hg_repo)
+    hg_dir = hg_repo.join('.hg').strpath
+    assert vcversioner_hg.describe(hg_dir) is None
+    assert find_hg_version(hg_repo).version == '1.1.dev3'
+    assert find_hg_version(
+        hg_repo, Popen=RaisingFakePopen()).version == '1.1.dev3'
+
+@needs_hg
+def test_hg_untagged(tmpdir):
+    "Repositories without tags aren't described."
+    hg(tmpdir, 'init')
+    hg_commit(tmpdir)
+    hg(tmpdir, 'tags')
+    assert vcversioner_hg.describe(tmpdir.join('.hg').strpath) is None
+    assert hg_describe(tmpdir) is None
+
+@needs_hg
+def test_hg_tag_prefix(hg_repo):
+    "Tags are chosen in Mercurial repositories just as with git."
+    hg(hg_repo, 'tag', '-r', '1', 'v2.0')
+    hg(hg_repo, 'tags')
+    _, match = vcversioner._tag_filter('v', None)
+    assert vcversioner_hg.describe(
+        hg_repo.join('.hg').strpath, match) == hg_describe(hg_repo, match)
+    version = find_hg_version(
+        hg_repo, tag_prefix='v', Popen=RaisingFakePopen())
+    assert version.version == '2.0.dev4'
+
+@needs_hg
+def test_hg_merges(hg_repo):
+    "The latest tag across a merge is the one with the fewest changes since."
+    hg(hg_repo, 'update', '-q', '-r', '0')
+    hg_commit(hg_repo, 'branch')
+    hg(hg_repo, 'tag', '-r', '.', '2.0')
+    hg(hg_repo, 'merge', '-q', '--tool', ':local')
+    hg(hg_repo, 'commit', '-q', '-m', 'merge')
+    hg(hg_repo, 'tags')
+    hg_dir = hg_repo.join('.hg').strpath
+    assert vcversioner_hg.describe(hg_dir) == hg_describe(hg_repo)
+
+@needs_hg
+def test_hg_share(hg_repo, tmpdir_factory):
+    "Shared repositories are read through the repository they share."
+    path = tmpdir_factory.mktemp('shares').join('share')
+    hg(hg_repo, '--config', 'extensions.share=', 'share', '-q',
+       hg_repo.strpath, path.strpath)
+    hg(path, 'tags')
+    assert vcversioner_hg.describe(
+        path.join('.hg').strpath) == hg_describe(path)
+
+
+def test_version_module_precomputed(tmpdir):
+    "Version modules carry the version's parts, ready to compare."
+    module_path = tmpdir.join('_version.py')
+    vcversioner.find_version(
+        Popen=FakePopen(b'1.2rc1-3-gbeef'), root=tmpdir.strpath,
+        version_module_paths=[module_path.strpath])
+    module = load_module(module_path)
+    assert module.__version__ == '1.2rc1.dev3'
+    assert module.__version_info__ == (1, 2, 'rc1', 'dev3')
+    assert module.__commits__ == 3
+    assert module.__version_key__ < vcversioner._version_info('1.2rc1')[1]
+    assert module.__version_key__ > vcversioner._version_info('1.2b4')[1]
+
+@pytest.mark.parametrize('versions', [
+    ['1.0.dev1', '1.0a1', '1.0a2.dev4', '1.0a2', '1.0b1', '1.0rc1', '1.0',
+     '1.0+dirty', '1.0.post1.dev2', '1.0.post1', '1.0.1', '1.1', '1!0.1'],
+    ['1.0+1', '1.0+2', '1.0+10', '1.0+10.1'],
+    ['1.0+abc', '1.0+abc.1', '1.0+1'],
+])
+def test_version_key_order(versions):
+    "Version keys sort just as PEP 440 says."
+    keys = [vcversioner._version_info(version)[1] for version in versions]
+    assert keys == sorted(keys)
+    assert len(set(keys)) == len(keys)
+
+@pytest.mark.parametrize('same', [
+    ['1.0', '1.0.0', 'v1.0'],
+    ['1.0rc1', '1.0c1', '1.0-rc-1', '1.0.pre1'],
+    ['1.0-1', '1.0.post1', '1.0r1', '1.0-rev1'],
+    ['1.0+a.1', '1.0+A-1', '1.0+a_1'],
+])
+def test_version_key_normalized(same):
+    "Equivalent spellings of a version have the same key."
+    keys = [vcversioner._version_info(version)[1] for version in same]
+    assert len(set(keys)) == 1
+
+def test_version_info_not_pep440():
+    "Versions which aren't PEP 440 versions have no info or key."
+    assert vcversioner._version_info('release/3.0') == (None, None)
+
+def test_lazy_version_module_precomputed(tmpdir):
+    "Lazy version modules carry the version's parts too."
+    root = tmpdir.join('root').ensure(dir=True)
+    module_path = tmpdir.join('_version.py')
+    vcversioner.find_version(
+        Popen=dev_version, root=root.strpath,
+        version_module_paths=[module_path.strpath], lazy_version_modules=True)
+    module = load_module(module_path)
+    assert module.__commits__ == 2
+    assert module.__version_info__ == (1, 0, 'dev2')
+    assert module.__version__ == '1.0.dev2'
+    assert module.__version_key__ == vcversioner._version_info('1.0.dev2')[1]
+
+
+@needs_git
+def test_find_tags(prefixed_repo):
+    "All version tags are listed, from the earliest to the latest version."
+    tags = vcversioner.find_tags(root=prefixed_repo.strpath)
+    assert [tag.name for tag in tags] == ['1.0', '1.1', 'v1.2']
+    assert [tag.version for tag in tags] == ['1.0', '1.1', 'v1.2']
+    assert tags[0].sha == git(prefixed_repo, 'rev-parse', 'HEAD~3')
+    assert tags[1].sha == git(prefixed_repo, 'rev-parse', '1.1^{commit}')
+
+@needs_git
+def test_find_tags_prefix(prefixed_repo):
+    "Tags are chosen by prefix and pattern, as for find_version."
+    tags = vcversioner.find_tags(root=prefixed_repo.strpath, tag_prefix='v')
+    assert tags == [
+        ('1.2', 'v1.2', git(prefixed_repo, 'rev-parse', 'HEAD~1'))]
+    tags = vcversioner.find_tags(
+        root=prefixed_repo.strpath, tag_pattern='1.0*')
+    assert [tag.name for tag in tags] == ['1.0']
+
+@needs_git
+def test_find_tags_precedence(git_repo):
+    "Tags are sorted by version precedence, not by name."
+    for name in ['1.10', '1.2', '1.2rc1', '1.2.post1', '1.2.dev3']:
+        git(git_repo, 'tag', name)
+    tags = vcversioner.find_tags(root=git_repo.strpath)
+    assert [tag.name for tag in tags] == [
+        '1.0', '1.1', '1.2.dev3', '1.2rc1', '1.2', '1.2.post1', '1.10']
+
+@needs_git
+@pytest.mark.parametrize('packed', [False, True])
+def test_find_tags_cached(git_repo, monkeypatch, packed):
+    "Tags are only read again once they've changed."
+    if packed:
+        git(git_repo, 'pack-refs', '--all')
+    tags = vcversioner.find_tags(root=git_repo.strpath)
+    reads = []
+    monkeypatch.setattr(
+        vcversioner._GitRepository, 'peeled_tags',
+        lambda self, match: reads.append(match) or {})
+    assert vcversioner.find_tags(root=git_repo.strpath) == tags
+    assert reads == []
+    git(git_repo, 'tag', 'release/2.0')
+    assert vcversioner.find_tags(root=git_repo.strpath) == []
+    assert len(reads) == 1
+
+@needs_git
+def test_find_tags_new_directory(git_repo):
+    "Tags in new directories are noticed."
+    vcversioner.find_tags(root=git_repo.strpath)
+    git(git_repo, 'tag', 'release/2.0')
+    git(git_repo, 'tag', 'v2.0')
+    tags = vcversioner.find_tags(root=git_repo.strpath, tag_prefix='v')
+    assert [tag.name for tag in tags] == ['v2.0']
+    git(git_repo, 'tag', 'release/1.5')
+    tags = vcversioner.find_tags(
+        root=git_repo.strpath, tag_prefix='release/')
+    assert [tag.version for tag in tags] == ['1.5', '2.0']
+
+@needs_git
+def test_find_tags_cache_file(git_repo, monkeypatch):
+    "Other processes can use the tags remembered in cache_file."
+    cache_file = git_repo.join('tags.cache').strpath
+    tags = vcversioner.find_tags(
+        root=git_repo.strpath, cache_file=cache_file)
+    monkeypatch.setattr(vcversioner, '_tag_lists', {})
+    monkeypatch.setattr(
+        vcversioner._GitRepository, 'peeled_tags',
+        lambda self, match: pytest.fail('tags were read again'))
+    assert vcversioner.find_tags(
+        root=git_repo.strpath, cache_file=cache_file) == tags
+    assert isinstance(tags[0], vcversioner.Tag)
+
+@needs_git
+def test_find_tags_with_git(git_repo, monkeypatch):
+    "If the repository can't be read directly, git is used."
+    tags = vcversioner.find_tags(root=git_repo.strpath)
+    monkeypatch.setattr(vcversioner, '_tag_lists', {})
+
+    def unreadable(self):
+        raise vcversioner._GitReadError('unreadable')
+
+    monkeypatch.setattr(vcversioner._GitRepository, 'tag_refs', unreadable)
+    popen = RecordingPopen()
+    assert vcversioner.find_tags(root=git_repo.strpath, Popen=popen) == tags
+    assert popen.commands == ['for-each-ref']
+
+
+class FakeBuildMeta(object):
+    "Stands in for setuptools.build_meta, running setup.py in each hook."
+
+    def __init__(self, root, Popen):
+        self.root = root
+        self.Popen = Popen
+        self.versions = []
+
+    def _run_setup(self):
+        # each hook might be in a new process, remembering nothing.
+        vcversioner.clear_memo()
+        dist = Struct()
+        dist.metadata = Struct()
+        vcversioner.setup(dist, 'vcversioner', {
+            'root': self.root, 'Popen': self.Popen, 'version_file': None})
+        self.versions.append(dist.version)
+
+    def get_requires_for_build_wheel(self, config_settings=None):
+        self._run_setup()
+        return ['wheel']
+
+    def prepare_metadata_for_build_wheel(
+            self, metadata_directory, config_settings=None):
+        self._run_setup()
+        return 'spam.dist-info'
+
+    def build_wheel(self, wheel_directory, config_settings=None,
+                    metadata_directory=None):
+        self._run_setup()
+        return 'spam.whl'
+
+@needs_git
+def test_build_meta(git_repo, monkeypatch):
+    "A build only finds the version once, however many hooks it runs."
+    import setuptools
+    popen = RecordingPopen()
+    fake = FakeBuildMeta(git_repo.strpath, popen)
+    monkeypatch.setattr(setuptools, 'build_meta', fake, raising=False)
+    git_repo.chdir()
+    backend = vcversioner.build_meta
+    assert backend.get_requires_for_build_wheel() == ['wheel']
+    assert backend.prepare_metadata_for_build_wheel('meta') == (
+        'spam.dist-info')
+    assert backend.build_wheel('dist', metadata_directory='meta') == (
+        'spam.whl')
+    assert fake.versions == ['1.1.dev2'] * 3
+    assert popen.commands == ['describe']
+    assert git_repo.join('build', 'vcversioner-build.json').check()
+
+    git_commit(git_repo)
+    assert backend.build_wheel('dist') == 'spam.whl'
+    assert fake.versions[-1] == '1.1.dev3'
+    assert popen.commands == ['describe', 'describe']
+
+@needs_git
+def test_build_meta_explicit_cache_file(git_repo, monkeypatch):
+    "The cache_file from setup.py is used instead, if there is one."
+    monkeypatch.setattr(vcversioner, '_build_defaults', {'cache_file': 'x'})
+    dist = Struct()
+    dist.metadata = Struct()
+    cache_file = git_repo.join('version.cache')
+    vcversioner.setup(dist, 'vcversioner', {
+        'root': git_repo.strpath, 'cache_file': cache_file.strpath,
+        'version_file': None})
+    assert cache_file.check()
+    assert not git_repo.join('x').check()
+
+def test_build_meta_hooks():
+    "The backend has exactly the hooks setuptools.build_meta has."
+    from setuptools import build_meta
+    for name in ['build_wheel', 'build_sdist', 'get_requires_for_build_wheel',
+                 'prepare_metadata_for_build_wheel']:
+        assert hasattr(vcversioner.build_meta, name)
+    assert not hasattr(vcversioner.build_meta, 'build_spam')
+    assert (vcversioner.build_meta.build_wheel.__name__
+            == build_meta.build_wheel.__name__)
+    assert vcversioner._build_defaults == {}
+
+
+def test_pretend_version(tmpdir, monkeypatch):
+    "A version from the environment is used without reading anything."
+    monkeypatch.setenv('VCVERSIONER_PRETEND_VERSION', '2.0.1')
+    monkeypatch.setenv('VCVERSIONER_PRETEND_SHA', 'gcafe')
+    module_path = tmpdir.join('_version.py')
+    version = vcversioner.find_version(
+        root=tmpdir.join('spam').strpath, Popen=RaisingFakePopen(),
+        version_module_paths=[module_path.strpath])
+    assert version == ('2.0.1', '0', 'gcafe')
+    module = load_module(module_path)
+    assert module.__version__ == '2.0.1'
+    assert module.__sha__ == 'gcafe'
+    assert module.__version_info__ == (2, 0, 1)
+
+def test_pretend_version_without_sha(tmpdir, monkeypatch):
+    "The sha is empty if the environment doesn't give one."
+    monkeypatch.setenv('VCVERSIONER_PRETEND_VERSION', ' 2.0 ')
+    monkeypatch.delenv('VCVERSIONER_PRETEND_SHA', raising=False)
+    version = vcversioner.find_version(
+        root=tmpdir.strpath, Popen=RaisingFakePopen())
+    assert version == ('2.0', '0', '')
+    assert not tmpdir.join('version.txt').check()
+
+def test_pretend_version_scoped(tmpdir, monkeypatch):
+    "Versions can be given to just one project by its directory's name."
+    monkeypatch.setenv('VCVERSIONER_PRETEND_VERSION_FOR_SPAM_EGGS', '3.0')
+    monkeypatch.setenv('VCVERSIONER_PRETEND_SHA_FOR_SPAM_EGGS', 'gfeed')
+    monkeypatch.setenv('VCVERSIONER_PRETEND_VERSION', '2.0')
+    monkeypatch.setenv('VCVERSIONER_PRETEND_SHA', 'gcafe')
+    version = vcversioner.find_version(
+        root=tmpdir.join('spam-eggs').strpath, Popen=RaisingFakePopen())
+    assert version == ('3.0', '0', 'gfeed')
+    version = vcversioner.find_version(
+        root=tmpdir.join('ham').strpath, Popen=RaisingFakePopen())
+    assert version == ('2.0', '0', 'gcafe')
+
+def test_pretend_version_scoped_only(tmpdir, monkeypatch):
+    "A version for another project doesn't apply."
+    monkeypatch.setenv('VCVERSIONER_PRETEND_VERSION_FOR_SPAM', '3.0')
+    monkeypatch.delenv('VCVERSIONER_PRETEND_VERSION', raising=False)
+    version = vcversioner.find_version(
+        root=tmpdir.join('eggs').strpath, Popen=basic_version,
+        version_file=None)
+    assert version == ('1.0', '0', 'gbeef')
+
+def test_pretend_version_read_only(tmpdir, monkeypatch):
+    "Read-only lookups don't write version modules for pretend versions."
+    monkeypatch.setenv('VCVERSIONER_PRETEND_VERSION', '2.0')
+    module_path = tmpdir.join('_version.py')
+    vcversioner.find_version(
+        root=tmpdir.strpath, version_module_paths=[module_path.strpath],
+        read_only=True)
+    assert not module_path.check()
+
+def test_pretend_version_trace(tmpdir, monkeypatch):
+    "Pretend versions are traced as such."
+    monkeypatch.setenv('VCVERSIONER_PRETEND_VERSION', '2.0')
+    traces = []
+    vcversioner.find_version(root=tmpdir.strpath, trace=traces.append)
+    [trace] = traces
+    assert trace['version_source'] == 'pretend'
+    assert trace['version'] == '2.0'
+
+
+def _soak_worker(job):
+    "Find versions over and over, as one of the processes of a soak test."
+    calls, configs = job
+    latencies = []
+    for n in range(calls):
+        kwargs = dict(configs[n % len(configs)], memoize=False)
+        start = time.perf_counter()
+        vcversioner.find_version(**kwargs)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def soak_calls():
+    "Return how many processes a soak test uses, and how many calls each."
+    processes, calls = os.environ.get('VCVERSIONER_SOAK', '8,24').split(',')
+    return int(processes), int(calls)
+
+def soak(configs, paths=()):
+    """Find versions from many processes at once, checking files as they go.
+
+    *configs* is a list of lists of keyword arguments for find_version; each
+    process cycles through one of those lists (in turn), so the files being
+    written keep changing. Meanwhile, each of *paths* is read over and over,
+    and any contents which aren't what one of *configs* would write are
+    recorded as torn. ``$VCVERSIONER_SOAK``, as ``processes,calls``, overrides
+    the default of 8 processes each making 24 calls. Returns a dict of
+    statistics.
+
+    """
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    processes, calls = soak_calls()
+    valid = dict((path, set()) for path in paths)
+    for kwargs in sum(configs, []):
+        vcversioner.find_version(**dict(kwargs, memoize=False))
+        for path in paths:
+            with open(path, 'rb') as infile:
+                valid[path].add(infile.read())
+
+    torn = []
+    reads = [0]
+    stop = threading.Event()
+
+    def check():
+        while paths and not stop.is_set():
+            for path in paths:
+                with open(path, 'rb') as infile:
+                    content = infile.read()
+                reads[0] += 1
+                if content not in valid[path]:
+                    torn.append((path, content))
+
+    jobs = [(calls, configs[n % len(configs)]) for n in range(processes)]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        # spawn the workers before the checking thread starts.
+        list(executor.map(abs, range(processes)))
+        checker = threading.Thread(target=check)
+        checker.start()
+        start = time.perf_counter()
+        try:
+            results = list(executor.map(_soak_worker, jobs))
+        finally:
+            elapsed = time.perf_counter() - start
+            stop.set()
+            checker.join()
+    latencies = sorted(sum(results, []))
+    stats = {
+        'processes': processes,
+        'calls': len(latencies),
+        'throughput': len(latencies) / elapsed,
+        'p50': latencies[len(latencies) // 2],
+        'p99': latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)],
+        'max': latencies[-1],
+        'reads': reads[0],
+        'torn': torn,
+    }
+    print('soak: %(processes)d processes, %(calls)d calls, '
+          '%(throughput).1f calls/s, p50 %(p50).4fs, p99 %(p99).4fs, '
+          'max %(max).4fs, %(reads)d reads' % stats)
+    return stats
+
+@needs_git
+def test_soak(git_repo):
+    "Version files and modules are never torn, however many processes write."
+    module_path = git_repo.join('_version.py').strpath
+    base = {
+        'root': git_repo.strpath,
+        'version_module_paths': [module_path],
+    }
+    git_args = ['git', '--git-dir', '%(git_dir)s', 'describe', '--tags',
+                '--long']
+    configs = [
+        base,
+        dict(base, git_args=git_args + ['--abbrev=12']),
+        dict(base, include_dev_version=False),
+    ]
+    stats = soak(
+        [configs], [git_repo.join('version.txt').strpath, module_path])
+    assert stats['torn'] == []
+    assert stats['reads'] > 0
+
+def test_soak_manifest(tmpdir):
+    "Processes sharing a manifest don't lose each other's updates."
+    processes, calls = soak_calls()
+    configs = []
+    for n in range(processes):
+        base = {
+            'root': tmpdir.join('spam%d' % (n,)).ensure(dir=True).strpath,
+            'version_file': None,
+            'manifest_file': tmpdir.join('manifest.txt').strpath,
+        }
+        configs.append([
+            dict(base, Popen=FakePopen(('1.%d-0-gbeef' % (n,)).encode())),
+            dict(base, Popen=FakePopen(('2.%d-0-gbeef' % (n,)).encode())),
+        ])
+    soak(configs)
+    entries = vcversioner._parse_manifest(
+        tmpdir.join('manifest.txt').read_binary())
+    last = 1 + (calls - 1) % 2
+    assert entries == dict(
+        ('spam%d' % (n,), ('%d.%d-0-gbeef' % (last, n), '%d.%d' % (last, n)))
+        for n in range(processes))
+
+@pytest.mark.skipif(vcversioner.fcntl is None, reason='no fcntl')
+def test_lock_failure(tmpdir, monkeypatch):
+    "Directories which can't be locked are written to unlocked."
+    closed = []
+    def failing_flock(fd, operation):
+        raise OSError(9, 'Bad file descriptor')
+    def recording_close(fd, close=os.close):
+        closed.append(fd)
+        close(fd)
+    monkeypatch.setattr(vcversioner.fcntl, 'flock', failing_flock)
+    monkeypatch.setattr(vcversioner.os, 'close', recording_close)
+    version = vcversioner.find_version(
+        root=tmpdir.strpath, Popen=basic_version, memoize=False)
+    assert version == ('1.0', '0', 'gbeef')
+    assert tmpdir.join('version.txt').read() == '1.0-0-gbeef'
+    assert len(closed) == 1
+
+
+@pytest.mark.skipif(vcversioner.fcntl is None, reason='no fcntl')
+def test_lock_timeout(tmpdir, monkeypatch):
+    "A lock held too long by another process is given up on."
+    monkeypatch.setattr(vcversioner, '_lock_timeout', 0.2)
+    holder = subprocess.Popen(
+        [sys.executable, '-c', 'import fcntl, os, sys, time; '
+         'fcntl.flock(os.open(sys.argv[1], os.O_RDONLY), fcntl.LOCK_EX); '
+         'print(flush=True); time.sleep(60)', tmpdir.strpath],
+        stdout=subprocess.PIPE)
+    try:
+        holder.stdout.readline()
+        start = time.monotonic()
+        version = vcversioner.find_version(
+            root=tmpdir.strpath, Popen=basic_version)
+        assert time.monotonic() - start < 5
+    finally:
+        holder.kill()
+        holder.wait()
+    assert version == ('1.0', '0', 'gbeef')
+    assert tmpdir.join('version.txt').read() == '1.0-0-gbeef'
+
+def write_pack_index(path, entries):
+    "Write a version 2 pack index of ``(binary sha, offset)`` *entries*."
+    import struct
+    entries = sorted(entries)
+    fanout = [0] * 256
+    for name, _ in entries:
+        for n in range(bytearray(name)[0], 256):
+            fanout[n] += 1
+    offsets = []
+    large = []
+    for _, offset in entries:
+        if offset < 0x80000000:
+            offsets.append(offset)
+        else:
+            offsets.append(0x80000000 | len(large))
+            large.append(offset)
+    path.write_binary(
+        b'\377tOc' + struct.pack('>I', 2) + struct.pack('>256I', *fanout)
+        + b''.join(name for name, _ in entries)
+        + b'\0' * (4 * len(entries))
+        + struct.pack('>%dI' % (len(entries),), *offsets)
+        + struct.pack('>%dQ' % (len(large),), *large))
+
+def test_pack_index(tmpdir):
+    "Pack indexes are searched by way of the fanout table."
+    names = [bytes(bytearray([first] + [n] * 19))
+             for first in [0, 0x17, 0x17, 0xff] for n in range(3)]
+    names = sorted(set(names))
+    entries = [(name, 100 * n) for n, name in enumerate(names)]
+    entries[-1] = names[-1], 1 << 33
+    write_pack_index(tmpdir.join('pack-x.idx'), entries)
+    pack = vcversioner._Pack(tmpdir.join('pack-x.idx').strpath)
+    try:
+        assert pack.count == len(names)
+        for name, offset in entries:
+            assert pack.find(name) == offset
+        assert pack.find(b'\x17' + b'\x05' * 19) is None
+        assert pack.find(b'\x80' * 20) is None
+        assert list(pack.names_with_prefix(b'\x17')) == names[3:6]
+    finally:
+        pack.close()
+    assert pack.index.closed
+
+def test_pack_index_truncated(tmpdir, monkeypatch):
+    "Truncated or unsupported pack indexes are closed, not read."
+    mapped = []
+    def recording_mmap(*args, **kwargs):
+        mapped.append(mmap(*args, **kwargs))
+        return mapped[-1]
+    mmap = vcversioner.mmap.mmap
+    monkeypatch.setattr(vcversioner.mmap, 'mmap', recording_mmap)
+    write_pack_index(tmpdir.join('pack-x.idx'), [(b'\x01' * 20, 12)])
+    data = tmpdir.join('pack-x.idx').read_binary()
+    version_3 = data[:4] + b'\0\0\0\3' + data[8:]
+    for contents in [b'', data[:100], data[:-1], version_3]:
+        tmpdir.join('pack-x.idx').write_binary(contents)
+        with pytest.raises(vcversioner._GitReadError):
+            vcversioner._Pack(tmpdir.join('pack-x.idx').strpath)
+    assert len(mapped) == 3
+    assert all(index.closed for index in mapped)
+
+@needs_git
+def test_pack_objects(git_repo):
+    "Every object in a pack can be found and read through its index."
+    git(git_repo, 'gc', '-q')
+    [idx] = git_repo.join('.git', 'objects', 'pack').listdir('*.idx')
+    shas = git(git_repo, 'rev-list', '--all', '--objects').split('\n')
+    shas = [line.split()[0] for line in shas]
+    with vcversioner._GitRepository(git_repo.join('.git').strpath) as repo:
+        [pack] = repo.packs
+        assert pack.count == len(set(shas))
+        for sha in shas:
+            assert pack.find(bytes.fromhex(sha)) is not None
+            type, data = repo.read_object(sha)
+            assert type.decode() == git(git_repo, 'cat-file', '-t', sha)
+            if type == b'commit':
+                assert data.decode().strip() == git(
+                    git_repo, 'cat-file', 'commit', sha)
+    assert pack.index.closed
+
+
+@needs_git
+def test_version_fingerprint(git_repo):
+    "The fingerprint only changes when HEAD, its ref, or the tags do."
+    fingerprint = vcversioner.version_fingerprint(git_repo.strpath)
+    assert vcversioner.version_fingerprint(git_repo.strpath) == fingerprint
+    git_repo.join('version.txt').write('spam')
+    assert vcversioner.version_fingerprint(git_repo.strpath) == fingerprint
+    seen = set([fingerprint])
+    for change in [
+            lambda: git_commit(git_repo),
+            lambda: git(git_repo, 'tag', '2.0'),
+            lambda: git(git_repo, 'tag', 'release/2.1'),
+            lambda: git(git_repo, 'tag', 'release/2.2'),
+            lambda: git(git_repo, 'checkout', '-q', '-b', 'spam'),
+            lambda: git(git_repo, 'checkout', '-q', 'HEAD~1'),
+            lambda: git(git_repo, 'pack-refs', '--all')]:
+        change()
+        fingerprint = vcversioner.version_fingerprint(git_repo.strpath)
+        assert fingerprint not in seen
+        seen.add(fingerprint)
+
+def test_version_fingerprint_version_file(tmpdir, monkeypatch):
+    "Outside version control, the version file and environment are used."
+    fingerprint = vcversioner.version_fingerprint(tmpdir.strpath)
+    tmpdir.join('version.txt').write('1.0-0-gcafe')
+    assert vcversioner.version_fingerprint(tmpdir.strpath) != fingerprint
+    fingerprint = vcversioner.version_fingerprint(tmpdir.strpath)
+    monkeypatch.setenv('VCVERSIONER_PRETEND_VERSION', '2.0')
+    assert vcversioner.version_fingerprint(tmpdir.strpath) != fingerprint
+
+@needs_hg
+def test_version_fingerprint_hg(hg_repo):
+    "Mercurial repositories are fingerprinted by their backend."
+    fingerprint = vcversioner.version_fingerprint(hg_repo.strpath)
+    assert vcversioner.version_fingerprint(hg_repo.strpath) == fingerprint
+    hg(hg_repo, 'tag', '2.0')
+    assert vcversioner.version_fingerprint(hg_repo.strpath) != fingerprint
+    fingerprint = vcversioner.version_fingerprint(hg_repo.strpath)
+    hg(hg_repo, 'update', '-q', '-r', '0')
+    assert vcversioner.version_fingerprint(hg_repo.strpath) != fingerprint
+
+@needs_git
+def test_main_fingerprint(git_repo, capsys):
+    "python -m vcversioner fingerprint prints or stamps the fingerprint."
+    fingerprint = vcversioner.version_fingerprint(git_repo.strpath)
+    vcversioner.main(['fingerprint', '--root', git_repo.strpath])
+    assert capsys.readouterr().out == fingerprint + '\n'
+    stamp = git_repo.join('version.stamp')
+    args = [
+        'fingerprint', '--root', git_repo.strpath, '--stamp', stamp.strpath]
+    vcversioner.main(args)
+    assert stamp.read() == fingerprint + '\n'
+    assert capsys.readouterr().out == ''
+    stamp.setmtime(1000000000)
+    vcversioner.main(args)
+    assert stamp.mtime() == 1000000000
+    git_commit(git_repo)
+    vcversioner.main(args)
+    assert stamp.read() != fingerprint + '\n'
@@ -21,12 +21,127 @@ Code online: https://github.com/habnabit/vcversioner
 
 from __future__ import print_function, unicode_literals
 
+import binascii
 import collections
+import contextlib
+import errno
+import fnmatch
+import functools
+import hashlib
+import heapq
+import importlib
+import inspect
+import json
+import mmap
 import os
+import re
+import stat
+import struct
 import subprocess
+import threading
+import time
+import zlib
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-Version = collections.namedtuple('Version', 'version commits sha')
+
+class Version(collections.namedtuple('Version', 'version commits sha')):
+    """A version found by :func:`find_version`.
+
+    This is a ``(version, commits, sha)`` tuple. *dirty* is whether tracked
+    files in the working tree had been modified, which is only ever true if
+    :func:`find_version` was asked to check.
+
+    """
+
+    # versions made by the namedtuple helpers (like _make) aren't dirty.
+    dirty = False
+
+    def __new__(cls, version, commits, sha, dirty=False):
+        self = super(Version, cls).__new__(cls, version, commits, sha)
+        self.dirty = dirty
+        return self
+
+    def __repr__(self):
+        ret = super(Version, self).__repr__()
+        if self.dirty:
+            ret = ret[:-1] + ', dirty=True)'
+        return ret
+
+    def _replace(self, **kwargs):
+        dirty = kwargs.pop('dirty', self.dirty)
+        ret = super(Version, self)._replace(**kwargs)
+        ret.dirty = dirty
+        return ret
+
+
+class Tag(collections.namedtuple('Tag', 'version name sha')):
+    """A tag found by :func:`find_tags`.
+
+    This is a ``(version, name, sha)`` tuple: the version the tag names (its
+    name without the tag prefix), the tag's full name, and the sha of the
+    commit it tags.
+
+    """
+
+#: How many times :func:`find_version` was able to use (``'hits'``) or had to
+#: refresh (``'misses'``) its *cache_file*.
+cache_stats = {'hits': 0, 'misses': 0}
+_cache_stats_lock = threading.Lock()
+
+# versions already found by this process, keyed by find_version's arguments.
+_memo = {}
+
+# manifest path -> (stat signature, entries), so that each manifest is only
+# parsed once for as long as it's unchanged.
+_manifests = {}
+_manifest_lock = threading.RLock()
+
+# how many seconds to wait for another process's lock on a directory (when
+# find_version isn't given a timeout) before writing without it.
+_lock_timeout = 10.0
+
+# find_version arguments which setup() uses unless setup.py says otherwise;
+# set by build_meta for the duration of each build hook.
+_build_defaults = {}
+
+# (common dir, tag prefix, tag pattern) -> (directories, fingerprint, tags),
+# for find_tags.
+_tag_lists = {}
+
+#: Backends for projects which aren't git repositories, as ``(directory,
+#: module name)`` pairs. If a project root has no ``.git`` but does have one of
+#: these directories, the module is imported (only then) and used in place of
+#: git. A backend module has two functions, each taking the repository
+#: directory and a compiled regex of the tag names to consider (or ``None`` for
+#: all tags): ``describe``, which returns a ``'<tag>-<commits>-<sha>'`` string
+#: read without spawning anything (or ``None`` if it can't), and ``command``,
+#: which returns the command whose output is that string. It also has a
+#: ``fingerprint`` function, taking just the repository directory, which
+#: cheaply returns a JSON-serializable value that changes whenever the
+#: version could have (for :func:`version_fingerprint`).
+backends = [
+    ('.hg', 'vcversioner_hg'),
+]
+
+
+class VersionNotFound(Exception):
+    """No version could be found.
+
+    :func:`find_version` prints the explanation and exits with a status of 2
+    instead of raising this, so that ``setup.py`` stops if there's no version
+    to give the project. :func:`find_versions` and :func:`async_find_version`
+    report this instead. *messages* is the list of lines explaining what went
+    wrong.
+
+    """
+
+    def __init__(self, messages):
+        Exception.__init__(self, messages)
+        self.messages = messages
 
 
 _print = print
@@ -34,27 +149,1882 @@ def print(*a, **kw):
     _print('vcversioner:', *a, **kw)
 
 
-def _fix_path(p):
-    "Translate ``/``s into the right path separator."
-    return p.replace('/', os.sep)
+def _fix_path(p):
+    "Translate ``/``s into the right path separator."
+    return p.replace('/', os.sep)
+
+
+def _abspath(p):
+    "Make *p* absolute, unless it's ``None``."
+    return None if p is None else os.path.abspath(p)
+
+
+class _GitReadError(Exception):
+    "The git repository couldn't be read without spawning git."
+
+# everything which can go wrong while reading a repository.
+_read_errors = (
+    _GitReadError, EnvironmentError, zlib.error, ValueError, struct.error,
+    IndexError)
+
+
+def _read_bytes(path):
+    with open(path, 'rb') as infile:
+        return infile.read()
+
+
+def _apply_delta(base, delta):
+    "Apply a git pack delta to a base object's contents."
+    delta = bytearray(delta)
+    pos = 0
+    for _ in range(2):
+        # skip the source and target sizes; the target is built up below.
+        while delta[pos] & 0x80:
+            pos += 1
+        pos += 1
+    out = bytearray()
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            offset = size = 0
+            for n in range(4):
+                if op & (1 << n):
+                    offset |= delta[pos] << (8 * n)
+                    pos += 1
+            for n in range(3):
+                if op & (0x10 << n):
+                    size |= delta[pos] << (8 * n)
+                    pos += 1
+            out += base[offset:offset + (size or 0x10000)]
+        elif op:
+            out += delta[pos:pos + op]
+            pos += op
+        else:
+            raise _GitReadError('invalid delta opcode')
+    return bytes(out)
+
+
+class _Pack(object):
+    """A single pack file and its ``.idx`` index.
+
+    The index is memory-mapped rather than read, and objects are found by
+    binary search within the range of names the fanout table gives for their
+    first byte, so only the pages of the index which are actually searched
+    are ever read, however big it is. Likewise, objects are read from the
+    pack by seeking straight to them. Memory use doesn't grow with the size
+    of the pack.
+
+    """
+
+    _types = {1: b'commit', 2: b'tree', 3: b'blob', 4: b'tag'}
+
+    def __init__(self, idx_path):
+        self.pack_path = idx_path[:-len('.idx')] + '.pack'
+        with open(idx_path, 'rb') as infile:
+            if not os.fstat(infile.fileno()).st_size:
+                raise _GitReadError('empty pack index %r' % (idx_path,))
+            self.index = mmap.mmap(
+                infile.fileno(), 0, access=mmap.ACCESS_READ)
+        self._pack = None
+        if len(self.index) < 8 + 1024:
+            self.index.close()
+            raise _GitReadError('truncated pack index %r' % (idx_path,))
+        if self.index[:4] == b'\377tOc':
+            if struct.unpack('>I', self.index[4:8])[0] != 2:
+                self.index.close()
+                raise _GitReadError('unsupported pack index version')
+            self.version = 2
+            self.fanout = struct.unpack('>256I', self.index[8:8 + 1024])
+            self.names_at = 8 + 1024
+        else:
+            self.version = 1
+            self.fanout = struct.unpack('>256I', self.index[:1024])
+            self.names_at = 1024
+        self.count = self.fanout[-1]
+        expected = self.names_at + (
+            28 * self.count if self.version == 2 else 24 * self.count)
+        if len(self.index) < expected:
+            self.index.close()
+            raise _GitReadError('truncated pack index %r' % (idx_path,))
+
+    def close(self):
+        self.index.close()
+        if self._pack is not None:
+            self._pack.close()
+            self._pack = None
+
+    def _name(self, n):
+        if self.version == 2:
+            start = self.names_at + 20 * n
+        else:
+            start = self.names_at + 24 * n + 4
+        return self.index[start:start + 20]
+
+    def _offset(self, n):
+        if self.version == 1:
+            start = self.names_at + 24 * n
+            return struct.unpack('>I', self.index[start:start + 4])[0]
+        start = self.names_at + 24 * self.count + 4 * n
+        offset, = struct.unpack('>I', self.index[start:start + 4])
+        if offset & 0x80000000:
+            start = (self.names_at + 28 * self.count
+                     + 8 * (offset & 0x7fffffff))
+            offset, = struct.unpack('>Q', self.index[start:start + 8])
+        return offset
+
+    def _search(self, prefix):
+        "Find the first index entry which sorts at or after *prefix*."
+        first = bytearray(prefix[:1])[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name(mid) < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, binsha):
+        "Return the pack offset of an object, or ``None`` if it's absent."
+        n = self._search(binsha)
+        if n < self.count and self._name(n) == binsha:
+            return self._offset(n)
+        return None
+
+    def names_with_prefix(self, prefix):
+        "Yield the names of objects whose binary names start with *prefix*."
+        n = self._search(prefix)
+        while n < self.count:
+            name = self._name(n)
+            if not name.startswith(prefix):
+                break
+            yield name
+            n += 1
+
+    def read(self, offset, repo):
+        "Read the object at *offset*, resolving any delta chain."
+        deltas = []
+        while True:
+            type, data, base = self._read_entry(offset)
+            if type == 6:
+                deltas.append(data)
+                offset = base
+            elif type == 7:
+                deltas.append(data)
+                base_type, base_data = repo.read_object(base)
+                break
+            elif type in self._types:
+                base_type, base_data = self._types[type], data
+                break
+            else:
+                raise _GitReadError('unknown pack object type %d' % (type,))
+        for delta in reversed(deltas):
+            base_data = _apply_delta(base_data, delta)
+        return base_type, base_data
+
+    def _read_entry(self, offset):
+        if self._pack is None:
+            self._pack = open(self.pack_path, 'rb')
+        self._pack.seek(offset)
+        header = bytearray(self._pack.read(32))
+        c = header[0]
+        type = (c >> 4) & 7
+        size = c & 15
+        shift = 4
+        pos = 1
+        while c & 0x80:
+            c = header[pos]
+            pos += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+        base = None
+        if type == 6:
+            c = header[pos]
+            pos += 1
+            distance = c & 0x7f
+            while c & 0x80:
+                c = header[pos]
+                pos += 1
+                distance = ((distance + 1) << 7) | (c & 0x7f)
+            base = offset - distance
+        elif type == 7:
+            base = bytes(header[pos:pos + 20])
+            pos += 20
+        self._pack.seek(offset + pos)
+        decompressor = zlib.decompressobj()
+        chunks = []
+        length = 0
+        while length < size or not size:
+            chunk = self._pack.read(4096)
+            if not chunk:
+                break
+            chunk = decompressor.decompress(chunk)
+            chunks.append(chunk)
+            length += len(chunk)
+            if not size:
+                break
+        data = b''.join(chunks) + decompressor.flush()
+        if len(data) != size:
+            raise _GitReadError('truncated pack object')
+        return type, data, base
+
+
+def _resolve_git_dir(path):
+    """Follow a ``.git`` file to the git directory it points to.
+
+    Worktrees made by ``git worktree`` and submodules have a ``.git`` file
+    containing ``gitdir: <path>`` instead of a ``.git`` directory. Any other
+    *path* is returned as is.
+
+    """
+
+    if not os.path.isfile(path):
+        return path
+    try:
+        content = _read_bytes(path).decode().strip()
+    except EnvironmentError:
+        return path
+    if not content.startswith('gitdir:'):
+        return path
+    return os.path.normpath(
+        os.path.join(os.path.dirname(path), content[7:].strip()))
+
+
+def _common_dir(git_dir):
+    """Return the git directory shared by all of a repository's worktrees.
+
+    A worktree's own git directory only holds ``HEAD``, the index, and a few
+    other per-worktree refs; everything else is in the directory named by its
+    ``commondir`` file.
+
+    """
+
+    try:
+        common_dir = _read_bytes(os.path.join(git_dir, 'commondir'))
+    except EnvironmentError:
+        return git_dir
+    return os.path.normpath(
+        os.path.join(git_dir, common_dir.decode().strip()))
+
+
+def _ref_path(git_dir, common_dir, name):
+    "Return the path of the loose ref *name*."
+    if '/' not in name or name.startswith(
+            ('refs/bisect/', 'refs/worktree/', 'refs/rewritten/')):
+        return os.path.join(git_dir, *name.split('/'))
+    return os.path.join(common_dir, *name.split('/'))
+
+
+class _GitRepository(object):
+    """Read refs and objects straight out of a git directory.
+
+    Only as much of git is implemented as ``git describe --tags --long`` needs:
+    refs (loose and packed), and loose or packed commit and tag objects.
+    *git_dir* can be a worktree's git directory, in which case everything but
+    ``HEAD`` is read from the common directory.
+
+    """
+
+    def __init__(self, git_dir):
+        if not os.path.isfile(os.path.join(git_dir, 'HEAD')):
+            raise _GitReadError('%r is not a git directory' % (git_dir,))
+        self.git_dir = git_dir
+        self.common_dir = _common_dir(git_dir)
+        self._object_dirs = self._find_object_dirs(
+            os.path.join(self.common_dir, 'objects'))
+        self._packs = None
+        self._packed_refs = None
+        self._commits = {}
+        self._shallow = set()
+        shallow_path = os.path.join(self.common_dir, 'shallow')
+        if os.path.exists(shallow_path):
+            self._shallow.update(_read_bytes(shallow_path).decode().split())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for pack in self._packs or ():
+            pack.close()
+
+    def _find_object_dirs(self, objects_dir, depth=0):
+        dirs = [objects_dir]
+        alternates = os.path.join(objects_dir, 'info', 'alternates')
+        if depth < 5 and os.path.exists(alternates):
+            for line in _read_bytes(alternates).decode().splitlines():
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    dirs.extend(self._find_object_dirs(
+                        os.path.join(objects_dir, line), depth + 1))
+        return dirs
+
+    @property
+    def packs(self):
+        if self._packs is None:
+            self._packs = []
+            for objects_dir in self._object_dirs:
+                pack_dir = os.path.join(objects_dir, 'pack')
+                if not os.path.isdir(pack_dir):
+                    continue
+                for name in sorted(os.listdir(pack_dir)):
+                    if name.endswith('.idx'):
+                        self._packs.append(
+                            _Pack(os.path.join(pack_dir, name)))
+        return self._packs
+
+    def read_object(self, sha):
+        "Return the ``(type, data)`` of an object given its hex or binary sha."
+        if len(sha) == 20:
+            binsha, sha = sha, binascii.hexlify(sha).decode()
+        else:
+            binsha = binascii.unhexlify(sha)
+        for objects_dir in self._object_dirs:
+            path = os.path.join(objects_dir, sha[:2], sha[2:])
+            if os.path.exists(path):
+                raw = zlib.decompress(_read_bytes(path))
+                header, _, data = raw.partition(b'\0')
+                return header.split(b' ', 1)[0], data
+        for pack in self.packs:
+            offset = pack.find(binsha)
+            if offset is not None:
+                return pack.read(offset, self)
+        raise _GitReadError('object %s not found' % (sha,))
+
+    def commit(self, sha):
+        "Return the ``(parents, commit time)`` of a commit."
+        ret = self._commits.get(sha)
+        if ret is not None:
+            return ret
+        type, data = self.read_object(sha)
+        if type != b'commit':
+            raise _GitReadError('%s is a %s, not a commit' % (sha, type))
+        parents = []
+        time = 0
+        for line in data.split(b'\n\n', 1)[0].split(b'\n'):
+            if line.startswith(b'parent '):
+                parents.append(line[7:].decode())
+            elif line.startswith(b'committer '):
+                time = int(line.rsplit(b' ', 2)[1])
+        if sha in self._shallow:
+            parents = []
+        ret = self._commits[sha] = parents, time
+        return ret
+
+    @property
+    def packed_refs(self):
+        """A mapping of ref name to ``(sha, peeled sha or None)``.
+
+        If ``packed-refs`` says its tags are peeled, a tag without a peeled
+        sha is lightweight, so its peeled sha is its own sha; otherwise,
+        ``None`` means it's unknown.
+
+        """
+
+        if self._packed_refs is None:
+            self._packed_refs = {}
+            path = os.path.join(self.common_dir, 'packed-refs')
+            if os.path.exists(path):
+                last = None
+                peeled = False
+                for line in _read_bytes(path).decode().splitlines():
+                    if line.startswith('# pack-refs with:'):
+                        traits = line.split(':', 1)[1].split()
+                        peeled = 'peeled' in traits or 'fully-peeled' in traits
+                    if not line or line.startswith('#'):
+                        continue
+                    if line.startswith('^'):
+                        if last is not None:
+                            self._packed_refs[last] = (
+                                self._packed_refs[last][0], line[1:])
+                        continue
+                    sha, _, last = line.partition(' ')
+                    known = peeled and last.startswith('refs/tags/')
+                    self._packed_refs[last] = sha, sha if known else None
+        return self._packed_refs
+
+    def _loose_ref(self, name):
+        path = _ref_path(self.git_dir, self.common_dir, name)
+        if os.path.isfile(path):
+            return _read_bytes(path).decode().strip()
+        return None
+
+    def resolve_ref(self, name):
+        "Resolve a (possibly symbolic) ref to a sha, or ``None``."
+        for _ in range(5):
+            value = self._loose_ref(name)
+            if value is None:
+                packed = self.packed_refs.get(name)
+                return packed and packed[0]
+            if not value.startswith('ref:'):
+                return value
+            name = value[4:].strip()
+        raise _GitReadError('symbolic ref loop at %r' % (name,))
+
+    def head(self):
+        return self.resolve_ref('HEAD')
+
+    def tag_refs(self):
+        "Return a mapping of tag name to ``(sha, peeled sha or None)``."
+        tags = dict(
+            (name[len('refs/tags/'):], value)
+            for name, value in self.packed_refs.items()
+            if name.startswith('refs/tags/'))
+        tags_dir = os.path.join(self.common_dir, 'refs', 'tags')
+        for dirpath, dirnames, filenames in os.walk(tags_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, tags_dir).replace(os.sep, '/')
+                sha = self.resolve_ref('refs/tags/' + name)
+                if sha:
+                    tags[name] = sha, None
+        return tags
+
+    def _peel(self, sha):
+        """Peel a tag ref down to its commit.
+
+        Returns ``(commit sha, tagger time)``; the tagger time is ``None`` for
+        lightweight tags, and the commit sha is ``None`` if the tag doesn't
+        point at a commit.
+
+        """
+
+        time = None
+        type, data = self.read_object(sha)
+        while type == b'tag':
+            headers = data.split(b'\n\n', 1)[0].split(b'\n')
+            for line in headers:
+                if line.startswith(b'object '):
+                    sha = line[7:].decode()
+                elif line.startswith(b'tagger ') and time is None:
+                    time = int(line.rsplit(b' ', 2)[1])
+            if time is None:
+                time = 0
+            type, data = self.read_object(sha)
+        if type != b'commit':
+            return None, time
+        return sha, time
+
+    def _tag_time(self, sha):
+        "Return the tagger time of an annotated tag."
+        headers = self.read_object(sha)[1].split(b'\n\n', 1)[0]
+        for line in headers.split(b'\n'):
+            if line.startswith(b'tagger '):
+                return int(line.rsplit(b' ', 2)[1])
+        return 0
+
+    def tagged_commits(self, match=None):
+        """Return a mapping of commit sha to the name of its best tag.
+
+        If several tags point at the same commit, annotated tags are preferred
+        over lightweight tags, and newer annotated tags over older ones, as
+        ``git describe`` does. If *match* is specified, it's a compiled regex,
+        and only tags whose names it matches are considered.
+
+        Tags are only read when their refs don't already say what they peel
+        to, and tagger times are only read to break ties, so tags which are
+        filtered out or packed cost nothing.
+
+        """
+
+        names = {}
+        for name, (sha, peeled) in sorted(self.tag_refs().items()):
+            if match is not None and not match.match(name):
+                continue
+            if peeled is None:
+                commit, time = self._peel(sha)
+                if commit is None:
+                    continue
+                prio = 1 if time is None else 2
+            else:
+                commit, time = peeled, None
+                prio = 1 if peeled == sha else 2
+            existing = names.get(commit)
+            if existing is None or existing[0] < prio:
+                names[commit] = [prio, time, name, sha]
+            elif prio == 2 and existing[0] == 2:
+                if existing[1] is None:
+                    existing[1] = self._tag_time(existing[3])
+                if time is None:
+                    time = self._tag_time(sha)
+                if existing[1] < time:
+                    names[commit] = [prio, time, name, sha]
+        return dict(
+            (commit, name) for commit, (_, _, name, _) in names.items())
+
+    def peeled_tags(self, match=None):
+        """Return a mapping of tag name to the sha of the commit it tags.
+
+        Tags of anything but commits are left out. If *match* is specified,
+        it's a compiled regex, and only tags whose names it matches are
+        included (or read at all).
+
+        """
+
+        tags = {}
+        for name, (sha, peeled) in self.tag_refs().items():
+            if match is not None and not match.match(name):
+                continue
+            if peeled is None:
+                peeled = self._peel(sha)[0]
+                if peeled is None:
+                    continue
+            tags[name] = peeled
+        return tags
+
+    def approximate_object_count(self):
+        # like git's own approximation, loose objects aren't counted; only
+        # packed ones affect how long abbreviations are.
+        return sum(pack.count for pack in self.packs)
+
+    def _is_ambiguous(self, prefix, sha):
+        for objects_dir in self._object_dirs:
+            loose_dir = os.path.join(objects_dir, prefix[:2])
+            if not os.path.isdir(loose_dir):
+                continue
+            for name in os.listdir(loose_dir):
+                if name.startswith(prefix[2:]) and prefix[:2] + name != sha:
+                    return True
+        if len(prefix) % 2:
+            binprefix = binascii.unhexlify(prefix[:-1])
+        else:
+            binprefix = binascii.unhexlify(prefix)
+        for pack in self.packs:
+            for name in pack.names_with_prefix(binprefix):
+                name = binascii.hexlify(name).decode()
+                if name.startswith(prefix) and name != sha:
+                    return True
+        return False
+
+    def abbreviate(self, sha):
+        "Abbreviate a sha the way git does by default."
+        count = self.approximate_object_count()
+        length = max(7, (count.bit_length() + 1) // 2)
+        while length < len(sha) and self._is_ambiguous(sha[:length], sha):
+            length += 1
+        return sha[:length]
+
+    def describe(self, match=None, max_candidates=10):
+        """Compute the output of ``git describe --tags --long``.
+
+        Returns ``None`` if there are no tags reachable from ``HEAD``. *match*
+        restricts the tags considered, as for :meth:`tagged_commits`, and
+        *max_candidates* is the equivalent of ``--candidates``.
+
+        """
+
+        head = self.head()
+        if head is None:
+            raise _GitReadError("HEAD doesn't point at a commit")
+        described = self.describe_commit(
+            head, self.tagged_commits(match), max_candidates)
+        if described is None:
+            return None
+        return '%s-%d-g%s' % (described + (self.abbreviate(head),))
+
+    def describe_indexed(self, match=None, max_candidates=10,
+                         read_only=False):
+        """Like :meth:`describe`, but using and updating a persistent index.
+
+        The index, ``vcversioner-index`` in the git directory, remembers the
+        tags (for as long as :func:`_ref_fingerprint` says they haven't
+        changed) and the nearest tag and distance for recently described
+        commits. A commit which only adds a straight line of untagged commits
+        on top of an indexed commit is described by walking just those new
+        commits; anything else gets a full walk. If *read_only* is true, the
+        index is used but not updated.
+
+        """
+
+        head = self.head()
+        if head is None:
+            raise _GitReadError("HEAD doesn't point at a commit")
+        index_path = os.path.join(self.git_dir, 'vcversioner-index')
+        fingerprint = _ref_fingerprint(self.git_dir)[2:]
+        fingerprint.append([match and match.pattern, max_candidates])
+        try:
+            index = json.loads(_read_bytes(index_path).decode())
+        except (EnvironmentError, ValueError):
+            index = None
+        if not isinstance(index, dict) or index.get('tags') != fingerprint:
+            index = {
+                'tags': fingerprint,
+                'names': self.tagged_commits(match),
+                'described': {},
+            }
+        names = index['names']
+        described = index['described']
+
+        sha = head
+        new_commits = 0
+        while (max_candidates and sha not in described
+               and sha not in names):
+            parents = self.commit(sha)[0]
+            if len(parents) != 1:
+                break
+            sha = parents[0]
+            new_commits += 1
+        if sha in described:
+            name, depth = described[sha]
+            result = name, depth + new_commits
+        elif sha in names:
+            result = names[sha], new_commits
+        else:
+            result = self.describe_commit(head, names, max_candidates)
+        if result is None:
+            return None
+
+        described.pop(head, None)
+        described[head] = list(result)
+        for old in list(described)[:-self.index_size]:
+            del described[old]
+        if not read_only:
+            _write_if_changed(index_path, json.dumps(index))
+        return '%s-%d-g%s' % (result + (self.abbreviate(head),))
+
+    # how many described commits the persistent index remembers.
+    index_size = 256
+
+    def describe_commit(self, head, names, max_candidates=10):
+        """Find the nearest tag to a commit, and how far away it is.
+
+        *names* maps tagged commits to their tag names, as returned by
+        :meth:`tagged_commits`. Returns ``(tag name, distance)``, or ``None``
+        if no tag is reachable.
+
+        """
+
+        if head in names:
+            return names[head], 0
+
+        # this walk mirrors git's own describe.c: commits are visited newest
+        # first, and each candidate tag's depth counts the visited commits
+        # which aren't reachable from that tag.
+        flags = {}
+        queue = []
+        counter = [0]
+
+        def push(sha, seen):
+            if sha in flags:
+                flags[sha] |= seen
+                return
+            flags[sha] = seen
+            counter[0] += 1
+            heapq.heappush(queue, (-self.commit(sha)[1], counter[0], sha))
+
+        def all_flagged(bits):
+            return all(flags[sha] & bits == bits for _, _, sha in queue)
+
+        push(head, 0)
+        candidates = []
+        all_bits = 0
+        seen_commits = 0
+        gave_up_on = None
+        while queue:
+            _, _, sha = heapq.heappop(queue)
+            seen_commits += 1
+            seen = flags[sha]
+            if sha in names:
+                if len(candidates) == max_candidates:
+                    gave_up_on = sha
+                    break
+                bit = 1 << len(candidates)
+                candidates.append(
+                    [seen_commits - 1, len(candidates), names[sha], bit])
+                all_bits |= bit
+                seen = flags[sha] = seen | bit
+            for candidate in candidates:
+                if not seen & candidate[3]:
+                    candidate[0] += 1
+            for parent in self.commit(sha)[0]:
+                push(parent, seen)
+            # once everything left to walk is reachable from every candidate,
+            # no depth can change any further.
+            if candidates and all_flagged(all_bits):
+                queue = []
+        if not candidates:
+            return None
+        candidates.sort()
+        best = candidates[0]
+        if gave_up_on is not None:
+            counter[0] += 1
+            heapq.heappush(queue, (
+                -self.commit(gave_up_on)[1], counter[0], gave_up_on))
+        while queue:
+            _, _, sha = heapq.heappop(queue)
+            seen = flags[sha]
+            if seen & best[3]:
+                if all_flagged(best[3]):
+                    break
+            else:
+                best[0] += 1
+            for parent in self.commit(sha)[0]:
+                push(parent, seen)
+        depth, _, name, _ = best
+        return name, depth
+
+
+def _describe_in_process(git_dir, tag_index=False, match=None,
+                         max_candidates=None, read_only=False):
+    """Run the equivalent of ``git describe --tags --long`` without git.
+
+    Returns ``None`` if the repository couldn't be read or has no tags, in
+    which case the caller should fall back to spawning git. If *tag_index* is
+    true, a persistent index is used to avoid walking history that's already
+    been walked, which is only updated if *read_only* is false. *match* and
+    *max_candidates* are as for :meth:`_GitRepository.describe`.
+
+    """
+
+    if max_candidates is None:
+        max_candidates = 10
+    try:
+        with _GitRepository(git_dir) as repo:
+            if tag_index:
+                return repo.describe_indexed(
+                    match, max_candidates, read_only)
+            return repo.describe(match, max_candidates)
+    except _read_errors:
+        return None
+
+
+def _ref_fingerprint(git_dir):
+    """Cheaply summarize the state of a repository's ``HEAD`` and tags.
+
+    This is ``HEAD`` itself and the sha of the ref it points to (if that ref
+    is loose), followed by :func:`_tags_fingerprint` of every directory of
+    tags. Returns ``None`` if *git_dir* isn't a git repository.
+
+    """
+
+    try:
+        head = _read_bytes(os.path.join(git_dir, 'HEAD')).decode().strip()
+    except EnvironmentError:
+        return None
+    common_dir = _common_dir(git_dir)
+    ref = head
+    for _ in range(5):
+        if not ref.startswith('ref:'):
+            break
+        path = _ref_path(git_dir, common_dir, ref[4:].strip())
+        try:
+            ref = _read_bytes(path).decode().strip()
+        except EnvironmentError:
+            # the ref is packed, so packed-refs' stat covers it.
+            ref = None
+            break
+    return [head, ref] + _tags_fingerprint(
+        common_dir, _tag_directories(common_dir))
+
+
+def _stat_key(path):
+    "Return stat data which changes whenever *path* does, or ``None``."
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size, st.st_ino]
+
+
+def _tag_directories(common_dir):
+    "List ``refs/tags`` and the directories under it, relative to it."
+    tags_dir = os.path.join(common_dir, 'refs', 'tags')
+    # most filesystems count a directory's subdirectories in its link count,
+    # so if it's 2, there's nothing to walk (and refs/tags might have many
+    # thousands of files). refs/tags itself is always included, in case it
+    # doesn't exist yet.
+    try:
+        if os.stat(tags_dir).st_nlink == 2:
+            return [os.curdir]
+    except OSError:
+        return [os.curdir]
+    return [
+        os.path.relpath(dirpath, tags_dir)
+        for dirpath, _, _ in os.walk(tags_dir)] or [os.curdir]
+
+
+def _tags_fingerprint(common_dir, directories):
+    """Summarize the state of a repository's tags.
+
+    This is the stat data of ``packed-refs`` and of each of *directories*
+    (from :func:`_tag_directories`). Any tag being added, removed, or moved
+    renames a file in one of those, or rewrites ``packed-refs``; a new
+    directory of tags changes its parent directory, so it's noticed too.
+
+    """
+
+    paths = [os.path.join(common_dir, 'packed-refs')] + [
+        os.path.join(common_dir, 'refs', 'tags', directory)
+        for directory in directories]
+    return [_stat_key(path) for path in paths]
+
+
+_index_entry = struct.Struct('>10L20sH')
+
+
+def _index_entries(data, extensions=None):
+    """Parse a git index, yielding an ``(entry, flags, path)`` for each file.
+
+    *entry* is the tuple of cached stat data, mode, and sha from
+    :data:`_index_entry`; *flags* has the extended flags in its high bits.
+    Versions 2 through 4 of the format are understood. If *extensions* is
+    given, it's filled in with the contents of each of the index's
+    extensions, by signature, once every entry has been yielded.
+
+    """
+
+    signature, version, count = struct.unpack_from('>4sLL', data)
+    if signature != b'DIRC' or version not in (2, 3, 4):
+        raise _GitReadError('unsupported index')
+    offset = 12
+    path = b''
+    for _ in range(count):
+        start = offset
+        entry = _index_entry.unpack_from(data, offset)
+        flags = entry[-1]
+        offset += _index_entry.size
+        if flags & 0x4000:
+            flags |= struct.unpack_from('>H', data, offset)[0] << 16
+            offset += 2
+        if version == 4:
+            # the path is stored as how much of the previous path to drop,
+            # followed by what to add to what's left.
+            c = data[offset]
+            offset += 1
+            strip = c & 0x7f
+            while c & 0x80:
+                c = data[offset]
+                offset += 1
+                strip = ((strip + 1) << 7) | (c & 0x7f)
+            end = data.index(b'\0', offset)
+            path = path[:len(path) - strip] + data[offset:end]
+            offset = end + 1
+        else:
+            end = data.index(b'\0', offset)
+            path = data[offset:end]
+            offset = start + ((end - start + 8) & ~7)
+        yield entry, flags, path
+    if extensions is None:
+        return
+    # the index ends with a checksum of everything before it.
+    while offset + 8 <= len(data) - 20:
+        signature, size = struct.unpack_from('>4sL', data, offset)
+        offset += 8
+        extensions[signature] = data[offset:offset + size]
+        offset += size
+
+
+def _cache_tree(data):
+    """Parse an index's ``TREE`` extension.
+
+    Returns a dict mapping each directory's path (``b''`` for the top) to the
+    binary sha of the tree the index has for it, or ``None`` if that part of
+    the cached tree was invalidated by a change to the index.
+
+    """
+
+    trees = {}
+    offset = 0
+
+    def parse(parent):
+        nonlocal offset
+        end = data.index(b'\0', offset)
+        name = data[offset:end]
+        path = parent + b'/' + name if parent else name
+        end_line = data.index(b'\n', end)
+        entry_count, subtree_count = map(int, data[end + 1:end_line].split())
+        offset = end_line + 1
+        trees[path] = None
+        if entry_count >= 0:
+            trees[path] = data[offset:offset + 20]
+            offset += 20
+        for _ in range(subtree_count):
+            parse(path)
+
+    if data:
+        parse(None)
+    return trees
+
+
+def _head_tree(repo, path):
+    """Return the binary sha of the tree at *path* in *repo*'s ``HEAD``.
+
+    *path* is a ``/``-separated bytestring, or ``b''`` for the top. Returns
+    ``None`` if there's no such directory.
+
+    """
+
+    type, data = repo.read_object(repo.head())
+    sha = binascii.unhexlify(data[5:45])
+    for name in path.split(b'/') if path else []:
+        type, data = repo.read_object(sha)
+        if type != b'tree':
+            return None
+        offset, sha = 0, None
+        while offset < len(data):
+            end = data.index(b'\0', offset)
+            mode, entry_name = data[offset:end].split(b' ', 1)
+            if entry_name == name and mode in (b'40000', b'040000'):
+                sha = data[end + 1:end + 21]
+                break
+            offset = end + 21
+        if sha is None:
+            return None
+    return sha
+
+
+def _find_backend(root):
+    """Find the backend for a project root which isn't a git repository.
+
+    Returns ``(repository directory, backend module)``, or ``(None, None)`` if
+    *root* has none of the directories in :data:`backends` (or the module for
+    it couldn't be imported).
+
+    """
+
+    for name, module_name in backends:
+        path = os.path.join(root, name)
+        if not os.path.isdir(path):
+            continue
+        try:
+            return path, importlib.import_module(module_name)
+        except ImportError:
+            pass
+    return None, None
+
+
+def _find_worktree(root):
+    """Find the working tree containing *root*.
+
+    Returns ``(working tree, git directory)``, or ``(None, None)`` if *root*
+    isn't in a git working tree.
+
+    """
+
+    path = os.path.abspath(root)
+    while True:
+        git_dir = os.path.join(path, '.git')
+        if os.path.exists(git_dir):
+            return path, _resolve_git_dir(git_dir)
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None, None
+        path = parent
+
+
+def _enclosing_git_dir(root, version_file=None):
+    """Find the git directory of the repository containing *root*.
+
+    Returns ``None`` if *root* has its own ``.git`` or another version control
+    directory from :data:`backends`, if *version_file* exists, or if *root*
+    isn't in a git working tree at all; such roots are looked up as usual.
+
+    """
+
+    names = ['.git'] + [name for name, _ in backends]
+    if any(os.path.exists(os.path.join(root, name)) for name in names):
+        return None
+    if version_file is not None and os.path.exists(version_file):
+        return None
+    return _find_worktree(root)[1]
+
+
+def _is_dirty(root, root_only=False):
+    """Check whether any tracked file differs from what's in the index.
+
+    Rather than rescanning the working tree as ``git status`` does, each
+    file's stat data is compared to what the index cached, stopping at the
+    first modified file. Only files whose stat data changed (or was cached too
+    recently to be trusted) are read and hashed, so touching a file doesn't
+    make the tree dirty. If *root_only* is true, only files inside *root* are
+    checked.
+
+    Changes which are staged but not committed are noticed by comparing the
+    tree git caches in the index (which ``git commit`` and ``git checkout``
+    keep up to date) to ``HEAD``'s tree. If the index has no valid cached tree
+    (say, after ``git add``), the tree is taken to be dirty.
+
+    """
+
+    worktree, git_dir = _find_worktree(root)
+    if worktree is None:
+        return False
+    index_path = os.path.join(git_dir, 'index')
+    try:
+        index_mtime = os.stat(index_path).st_mtime_ns
+        data = _read_bytes(index_path)
+    except EnvironmentError:
+        return False
+    prefix = b''
+    if root_only:
+        prefix = os.path.relpath(os.path.abspath(root), worktree)
+        prefix = b'' if prefix == '.' else os.fsencode(
+            prefix.replace(os.sep, '/') + '/')
+    extensions = {}
+    for entry, flags, path in _index_entries(data, extensions):
+        if not path.startswith(prefix):
+            continue
+        (_, _, mtime, mtime_ns, _, _, mode, _, _, size, sha, _) = entry
+        if flags & 0x3000:
+            # an unmerged entry.
+            return True
+        if flags & 0x8000 or flags & (0x4000 << 16) or mode >> 12 == 0o16:
+            # assumed unchanged, skipped by a sparse checkout, or a submodule.
+            continue
+        if flags & (0x2000 << 16):
+            # added with ``git add --intent-to-add``.
+            return True
+        full_path = os.path.join(worktree, os.fsdecode(path))
+        try:
+            st = os.lstat(full_path)
+        except OSError:
+            return True
+        if stat.S_ISLNK(st.st_mode) != (mode >> 12 == 0o12):
+            return True
+        if stat.S_ISREG(st.st_mode) and (st.st_mode ^ mode) & 0o100:
+            return True
+        if st.st_size & 0xffffffff != size:
+            return True
+        cached_mtime = mtime * 10 ** 9 + mtime_ns
+        if mtime_ns:
+            unchanged = st.st_mtime_ns == cached_mtime
+        else:
+            unchanged = st.st_mtime_ns // 10 ** 9 == mtime
+        if unchanged and cached_mtime < index_mtime:
+            continue
+        # the stat data doesn't match, or the file was modified too close to
+        # when the index was written to tell; compare the contents instead.
+        if stat.S_ISLNK(st.st_mode):
+            content = os.fsencode(os.readlink(full_path))
+        else:
+            try:
+                content = _read_bytes(full_path)
+            except EnvironmentError:
+                return True
+        blob = hashlib.sha1(b'blob %d\0' % (len(content),))
+        blob.update(content)
+        if blob.digest() != sha:
+            return True
+
+    # the working tree matches the index; now check the index matches HEAD.
+    trees = _cache_tree(extensions.get(b'TREE', b''))
+    root_path = path = prefix.rstrip(b'/')
+    while path not in trees and path:
+        path = path.rpartition(b'/')[0]
+    if trees.get(path) is None:
+        return True
+    # a valid cached tree covers everything beneath it, so if the root isn't
+    # in it, the index has nothing there.
+    index_tree = trees[path] if path == root_path else None
+    with _GitRepository(git_dir) as repo:
+        return index_tree != _head_tree(repo, root_path)
+
+
+def _pretend_version(root):
+    """Return the ``(version, sha)`` the environment gives *root*, or ``None``.
+
+    ``VCVERSIONER_PRETEND_VERSION_FOR_<NAME>``, where *NAME* is the name of
+    *root*'s directory uppercased with anything but letters and digits
+    replaced by ``_``, takes precedence over ``VCVERSIONER_PRETEND_VERSION``.
+    The sha comes from ``VCVERSIONER_PRETEND_SHA_FOR_<NAME>`` or
+    ``VCVERSIONER_PRETEND_SHA`` the same way, and is empty if neither is set.
+
+    """
+
+    name = os.path.basename(os.path.normpath(root))
+    suffix = '_FOR_' + re.sub('[^A-Z0-9]+', '_', name.upper())
+    for variable in ['VCVERSIONER_PRETEND_VERSION' + suffix,
+                     'VCVERSIONER_PRETEND_VERSION']:
+        version = os.environ.get(variable, '').strip()
+        if version:
+            break
+    else:
+        return None
+    sha = (os.environ.get('VCVERSIONER_PRETEND_SHA' + suffix)
+           or os.environ.get('VCVERSIONER_PRETEND_SHA', ''))
+    return version, sha.strip()
+
+
+def _tag_filter(tag_prefix, tag_pattern):
+    """Work out which tags are candidates for describing a commit.
+
+    Returns ``(glob, regex)``: the ``--match`` glob to pass to ``git
+    describe`` and the equivalent compiled regex, for reading the repository
+    in-process. Both are ``None`` if every tag is a candidate.
+
+    """
+
+    if not tag_prefix and not tag_pattern:
+        return None, None
+    tag_pattern = tag_pattern or '*'
+    glob = re.sub(r'([\\*?[])', r'\\\1', tag_prefix) + tag_pattern
+    regex = re.compile(re.escape(tag_prefix) + fnmatch.translate(tag_pattern))
+    return glob, regex
+
+
+def _read_cache(cache_file, key, open=open):
+    """Return the cached raw version for *key*, or ``None``.
+
+    If *key* is ``None``, whatever version was cached last is returned.
+
+    """
+
+    try:
+        with open(cache_file, 'rb') as infile:
+            cached = json.loads(infile.read().decode())
+    except (EnvironmentError, ValueError):
+        return None
+    if not isinstance(cached, dict):
+        return None
+    if key is not None and cached.get('key') != key:
+        return None
+    return cached.get('raw_version')
+
+
+def _write_cache(cache_file, key, raw_version, open=open):
+    _write_if_changed(
+        cache_file, json.dumps({'key': key, 'raw_version': raw_version}),
+        open=open)
+
+
+_manifest_header = '# vcversioner manifest: package, git output, version\n'
+
+
+def _manifest_package(root, manifest_file):
+    "Return the name of *root*'s entry in *manifest_file*."
+    relative = os.path.relpath(root, os.path.dirname(manifest_file))
+    return relative.replace(os.sep, '/')
+
+
+def _parse_manifest(content):
+    entries = {}
+    for line in content.decode('utf-8').splitlines():
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split('\t')
+        if len(fields) != 3:
+            # a damaged line only loses its own entry.
+            continue
+        package, raw_version, version = fields
+        entries[package] = raw_version, version
+    return entries
+
+
+def _read_manifest(manifest_file):
+    """Return a mapping of package to ``(raw version, version)``.
+
+    The parsed manifest is remembered until the file's size, mtime, or inode
+    changes, so each manifest is read once no matter how many packages are
+    looked up in it.
+
+    """
+
+    try:
+        st = os.stat(manifest_file)
+    except OSError:
+        return {}
+    signature = st.st_mtime_ns, st.st_size, st.st_ino
+    with _manifest_lock:
+        parsed = _manifests.get(manifest_file)
+        if parsed is None or parsed[0] != signature:
+            parsed = _manifests[manifest_file] = (
+                signature, _parse_manifest(_read_bytes(manifest_file)))
+    return parsed[1]
+
+
+def _manifest_entry(manifest_file, package, use_mmap=False):
+    """Look up *package*'s ``(raw version, version)`` in a manifest.
+
+    Returns ``None`` if there's no entry. If *use_mmap* is true, the file is
+    memory-mapped and only the line for *package* is decoded, instead of
+    parsing the whole manifest.
+
+    """
+
+    if not use_mmap:
+        return _read_manifest(manifest_file).get(package)
+    needle = ('\n%s\t' % (package,)).encode('utf-8')
+    try:
+        with open(manifest_file, 'rb') as infile, mmap.mmap(
+                infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            start = mapped.find(needle)
+            if start < 0:
+                return None
+            start += len(needle)
+            end = mapped.find(b'\n', start)
+            if end < 0:
+                end = len(mapped)
+            raw_version, version = mapped[start:end].decode('utf-8').split(
+                '\t')
+    except (EnvironmentError, ValueError):
+        # mapping an empty file raises ValueError.
+        return None
+    return raw_version, version
+
+
+def _update_manifest(manifest_file, package, raw_version, version, open=open):
+    """Set *package*'s entry in a manifest.
+
+    The manifest is only rewritten if the entry changed. Returns whether it
+    was. Surrounding whitespace is stripped from *raw_version*, and an entry
+    which would still span more than one line or field isn't written.
+
+    """
+
+    raw_version = raw_version.strip()
+    line = '%s\t%s\t%s' % (package, raw_version, version)
+    if line.count('\t') != 2 or len(line.splitlines()) != 1:
+        return False
+    with _manifest_lock:
+        entries = dict(_read_manifest(manifest_file))
+        if entries.get(package) == (raw_version, version):
+            return False
+        entries[package] = raw_version, version
+        lines = [_manifest_header]
+        for name, entry in sorted(entries.items()):
+            lines.append('%s\t%s\t%s\n' % ((name,) + entry))
+        return _write_if_changed(manifest_file, ''.join(lines), open=open)
+
+
+@contextlib.contextmanager
+def _locked(directories, timeout=None):
+    """Hold exclusive locks on *directories*, shared with other processes.
+
+    Processes finding the versions of the same projects at once (as with
+    parallel builds in one checkout) write the same files; holding these
+    locks while writing keeps them from interleaving read-modify-write
+    updates, like those to a manifest. The directories themselves are locked
+    with ``flock``, so no lock files are left behind. Where that's not
+    possible (on Windows, if a directory doesn't exist, or if its filesystem
+    can't lock it, as NFS sometimes can't), that directory isn't locked, but
+    each file is still replaced atomically.
+
+    Waiting for other processes' locks takes at most *timeout* seconds in
+    all (:data:`_lock_timeout`, if it's ``None``), so that a hung or stopped
+    process can't stall every other build; any directory still locked after
+    that isn't locked by this process either.
+
+    """
+
+    if timeout is None:
+        timeout = _lock_timeout
+    deadline = time.monotonic() + timeout
+    fds = []
+    try:
+        # always locking in the same order means processes can't deadlock.
+        for directory in sorted(set(map(os.path.abspath, directories))):
+            if fcntl is None:
+                break
+            try:
+                fd = os.open(directory, os.O_RDONLY)
+            except OSError:
+                continue
+            delay = 0.001
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    locked = True
+                except BlockingIOError:
+                    remaining = deadline - time.monotonic()
+                    if remaining > 0:
+                        time.sleep(min(delay, remaining))
+                        delay = min(delay * 2, 0.1)
+                        continue
+                    locked = False
+                except OSError:
+                    locked = False
+                break
+            if not locked:
+                os.close(fd)
+                continue
+            fds.append(fd)
+        yield
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def _write_if_changed(path, content, open=open):
+    """Atomically replace the contents of *path*, unless they're the same.
+
+    Leaving an unchanged file alone keeps its mtime, so nothing downstream
+    (``.pyc`` files, file watchers, make) thinks it changed. Otherwise, the new
+    contents are written to a temporary file which is then renamed over
+    *path*, so that readers never see a partially-written file. Returns
+    whether *path* was written.
+
+    """
+
+    content = content.encode('utf-8')
+    try:
+        with open(path, 'rb') as infile:
+            if infile.read() == content:
+                return False
+    except EnvironmentError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    temp_path = '%s.%d-%d.tmp' % (path, os.getpid(), threading.get_ident())
+    try:
+        with open(temp_path, 'wb') as outfile:
+            outfile.write(content)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return True
+
+
+# PEP 440's version scheme, as given in its appendix.
+_pep440 = re.compile(r"""
+    v?
+    (?:(?P<epoch>[0-9]+)!)?
+    (?P<release>[0-9]+(?:\.[0-9]+)*)
+    (?:
+        [-_.]?(?P<pre_l>a|b|c|rc|alpha|beta|pre|preview)
+        [-_.]?(?P<pre_n>[0-9]+)?
+    )?
+    (?:
+        -(?P<post_n1>[0-9]+)
+        |
+        [-_.]?(?P<post_l>post|rev|r)[-_.]?(?P<post_n2>[0-9]+)?
+    )?
+    (?:[-_.]?(?P<dev_l>dev)[-_.]?(?P<dev_n>[0-9]+)?)?
+    (?:\+(?P<local>[a-z0-9]+(?:[-_.][a-z0-9]+)*))?
+    \Z""", re.VERBOSE | re.IGNORECASE)
+_pre_letters = {'alpha': 'a', 'beta': 'b', 'c': 'rc', 'pre': 'rc',
+                'preview': 'rc'}
+
+
+def _version_info(version):
+    """Precompute ``__version_info__`` and ``__version_key__`` for *version*.
+
+    ``__version_info__`` is the release numbers followed by the normalized
+    pre-release, post-release, development release, and local version parts,
+    e.g. ``(1, 2, 'rc1', 'dev3')`` for ``1.2rc1.dev3``. ``__version_key__``
+    orders versions the way PEP 440 (and ``packaging.version.Version``) does,
+    but is made only of tuples, ints, and strings, so it can be written out as
+    a literal and compared without importing anything. Both are ``None`` if
+    *version* isn't a PEP 440 version.
+
+    """
+
+    match = _pep440.match(version.strip())
+    if match is None:
+        return None, None
+    release = tuple(int(part) for part in match.group('release').split('.'))
+    info = list(release)
+    pre = post = dev = local = None
+    if match.group('pre_l'):
+        letter = match.group('pre_l').lower()
+        pre = _pre_letters.get(letter, letter), int(match.group('pre_n') or 0)
+        info.append('%s%d' % pre)
+    if match.group('post_n1') or match.group('post_l'):
+        post = int(match.group('post_n1') or match.group('post_n2') or 0)
+        info.append('post%d' % (post,))
+    if match.group('dev_l'):
+        dev = int(match.group('dev_n') or 0)
+        info.append('dev%d' % (dev,))
+    if match.group('local'):
+        local = re.split('[-_.]', match.group('local').lower())
+        info.append('+' + '.'.join(local))
+
+    # trailing zeros don't matter: 1.0 == 1.0.0.
+    trimmed = list(release)
+    while trimmed and trimmed[-1] == 0:
+        trimmed.pop()
+    # tuples stand in for packaging's infinities: (-1,) sorts before any
+    # (0, ...), which sorts before (1,).
+    if pre is not None:
+        pre_key = (0,) + pre
+    elif post is None and dev is not None:
+        pre_key = -1,
+    else:
+        pre_key = 1,
+    if local is None:
+        local_key = 0,
+    else:
+        local_key = (1,) + tuple(
+            (1, int(part)) if part.isdigit() else (0, part) for part in local)
+    key = (
+        int(match.group('epoch') or 0),
+        tuple(trimmed),
+        pre_key,
+        (-1,) if post is None else (0, post),
+        (1,) if dev is None else (0, dev),
+        local_key,
+    )
+    return tuple(info), key
+
+
+_version_module = """
+# This file is automatically generated by setup.py.
+__version__ = %(version)r
+__sha__ = %(sha)r
+__version_info__ = %(version_info)r
+__commits__ = %(commits)r
+__version_key__ = %(version_key)r
+"""
+
+_lazy_version_module = '''
+# This file is automatically generated by setup.py.
+# __version__ and the rest are only looked up the first time one is used. If
+# this module is inside the project root (e.g. in an editable install) and
+# vcversioner can be imported, the version is found again; otherwise, it's the
+# version from when this file was generated.
+_generated = %(generated)r
+_lookup = %(lookup)r
+_names = (
+    '__version__', '__sha__', '__version_info__', '__commits__',
+    '__version_key__')
+
+
+def __getattr__(name):
+    if name not in _names:
+        raise AttributeError(
+            'module %%r has no attribute %%r' %% (__name__, name))
+    found = _generated
+    import os
+    root = _lookup['root']
+    if os.path.abspath(__file__).startswith(os.path.join(root, '')):
+        try:
+            import vcversioner
+        except ImportError:
+            pass
+        else:
+            version = vcversioner.find_versions([root], **_lookup)[root]
+            if isinstance(version, vcversioner.Version):
+                found = vcversioner._version_module_values(version)
+    globals().update(zip(_names, found))
+    return globals()[name]
+'''
+
+
+def _version_module_values(version):
+    """Return what a version module defines for the :class:`Version`.
+
+    That's ``(__version__, __sha__, __version_info__, __commits__,
+    __version_key__)``.
+
+    """
+
+    version_info, version_key = _version_info(version.version)
+    commits = int(version.commits) if version.commits.isdigit() else None
+    return version.version, version.sha, version_info, commits, version_key
+
+
+class _Trace(object):
+    """Time the phases of a single :func:`find_version` call.
+
+    When it's finished, the timings are passed to the *trace* callback and
+    appended as a line of JSON to the file named by ``$VCVERSIONER_TRACE``, if
+    either is set.
+
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.path = os.environ.get('VCVERSIONER_TRACE')
+        self.start = time.perf_counter()
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, duration):
+        self.phases[name] = self.phases.get(name, 0) + duration
+
+    def finish(self, root, source, version=None, messages=None):
+        if self.callback is None and not self.path:
+            return
+        record = {
+            'root': root,
+            'version_source': source,
+            'version': version,
+            'phases': self.phases,
+            'total': time.perf_counter() - self.start,
+        }
+        if messages is not None:
+            record['error'] = messages
+        if self.callback is not None:
+            self.callback(record)
+        if self.path:
+            with open(self.path, 'a') as outfile:
+                outfile.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def _find_version(include_dev_version, root, version_file,
+                  version_module_paths, git_args, Popen, open, in_process,
+                  cache_file, memoize, read_only, trace,
+                  lazy_version_modules, tag_index, tag_prefix, tag_pattern,
+                  max_candidates, timeout, manifest_file, manifest_mmap, dirty,
+                  dirty_root_only, enclosing_repository=False):
+    """The steps of :func:`find_version`, minus actually running git.
+
+    This is a generator which yields the git command to run whenever git needs
+    to be run, and expects to be sent that command's ``(stdout, stderr,
+    timings)`` (or have ``OSError`` thrown in, if it couldn't be spawned),
+    where *timings* is a dict of phase names to durations in seconds. This way
+    the same steps can be driven synchronously or from an event loop. If
+    *enclosing_repository* is true, a root without a repository of its own is
+    looked up in the one containing it (see :func:`find_versions`).
+
+    """
+
+    tracer = _Trace(trace)
+    substitutions = {'pwd': os.getcwd()}
+    substitutions['root'] = root % substitutions
+
+    # a version from the environment trumps everything, and needs nothing
+    # read, so it's checked before anything else is done.
+    pretend = _pretend_version(substitutions['root'])
+    if pretend is not None:
+        ret = Version(pretend[0], '0', pretend[1])
+        lock_directories = [] if read_only else [substitutions['root']]
+        locked = _locked(lock_directories, timeout)
+        with locked, tracer.phase('write_version_modules'):
+            module = _version_module % dict(zip(
+                ['version', 'sha', 'version_info', 'commits', 'version_key'],
+                _version_module_values(ret)))
+            for path in () if read_only else version_module_paths:
+                _write_if_changed(path, module, open=open)
+        tracer.finish(substitutions['root'], 'pretend', ret.version)
+        return ret
+
+    substitutions['git_dir'] = git_dir = _resolve_git_dir(
+        _fix_path('%(root)s/.git' % substitutions))
+    if enclosing_repository:
+        enclosing_git_dir = _enclosing_git_dir(
+            substitutions['root'],
+            version_file and _fix_path(version_file % substitutions))
+        if enclosing_git_dir is not None:
+            substitutions['git_dir'] = git_dir = enclosing_git_dir
+    git_arg_templates = git_args
+    base_git_args = [_fix_path(arg % substitutions) for arg in git_args]
+    git_args = list(base_git_args)
+    match_glob, match = _tag_filter(tag_prefix, tag_pattern)
+    if match_glob is not None:
+        git_args.extend(['--match', match_glob])
+    if max_candidates is not None:
+        git_args.append('--candidates=%d' % (max_candidates,))
+    if version_file is not None:
+        version_file = _fix_path(version_file % substitutions)
+    if manifest_file is not None:
+        manifest_file = _fix_path(manifest_file % substitutions)
+        package = _manifest_package(substitutions['root'], manifest_file)
+
+    memo_key = (
+        substitutions['root'], tuple(git_args), version_file,
+        include_dev_version, tuple(version_module_paths), bool(in_process),
+        cache_file, bool(read_only), bool(lazy_version_modules),
+        bool(tag_index), tag_prefix, manifest_file, bool(dirty),
+        bool(dirty_root_only), bool(enclosing_repository), Popen, open)
+    if memoize:
+        # a remembered version is only good for as long as the repository's
+        # HEAD and tags are the same as when it was found.
+        memo_fingerprint = _fingerprint_parts(substitutions['root'], None)
+        memoized = _memo.get(memo_key)
+        if memoized is not None and memoized[0] == memo_fingerprint:
+            ret = memoized[1]
+            tracer.finish(substitutions['root'], 'memo', ret.version)
+            return ret
+
+    command = git_args
+    repo_dir = backend = None
+    if not os.path.exists(git_dir):
+        repo_dir, backend = _find_backend(substitutions['root'])
+    if backend is not None:
+        command = backend.command(repo_dir, match)
+
+    # try to pull the version from the cache, then git, or (perhaps) fall back
+    # on a previously-saved version.
+    raw_version = None
+    git_output = []
+    source = None
+    timed_out = None
+    if cache_file is not None:
+        with tracer.phase('cache'):
+            cache_file = _fix_path(cache_file % substitutions)
+            fingerprint = _ref_fingerprint(git_dir)
+            cache_key = [fingerprint, git_args, bool(in_process)]
+            if fingerprint is not None:
+                raw_version = _read_cache(cache_file, cache_key, open=open)
+        with _cache_stats_lock:
+            cache_stats['hits' if raw_version else 'misses'] += 1
+        if raw_version:
+            version_source = repr(cache_file)
+            source = 'cache'
+    if not raw_version and backend is not None:
+        with tracer.phase('in_process'):
+            raw_version = backend.describe(repo_dir, match)
+        version_source = repr(repo_dir)
+        source = 'in_process'
+    elif not raw_version and (in_process or tag_index):
+        with tracer.phase('in_process'):
+            raw_version = _describe_in_process(
+                git_dir, tag_index, match, max_candidates, read_only)
+        version_source = 'git'
+        source = 'in_process'
+    if not raw_version:
+        start = time.perf_counter()
+        try:
+            stdout, stderr, timings = yield command
+        except OSError:
+            pass
+        except subprocess.TimeoutExpired:
+            timed_out = time.perf_counter() - start
+            tracer.add('timeout', timed_out)
+            git_output = ['timed out after %.1f seconds' % (timed_out,)]
+        else:
+            for name, duration in timings.items():
+                tracer.add(name, duration)
+            raw_version = stdout.strip().decode()
+            git_output = stderr.decode().splitlines()
+            version_source = source = 'git'
+
+    def fail(*messages):
+        messages = list(messages)
+        if git_output:
+            messages.append('-- git output follows --')
+            messages.extend(git_output)
+        tracer.finish(substitutions['root'], source, messages=messages)
+        raise VersionNotFound(messages)
+
+    if (not raw_version and manifest_file is not None
+            and (version_file is None or not os.path.exists(version_file))):
+        with tracer.phase('read_manifest'):
+            entry = _manifest_entry(manifest_file, package, manifest_mmap)
+        if entry is not None:
+            raw_version = entry[0]
+            version_source = repr(manifest_file)
+            source = 'manifest'
+
+    # if git hung, the last cached version is better than nothing (but not
+    # better than version_file, which is never older).
+    if (not raw_version and timed_out is not None and cache_file is not None
+            and (version_file is None or not os.path.exists(version_file))):
+        raw_version = _read_cache(cache_file, None, open=open)
+        if raw_version:
+            version_source = repr(cache_file)
+            source = 'cache'
+
+    # git failed if the string is empty
+    if not raw_version:
+        if version_file is None:
+            fail('%r failed.' % (command,))
+        elif not os.path.exists(version_file):
+            fail("%r failed and %r isn't present." % (command, version_file),
+                 "are you installing from a github tarball?")
+        with tracer.phase('read_version_file'):
+            with open(version_file, 'rb') as infile:
+                raw_version = infile.read().decode()
+        version_source = repr(version_file)
+        source = 'version_file'
+
+    if timed_out is not None:
+        print('%r timed out after %.1f seconds; using the version from %s.' % (
+            command, timed_out, version_source))
+
+
+    # try to parse the version into something usable.
+    try:
+        with tracer.phase('parse'):
+            tag_version, commits, sha = raw_version.rsplit('-', 2)
+            if tag_prefix and tag_version.startswith(tag_prefix):
+                tag_version = tag_version[len(tag_prefix):]
+    except ValueError:
+        fail("%r (from %s) couldn't be parsed into a version." % (
+            raw_version, version_source))
+
+    if commits == '0' or not include_dev_version:
+        version = tag_version
+    else:
+        version = '%s.dev%s' % (tag_version, commits)
+    # the manifest is for looking versions up, so it never says dirty.
+    manifest_version = version
+
+    is_dirty = False
+    if dirty and backend is None:
+        with tracer.phase('dirty'):
+            try:
+                is_dirty = _is_dirty(substitutions['root'], dirty_root_only)
+            except _read_errors:
+                pass
+        if is_dirty:
+            version += '.dirty' if '+' in version else '+dirty'
+    ret = Version(version, commits, sha, is_dirty)
+
+    lock_directories = [] if read_only else [substitutions['root']]
+    if manifest_file is not None and not read_only:
+        lock_directories.append(os.path.dirname(manifest_file))
+    with _locked(lock_directories, timeout):
+        if version_file is not None and not read_only:
+            with tracer.phase('write_version_file'):
+                _write_if_changed(version_file, raw_version, open=open)
+
+        if (source in ('git', 'in_process') and cache_file is not None
+                and fingerprint is not None and not read_only):
+            with tracer.phase('write_cache'):
+                _write_cache(cache_file, cache_key, raw_version, open=open)
+
+        if manifest_file is not None and not read_only:
+            with tracer.phase('write_manifest'):
+                _update_manifest(
+                    manifest_file, package, raw_version, manifest_version,
+                    open=open)
+
+        with tracer.phase('write_version_modules'):
+            if lazy_version_modules:
+                # the module can be imported from any directory, so every
+                # path it looks up with has to be absolute.
+                absolute = dict(
+                    substitutions,
+                    root=os.path.abspath(substitutions['root']),
+                    git_dir=os.path.abspath(substitutions['git_dir']))
+                lookup = {
+                    'root': absolute['root'],
+                    'version_file': _abspath(version_file),
+                    'git_args': [
+                        _fix_path(arg % absolute)
+                        for arg in git_arg_templates],
+                    'include_dev_version': include_dev_version,
+                    'in_process': in_process,
+                    'tag_index': tag_index,
+                    'cache_file': _abspath(cache_file),
+                    'tag_prefix': tag_prefix,
+                    'tag_pattern': tag_pattern,
+                    'max_candidates': max_candidates,
+                    'timeout': timeout,
+                    'manifest_file': _abspath(manifest_file),
+                    'manifest_mmap': manifest_mmap,
+                    'dirty': dirty,
+                    'dirty_root_only': dirty_root_only,
+                    'read_only': True,
+                }
+                module = _lazy_version_module % {
+                    'generated': _version_module_values(ret),
+                    'lookup': lookup}
+            else:
+                module = _version_module % dict(zip(
+                    ['version', 'sha', 'version_info', 'commits',
+                     'version_key'],
+                    _version_module_values(ret)))
+            for path in () if read_only else version_module_paths:
+                _write_if_changed(path, module, open=open)
+
+    if memoize:
+        _memo[memo_key] = memo_fingerprint, ret
+    tracer.finish(substitutions['root'], source, version)
+    return ret
+
+
+def _step(steps, value=None, error=None):
+    "Advance a :func:`_find_version` generator, returning ``(done, value)``."
+    try:
+        if error is not None:
+            return False, steps.throw(error)
+        return False, steps.send(value)
+    except StopIteration as e:
+        return True, e.value
+
+
+def _communicate(proc, timeout=None):
+    """Wait for *proc*'s output for at most *timeout* seconds.
+
+    If it takes any longer, it's killed and ``subprocess.TimeoutExpired`` is
+    raised.
+
+    """
+
+    if timeout is None:
+        return proc.communicate()
+    try:
+        return proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        raise
+
+
+def _run_steps(steps, Popen, timeout=None):
+    """Drive a :func:`_find_version` generator, running git with *Popen*.
+
+    git is given *timeout* seconds to finish, as for :func:`find_version`.
+
+    """
+
+    done, value = _step(steps)
+    while not done:
+        start = time.perf_counter()
+        try:
+            proc = Popen(value, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            spawned = time.perf_counter()
+            stdout, stderr = _communicate(proc, timeout)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            done, value = _step(steps, error=e)
+            continue
+        timings = {
+            'spawn': spawned - start,
+            'communicate': time.perf_counter() - spawned,
+        }
+        done, value = _step(steps, (stdout, stderr, timings))
+    return value
+
+
+def _run_or_exit(steps, Popen, timeout=None):
+    "Like :func:`_run_steps`, but explain and exit if there's no version."
+    try:
+        return _run_steps(steps, Popen, timeout)
+    except VersionNotFound as e:
+        for message in e.messages:
+            print(message)
+        raise SystemExit(2)
+
+
+def _bind_arguments(kwargs):
+    "Fill in :func:`find_version`'s defaults for any missing *kwargs*."
+    bound = inspect.signature(find_version).bind(**kwargs)
+    bound.apply_defaults()
+    return bound.arguments
 
 
 def find_version(include_dev_version=True, root='%(pwd)s',
                  version_file='%(root)s/version.txt', version_module_paths=(),
-                 git_args=('git', '--git-dir', '%(root)s/.git', 'describe',
+                 git_args=('git', '--git-dir', '%(git_dir)s', 'describe',
                            '--tags', '--long'),
-                 Popen=subprocess.Popen, open=open):
+                 Popen=subprocess.Popen, open=open, in_process=False,
+                 cache_file=None, memoize=False, read_only=False, trace=None,
+                 lazy_version_modules=False, tag_index=False, tag_prefix='',
+                 tag_pattern=None, max_candidates=None, timeout=None,
+                 manifest_file=None, manifest_mmap=False, dirty=False,
+                 dirty_root_only=False):
     """Find an appropriate version number from version control.
 
     It's much more convenient to be able to use your version control system's
     tagging mechanism to derive a version number than to have to duplicate that
-    information all over the place. Currently, only git is supported.
+    information all over the place. Git and Mercurial are supported.
 
     The default behavior is to write out a ``version.txt`` file which contains
     the git output, for systems where git isn't installed or there is no .git
     directory present. ``version.txt`` can (and probably should!) be packaged
     in release tarballs by way of the ``MANIFEST.in`` file.
 
+    If the ``VCVERSIONER_PRETEND_VERSION`` environment variable (or
+    ``VCVERSIONER_PRETEND_VERSION_FOR_<NAME>``, where *NAME* is the name of
+    *root*'s directory in uppercase) is set, its value is the version, with
+    the sha taken from ``VCVERSIONER_PRETEND_SHA`` (or
+    ``VCVERSIONER_PRETEND_SHA_FOR_<NAME>``). Nothing is run or read, and only
+    the version modules are written.
+
     :param include_dev_version: By default, if there are any commits after the
                                 most recent tag (as reported by git), that
                                 number will be included in the version number
@@ -84,7 +2054,7 @@ def find_version(include_dev_version=True, root='%(pwd)s',
                                  __version__, __sha__``.
 
     :param git_args: The git command to run to get a version. By default, this
-                     is ``git --git-dir %(root)s/.git describe --tags --long``.
+                     is ``git --git-dir %(git_dir)s describe --tags --long``.
                      ``--git-dir`` is used to prevent contamination from git
                      repositories which aren't the git repository of your
                      project. Specify this as a list of string arguments
@@ -96,7 +2066,129 @@ def find_version(include_dev_version=True, root='%(pwd)s',
 
     :param open: Defaults to ``open``. This is for testing.
 
-    *root*, *version_file*, and *git_args* each support some substitutions:
+    :param in_process: If true, read ``%(git_dir)s`` directly instead of
+                       spawning git. The result is the same as what ``git
+                       describe --tags --long`` would output, but no process
+                       is spawned, so git doesn't even need to be installed.
+                       If the repository can't be read this way (or has no
+                       tags), *git_args* is run as usual.
+
+    :param cache_file: The name of a file in which to cache the version found
+                       from git, keyed by the state of ``HEAD`` and the tags in
+                       ``%(git_dir)s``. As long as neither has changed, the
+                       cached version is used and git isn't consulted at all.
+                       For example, ``'%(root)s/version.txt.cache'`` keeps the
+                       cache next to the default *version_file*. Hits and
+                       misses are counted in :data:`cache_stats`. By default,
+                       no cache is kept. Standard substitutions are performed
+                       on this value.
+
+    :param memoize: If true, the version found is remembered for the rest of
+                    the process, and later calls with the same arguments
+                    (after substitution) return it without running git or
+                    writing anything, for as long as the repository's
+                    ``HEAD`` and tags are unchanged (uncommitted changes
+                    aren't rechecked, and files deleted in the meantime
+                    aren't written again). This means that ``setup.py`` and
+                    anything else in the same build can call
+                    :func:`find_version` freely. Use :func:`clear_memo` to
+                    forget remembered versions. By default, the version is
+                    looked up every time.
+
+    :param read_only: If true, nothing is written: not *version_file*, not
+                      *cache_file*, and not *version_module_paths*. Otherwise,
+                      files are only written if their contents would change,
+                      and are replaced atomically.
+
+    :param trace: A callable which, if specified, is called with a dict
+                  describing how the version was found: the ``root``, the
+                  ``version`` (``None`` on failure), the ``version_source``
+                  (one of ``'memo'``, ``'cache'``, ``'in_process'``,
+                  ``'git'``, ``'version_file'``, ``'manifest'``, or
+                  ``'pretend'``), the ``total`` time taken in seconds, and
+                  ``phases``, a dict of how long each phase (such as
+                  ``'spawn'``, ``'communicate'``, ``'parse'``, or
+                  ``'write_version_modules'``) took. On failure, ``error``
+                  is the list of messages explaining why. The same dicts are
+                  also appended as lines of JSON to the file named by the
+                  ``VCVERSIONER_TRACE`` environment variable, if it's set.
+
+    :param lazy_version_modules: If true, the modules in
+                                 *version_module_paths* don't hardcode
+                                 ``__version__`` and ``__sha__``. Instead,
+                                 the first time either is accessed, the
+                                 version is found again (as long as the
+                                 module is inside *root*, as it is in an
+                                 editable install, and vcversioner can be
+                                 imported), and otherwise is the version
+                                 found now. Importing such a module costs
+                                 nothing extra, and it's never stale during
+                                 development.
+
+    :param tag_index: If true, the repository is read in-process (as with
+                      *in_process*), and a persistent index of tags and of
+                      the nearest tag to recently described commits is kept
+                      in ``%(git_dir)s/vcversioner-index``. New commits on
+                      top of an indexed commit are then described by walking
+                      only the new commits, instead of the whole history.
+
+    :param tag_prefix: If specified, only tags starting with this prefix are
+                       considered, and the prefix is stripped off to get the
+                       version. For example, with a *tag_prefix* of ``'v'``,
+                       the tag ``v1.0`` is version ``1.0``, and the tag
+                       ``deploy-2013-08-06`` is ignored.
+
+    :param tag_pattern: If specified, only tags matching this glob (after
+                        *tag_prefix*, if any) are considered. For example,
+                        ``'[0-9]*'`` skips any tags which don't start with a
+                        digit. This is passed to git as ``--match``.
+
+    :param max_candidates: How many of the nearest tags to consider before
+                           settling on the closest one; the fewer, the less
+                           history is walked. git's default is 10. This is
+                           passed to git as ``--candidates``.
+
+    :param timeout: The number of seconds to wait for git before killing it.
+                    If git takes too long, the version is read from
+                    *version_file* instead or, failing that, the last version
+                    saved in *cache_file*, and how long git was waited for is
+                    printed. By default, there's no limit. This is also the
+                    longest time spent waiting for other processes' locks
+                    before writing anyway (ten seconds, by default).
+
+    :param manifest_file: The name of a manifest file, which several projects
+                          (such as the packages of a monorepo) can share
+                          instead of each having a *version_file*. It holds
+                          the git output and the version for each project,
+                          keyed by the project's root relative to the
+                          manifest's directory. Like *version_file*, it's
+                          used if git fails, and it's only rewritten when an
+                          entry changes. Standard substitutions are
+                          performed on this value.
+
+    :param manifest_mmap: If true, *manifest_file* is memory-mapped and only
+                          this project's entry is decoded, instead of the
+                          whole manifest being parsed (once per process).
+
+    :param dirty: If true, check whether any tracked files have been modified
+                  since the last commit, whether or not the changes have been
+                  staged. If so, the returned :class:`Version`'s ``dirty``
+                  attribute is true and ``+dirty`` is added to the version as
+                  a local version label (so ``1.0.dev3`` becomes
+                  ``1.0.dev3+dirty``). Files are compared using the stat data
+                  cached in the index, stopping at the first modified file,
+                  and the index's cached tree is compared with ``HEAD``'s, so
+                  this is much faster than ``git status``.
+
+    :param dirty_root_only: If true, only files inside *root* are checked by
+                            *dirty*, which is useful when *root* is one
+                            project in a larger repository.
+
+    *tag_prefix*, *tag_pattern*, and *max_candidates* also apply to
+    *in_process* and *tag_index*. Their options are appended to *git_args*.
+
+    *root*, *version_file*, *cache_file*, *manifest_file*, and *git_args* each
+    support some substitutions:
 
     ``%(root)s``
       The value provided for *root*. This is not available for the *root*
@@ -105,80 +2197,499 @@ def find_version(include_dev_version=True, root='%(pwd)s',
     ``%(pwd)s``
       The current working directory.
 
+    ``%(git_dir)s``
+      The git directory of *root*. This is usually ``%(root)s/.git``, but if
+      that's a file, as it is in worktrees made by ``git worktree`` and in
+      submodules, it's the directory that file points to. This is not
+      available for the *root* parameter itself.
+
     ``/`` will automatically be translated into the correct path separator for
     the current platform, such as ``:`` or ``\``.
 
     """
 
+    # at this point, locals() is exactly the arguments.
+    return _run_or_exit(_find_version(**locals()), Popen, timeout)
+
+
+def clear_memo(root=None):
+    """Forget versions remembered by :func:`find_version`.
+
+    :param root: If specified, only versions found for this project root are
+                 forgotten. Standard substitutions are performed on this
+                 value, just as for :func:`find_version`.
+
+    """
+
+    if root is None:
+        _memo.clear()
+        return
+    root = root % {'pwd': os.getcwd()}
+    for key in list(_memo):
+        if key[0] == root:
+            _memo.pop(key, None)
+
+
+def find_tags(root='%(pwd)s', tag_prefix='', tag_pattern=None,
+              cache_file=None, Popen=subprocess.Popen):
+    """Find every tag which names a version.
+
+    Tags are chosen by *tag_prefix* and *tag_pattern* just as for
+    :func:`find_version`, and only tags whose versions (their names, minus
+    *tag_prefix*) are PEP 440 versions are included. Returns a list of
+    :class:`Tag`, sorted from the earliest version to the latest, so that
+    ``find_tags()[-1]`` is the latest release and ``find_tags()[-2]`` the one
+    before it.
+
+    The repository is read directly if possible, and otherwise through git.
+    The result is remembered for as long as no tag is added, removed, or
+    moved, which is checked by looking at the stat data of ``packed-refs``
+    and of the directories in ``refs/tags``, so asking again is cheap no
+    matter how many tags there are.
+
+    :param root: The project root, as for :func:`find_version`.
+    :param cache_file: If specified, the result is also remembered in this
+                       file, so that other processes can use it. Standard
+                       substitutions are performed on this value.
+    :param Popen: Defaults to ``subprocess.Popen``. This is for testing.
+
+    """
+
+    substitutions = {'pwd': os.getcwd()}
+    substitutions['root'] = root % substitutions
+    substitutions['git_dir'] = git_dir = _resolve_git_dir(
+        _fix_path('%(root)s/.git' % substitutions))
+    common_dir = _common_dir(git_dir)
+    key = common_dir, tag_prefix, tag_pattern
+    cached = _tag_lists.get(key)
+    if cached is not None:
+        directories, fingerprint, tags = cached
+        if _tags_fingerprint(common_dir, directories) == fingerprint:
+            return list(tags)
+    if cache_file is not None:
+        cache_file = _fix_path(cache_file % substitutions)
+        cached = _read_cache(cache_file, list(key))
+        if cached is not None:
+            directories, fingerprint, tags = cached
+            if _tags_fingerprint(common_dir, directories) == fingerprint:
+                tags = [Tag(*tag) for tag in tags]
+                _tag_lists[key] = directories, fingerprint, tags
+                return list(tags)
+
+    # the fingerprint is taken first, so that a tag which changes while
+    # they're being read is noticed the next time.
+    directories = _tag_directories(common_dir)
+    fingerprint = _tags_fingerprint(common_dir, directories)
+    _, match = _tag_filter(tag_prefix, tag_pattern)
+    try:
+        with _GitRepository(git_dir) as repo:
+            peeled = repo.peeled_tags(match)
+    except _read_errors:
+        with _CatFileRepository(git_dir, Popen) as repo:
+            peeled = repo.peeled_tags(match)
+    tags = []
+    for name, sha in peeled.items():
+        version = name[len(tag_prefix):]
+        version_key = _version_info(version)[1]
+        if version_key is not None:
+            tags.append((version_key, Tag(version, name, sha)))
+    tags = [tag for _, tag in sorted(tags)]
+    _tag_lists[key] = directories, fingerprint, tags
+    if cache_file is not None:
+        _write_cache(
+            cache_file, list(key), [directories, fingerprint, tags])
+    return list(tags)
+
+
+def _fingerprint_parts(root, version_file):
+    """What :func:`version_fingerprint` hashes, given substituted arguments.
+
+    *version_file* is only used if *root* isn't a repository, and can be
+    ``None`` to leave it out.
+
+    """
+
+    parts = [_pretend_version(root)]
+    git_dir = _resolve_git_dir(_fix_path('%s/.git' % (root,)))
+    fingerprint = _ref_fingerprint(git_dir)
+    if fingerprint is not None:
+        return parts + ['git', fingerprint]
+    repo_dir, backend = _find_backend(root)
+    if backend is not None:
+        parts.extend([backend.__name__, backend.fingerprint(repo_dir)])
+    elif version_file is not None:
+        parts.extend(['version_file', _stat_key(version_file)])
+    return parts
+
+
+def version_fingerprint(root='%(pwd)s', version_file='%(root)s/version.txt'):
+    """Cheaply summarize everything a project's version depends on.
+
+    Returns a hex digest which changes whenever :func:`find_version` could
+    find a different version: when ``HEAD`` moves or points somewhere else,
+    or a tag is added, removed, or moved. Nothing is run, and only a few
+    files are statted and read, so build tools can use this to decide whether
+    vcversioner needs to run at all. Uncommitted changes (as for *dirty*)
+    aren't taken into account.
+
+    For Mercurial repositories, the backend's fingerprint is used. If *root*
+    isn't a repository at all, the version comes from *version_file*, so its
+    stat data is used instead. A version from the environment (see
+    :func:`find_version`) is part of the fingerprint too.
+
+    :param root: The project root, as for :func:`find_version`.
+    :param version_file: The version file, as for :func:`find_version`.
+
+    """
+
     substitutions = {'pwd': os.getcwd()}
     substitutions['root'] = root % substitutions
-    git_args = [_fix_path(arg % substitutions) for arg in git_args]
     if version_file is not None:
         version_file = _fix_path(version_file % substitutions)
+    return hashlib.sha1(json.dumps(_fingerprint_parts(
+        substitutions['root'], version_file)).encode()).hexdigest()
 
-    # try to pull the version from git, or (perhaps) fall back on a
-    # previously-saved version.
-    try:
-        proc = Popen(git_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    except OSError:
-        raw_version = None
-        git_output = []
-    else:
+
+class _SharedProcess(object):
+    "The output of a git command, run at most once and shared between callers."
+
+    def __init__(self, output=None):
+        self.lock = threading.Lock()
+        self.output = output
+        self.error = None
+
+    def communicate(self, timeout=None):
+        return self.output
+
+
+class _SharedGit(object):
+    """A stand-in for ``Popen`` which runs each distinct command only once.
+
+    Path arguments are compared by their real paths, so that several roots
+    using the same ``.git`` directory share a single git process.
+
+    """
+
+    def __init__(self, Popen, timeout=None):
+        self.Popen = Popen
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.processes = {}
+
+    def __call__(self, args, **kwargs):
+        key = tuple(
+            os.path.realpath(arg) if os.sep in arg else arg for arg in args)
+        with self.lock:
+            process = self.processes.get(key)
+            if process is None:
+                process = self.processes[key] = _SharedProcess()
+        with process.lock:
+            if process.output is None and process.error is None:
+                try:
+                    process.output = _communicate(
+                        self.Popen(args, **kwargs), self.timeout)
+                except (OSError, subprocess.TimeoutExpired) as e:
+                    process.error = e
+        if process.error is not None:
+            raise process.error
+        return process
+
+
+def find_versions(roots, max_workers=8, enclosing_repository=False,
+                  **kwargs):
+    """Find the versions of several projects at once.
+
+    Each root is looked up by :func:`find_version` on a pool of at most
+    *max_workers* threads, and git is only run once for each distinct git
+    command, so roots sharing a ``.git`` directory share the work. All other
+    keyword arguments are passed along to :func:`find_version`.
+
+    If *enclosing_repository* is true, a root with neither a ``.git`` (or
+    other version control directory from :data:`backends`) of its own nor an
+    existing *version_file* is looked up in the git repository containing it,
+    so the projects in subdirectories of one repository are all described by
+    one git process. This is off by default, since it means a root can pick up
+    the version of a repository that isn't its own.
+
+    Returns a dict mapping each of *roots* to either its :class:`Version` or,
+    if its version couldn't be found, the exception explaining why (usually a
+    :class:`VersionNotFound`). Nothing is printed for failed roots.
+
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    arguments = _bind_arguments(kwargs)
+    Popen = _SharedGit(arguments['Popen'], arguments['timeout'])
+
+    def find(root):
+        arguments_for_root = dict(
+            arguments, root=root, enclosing_repository=enclosing_repository)
+        try:
+            return _run_steps(_find_version(**arguments_for_root), Popen)
+        except Exception as e:
+            return e
+
+    roots = list(roots)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(roots, executor.map(find, roots)))
+
+
+async def async_find_version(create_subprocess_exec=None, **kwargs):
+    """Find an appropriate version number without blocking the event loop.
+
+    This is a coroutine which takes the same keyword arguments as, and
+    otherwise behaves like, :func:`find_version`, except that git is run with
+    asyncio's subprocess support and all file I/O happens in the event loop's
+    default executor. Instead of printing an explanation and exiting if no
+    version can be found, :class:`VersionNotFound` is raised.
+
+    :param create_subprocess_exec: Defaults to
+                                   ``asyncio.create_subprocess_exec``. This is
+                                   for testing.
+
+    """
+
+    # asyncio takes longer to import than the rest of vcversioner put
+    # together, so only its users pay for it.
+    import asyncio
+
+    if create_subprocess_exec is None:
+        create_subprocess_exec = asyncio.create_subprocess_exec
+    loop = asyncio.get_running_loop()
+    arguments = _bind_arguments(kwargs)
+    timeout = arguments['timeout']
+    steps = _find_version(**arguments)
+    value = error = None
+    while True:
+        done, git_args = await loop.run_in_executor(
+            None, functools.partial(_step, steps, value, error))
+        if done:
+            return git_args
+        value = error = None
+        start = loop.time()
+        try:
+            proc = await create_subprocess_exec(
+                *git_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            error = e
+            continue
+        spawned = loop.time()
+        try:
+            stdout, stderr = await asyncio.wait_for(
+                proc.communicate(), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            error = subprocess.TimeoutExpired(git_args, timeout)
+            continue
+        timings = {
+            'spawn': spawned - start,
+            'communicate': loop.time() - spawned,
+        }
+        value = stdout, stderr, timings
+
+
+class _CatFileRepository(_GitRepository):
+    """A repository read through a long-lived ``git cat-file --batch``.
+
+    Objects read this way are remembered for as long as the repository is
+    open, since they can't change. The tags are only listed again (with ``git
+    for-each-ref``) once :func:`_ref_fingerprint` notices they've changed.
+
+    """
+
+    def __init__(self, git_dir, Popen):
+        self.git_dir = git_dir
+        self.common_dir = _common_dir(git_dir)
+        self.Popen = Popen
+        self._proc = None
+        self._commits = {}
+        self._objects = {}
+        self._tags = self._tags_fingerprint = None
+        self._abbrev = None
+        self._shallow = set()
+        shallow_path = os.path.join(self.common_dir, 'shallow')
+        if os.path.exists(shallow_path):
+            self._shallow.update(_read_bytes(shallow_path).decode().split())
+
+    def _git(self, *args):
+        return ['git', '--git-dir', self.git_dir] + list(args)
+
+    def close(self):
+        if self._proc is not None:
+            for stream in [self._proc.stdin, self._proc.stdout]:
+                stream.close()
+            self._proc.wait()
+            self._proc = None
+
+    def _query(self, name):
+        "Send one query to the helper, restarting it if it's died."
+        for attempt in range(2):
+            if self._proc is None or self._proc.poll() is not None:
+                self._proc = self.Popen(
+                    self._git('cat-file', '--batch'), stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            try:
+                self._proc.stdin.write(name.encode() + b'\n')
+                self._proc.stdin.flush()
+                header = self._proc.stdout.readline().decode().split()
+            except EnvironmentError:
+                header = []
+            if header:
+                break
+            self.close()
+        else:
+            raise _GitReadError('git cat-file keeps dying')
+        if len(header) != 3:
+            raise _GitReadError('%r is %s' % (name, header[-1]))
+        sha, type, size = header
+        data = self._proc.stdout.read(int(size) + 1)[:-1]
+        return sha, type.encode(), data
+
+    def read_object(self, sha):
+        if len(sha) == 20:
+            sha = binascii.hexlify(sha).decode()
+        ret = self._objects.get(sha)
+        if ret is None:
+            _, type, data = self._query(sha)
+            ret = type, data
+            if type != b'commit':
+                # commits are remembered (more compactly) by commit().
+                self._objects[sha] = ret
+        return ret
+
+    def head(self):
+        if not os.path.isfile(os.path.join(self.git_dir, 'HEAD')):
+            raise _GitReadError('%r is not a git directory' % (self.git_dir,))
+        sha, type, data = self._query('HEAD')
+        return sha
+
+    def tag_refs(self):
+        tags = {}
+        proc = self.Popen(
+            self._git('for-each-ref', '--format=%(objectname) %(*objecttype) '
+                      '%(*objectname) %(refname)', 'refs/tags'),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         stdout, stderr = proc.communicate()
-        raw_version = stdout.strip().decode()
-        git_output = stderr.decode().splitlines()
-        version_source = 'git'
+        for line in stdout.decode().splitlines():
+            sha, peeled_type, peeled, name = line.split(' ', 3)
+            if not peeled_type:
+                peeled = sha
+            elif peeled_type == 'tag':
+                # a tag of a tag still has to be peeled the rest of the way.
+                peeled = None
+            tags[name[len('refs/tags/'):]] = sha, peeled
+        return tags
 
-    def show_git_output():
-        if not git_output:
-            return
-        print('-- git output follows --')
-        for line in git_output:
-            print(line)
+    def tagged_commits(self, match=None):
+        fingerprint = _ref_fingerprint(self.git_dir)
+        if fingerprint is None:
+            raise _GitReadError('%r is not a git directory' % (self.git_dir,))
+        fingerprint = fingerprint[2:] + [match and match.pattern]
+        if self._tags is None or fingerprint != self._tags_fingerprint:
+            self._tags = _GitRepository.tagged_commits(self, match)
+            self._tags_fingerprint = fingerprint
+        return self._tags
 
-    # git failed if the string is empty
-    if not raw_version:
-        if version_file is None:
-            print('%r failed.' % (git_args,))
-            show_git_output()
-            raise SystemExit(2)
-        elif not os.path.exists(version_file):
-            print("%r failed and %r isn't present." % (git_args, version_file))
-            print("are you installing from a github tarball?")
-            show_git_output()
-            raise SystemExit(2)
-        with open(version_file, 'rb') as infile:
-            raw_version = infile.read().decode()
-        version_source = repr(version_file)
+    def abbreviate(self, sha):
+        if self._abbrev is None:
+            proc = self.Popen(
+                self._git('rev-parse', '--short', sha),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            self._abbrev = len(proc.communicate()[0].strip()) or 7
+        length = self._abbrev
+        while length < len(sha):
+            try:
+                self._query(sha[:length])
+            except _GitReadError:
+                length += 1
+            else:
+                break
+        return sha[:length]
 
 
-    # try to parse the version into something usable.
-    try:
-        tag_version, commits, sha = raw_version.rsplit('-', 2)
-    except ValueError:
-        print("%r (from %s) couldn't be parsed into a version." % (
-            raw_version, version_source))
-        show_git_output()
-        raise SystemExit(2)
+class GitSession(object):
+    """A long-lived git helper for finding one repository's version repeatedly.
 
-    if version_file is not None:
-        with open(version_file, 'w') as outfile:
-            outfile.write(raw_version)
+    Long-running tools which need to find versions over and over can avoid
+    spawning git each time by keeping a session open::
 
-    if commits == '0' or not include_dev_version:
-        version = tag_version
-    else:
-        version = '%s.dev%s' % (tag_version, commits)
+      with vcversioner.GitSession('/path/to/project') as session:
+          version = session.find_version()
 
-    for path in version_module_paths:
-        with open(path, 'w') as outfile:
-            outfile.write("""
-# This file is automatically generated by setup.py.
-__version__ = %s
-__sha__ = %s
-""" % (repr(version).lstrip('u'), repr(sha).lstrip('u')))
+    The session keeps a single ``git cat-file --batch`` process running and
+    works out what ``git describe --tags --long`` would say by asking it for
+    objects, which are remembered between queries. ``git for-each-ref`` is
+    only run again when the repository's tags have changed. If the helper
+    process dies, it's restarted. If the session can't describe the
+    repository, the usual *git_args* is run instead.
+
+    :param root: The project root, just as for :func:`find_version`.
+
+    :param git_dir: The repository to use. Standard substitutions are
+                    performed on this value.
+
+    :param Popen: Defaults to ``subprocess.Popen``. This is for testing.
+
+    """
 
-    return Version(version, commits, sha)
+    def __init__(self, root='%(pwd)s', git_dir='%(root)s/.git',
+                 Popen=subprocess.Popen):
+        substitutions = {'pwd': os.getcwd()}
+        self.root = substitutions['root'] = root % substitutions
+        self.Popen = Popen
+        self._repo = _CatFileRepository(
+            _resolve_git_dir(_fix_path(git_dir % substitutions)), Popen)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        "Stop the helper process."
+        self._repo.close()
+
+    def describe(self, tag_prefix='', tag_pattern=None, max_candidates=None):
+        """Return what ``git describe --tags --long`` would, or ``None``.
+
+        ``None`` means the repository couldn't be described this way. The
+        arguments restrict the tags considered, just as for
+        :func:`find_version`.
+
+        """
+
+        _, match = _tag_filter(tag_prefix, tag_pattern)
+        if max_candidates is None:
+            max_candidates = 10
+        try:
+            return self._repo.describe(match, max_candidates)
+        except _read_errors:
+            return None
+
+    def _popen(self, arguments, args, **kwargs):
+        raw_version = self.describe(
+            arguments['tag_prefix'], arguments['tag_pattern'],
+            arguments['max_candidates'])
+        if raw_version is None:
+            return self.Popen(args, **kwargs)
+        return _SharedProcess(output=(raw_version.encode(), b''))
+
+    def find_version(self, **kwargs):
+        """Find a version, just like :func:`find_version`.
+
+        The arguments are the same, except that *root* defaults to the
+        session's root.
+
+        """
+
+        kwargs.setdefault('root', self.root)
+        arguments = _bind_arguments(kwargs)
+        return _run_or_exit(
+            _find_version(**arguments),
+            functools.partial(self._popen, arguments), arguments['timeout'])
 
 
 def setup(dist, attr, value):
@@ -199,4 +2710,330 @@ def setup(dist, attr, value):
 
     """
 
+    value = dict(_build_defaults, **value)
     dist.version = dist.metadata.version = find_version(**value).version
+
+
+class _BuildBackend(object):
+    """A PEP 517 build backend which wraps ``setuptools.build_meta``.
+
+    A frontend may run each hook in a new process, and each runs ``setup.py``
+    again. While a hook runs, :func:`setup` defaults *cache_file* to
+    :attr:`cache_file` in the source tree, so only the first hook of a build
+    finds the version from scratch and the rest use what it cached. Since the
+    cache is keyed by the state of ``HEAD`` and the tags, a later build after
+    a new commit or tag finds the version again.
+
+    """
+
+    cache_file = os.path.join('build', 'vcversioner-build.json')
+
+    def __getattr__(self, name):
+        from setuptools import build_meta
+        hook = getattr(build_meta, name)
+        if name.startswith('_') or not callable(hook):
+            return hook
+
+        @functools.wraps(hook)
+        def wrapper(*args, **kwargs):
+            cache_file = os.path.abspath(self.cache_file)
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            _build_defaults['cache_file'] = cache_file
+            try:
+                return hook(*args, **kwargs)
+            finally:
+                _build_defaults.clear()
+
+        return wrapper
+
+
+#: A PEP 517 build backend, used with ``build-backend =
+#: "vcversioner:build_meta"``. Its hooks are those of
+#: ``setuptools.build_meta``, except that the version is only found once per
+#: build.
+build_meta = _BuildBackend()
+
+
+class _PollWatcher(object):
+    "Notice changes to refs by periodically comparing their stat data."
+
+    def __init__(self, git_dir, interval=1.0):
+        self.interval = interval
+        self.paths = [
+            os.path.join(git_dir, 'HEAD'),
+            os.path.join(_common_dir(git_dir), 'packed-refs')]
+        self.refs_dirs = [os.path.join(_common_dir(git_dir), 'refs')]
+        if self.refs_dirs[0] != os.path.join(git_dir, 'refs'):
+            self.refs_dirs.append(os.path.join(git_dir, 'refs'))
+        self._last = self._snapshot()
+
+    def _snapshot(self):
+        paths = list(self.paths)
+        for refs_dir in self.refs_dirs:
+            for dirpath, dirnames, filenames in os.walk(refs_dir):
+                paths.extend(os.path.join(dirpath, name) for name in filenames)
+        snapshot = {}
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = st.st_mtime_ns, st.st_size, st.st_ino
+        return snapshot
+
+    def wait(self, timeout):
+        "Wait up to *timeout* seconds for a change; return whether there was."
+        deadline = time.monotonic() + timeout
+        while True:
+            snapshot = self._snapshot()
+            if snapshot != self._last:
+                self._last = snapshot
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.interval, remaining))
+
+    def close(self):
+        pass
+
+
+class _InotifyWatcher(object):
+    """Notice changes to refs with Linux's inotify.
+
+    ``HEAD``, ``packed-refs``, and every directory under ``refs`` are watched.
+    Raises ``OSError`` if inotify isn't available.
+
+    """
+
+    # IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE,
+    # IN_DELETE, IN_DELETE_SELF, and IN_MOVE_SELF.
+    _mask = 0x2 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400 | 0x800
+    _is_dir = 0x40000000
+    _overflow = 0x4000
+    _event = struct.Struct('iIII')
+
+    def __init__(self, git_dir, interval=None):
+        import ctypes
+        import ctypes.util
+        import select
+        self._select = select.select
+        libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        except AttributeError:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._errno = ctypes.get_errno
+        self.watches = {}
+        self.git_dirs = set([git_dir, _common_dir(git_dir)])
+        try:
+            for path in self.git_dirs:
+                self._watch(path)
+                self._watch_tree(os.path.join(path, 'refs'))
+        except OSError:
+            self.close()
+            raise
+
+    def _watch(self, path):
+        wd = self._add_watch(self.fd, os.fsencode(path), self._mask)
+        if wd < 0:
+            raise OSError(self._errno(), 'inotify_add_watch failed', path)
+        self.watches[wd] = path
+
+    def _watch_tree(self, path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            self._watch(dirpath)
+
+    def _is_change(self, wd, mask, name):
+        path = self.watches.get(wd)
+        if path is None or not name or name.endswith('.lock'):
+            return False
+        if path in self.git_dirs:
+            return name in ('HEAD', 'packed-refs')
+        if mask & self._is_dir and mask & (0x100 | 0x80):
+            # a new directory under refs.
+            self._watch_tree(os.path.join(path, name))
+        return True
+
+    def wait(self, timeout):
+        "Wait up to *timeout* seconds for a change; return whether there was."
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if not self._select([self.fd], [], [], remaining)[0]:
+                return False
+            data = os.read(self.fd, 65536)
+            changed = False
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self._event.unpack_from(
+                    data, offset)
+                offset += self._event.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                if mask & self._overflow or self._is_change(wd, mask, name):
+                    changed = True
+            if changed:
+                return True
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def watch(debounce=0.2, poll_interval=1.0, use_inotify=True, callback=None,
+          stop=None, **kwargs):
+    """Keep *version_file* and *version_module_paths* up to date.
+
+    The repository's ``HEAD``, ``packed-refs``, and ``refs`` are watched (with
+    inotify on Linux, and by polling otherwise), and whenever they change,
+    the version is found again and the files are rewritten if it changed.
+    This way an editable install always sees the current version, without
+    having to ask git when it's imported. Otherwise, the keyword arguments
+    are the same as for :func:`find_version`.
+
+    :param debounce: How many seconds to wait for things to settle after a
+                     change, so that a burst of ref updates (such as from a
+                     fetch or a rebase) only causes the version to be found
+                     once.
+
+    :param poll_interval: How many seconds to wait between checks for
+                          changes, if polling.
+
+    :param use_inotify: If false, always poll instead of using inotify.
+
+    :param callback: A callable which, if specified, is called with each
+                     :class:`Version` found (or the :class:`VersionNotFound`
+                     explaining why no version could be found).
+
+    :param stop: A ``threading.Event`` which, if specified, stops watching
+                 once it's set. Otherwise, this watches forever.
+
+    """
+
+    arguments = _bind_arguments(kwargs)
+    root = arguments['root'] % {'pwd': os.getcwd()}
+    git_dir = _resolve_git_dir(_fix_path('%s/.git' % (root,)))
+    watcher = None
+    if use_inotify:
+        try:
+            watcher = _InotifyWatcher(git_dir)
+        except OSError:
+            pass
+    if watcher is None:
+        watcher = _PollWatcher(git_dir, poll_interval)
+
+    def refresh():
+        try:
+            found = _run_steps(
+                _find_version(**arguments), arguments['Popen'],
+                arguments['timeout'])
+        except VersionNotFound as e:
+            found = e
+        if callback is not None:
+            callback(found)
+
+    try:
+        refresh()
+        while stop is None or not stop.is_set():
+            if not watcher.wait(poll_interval):
+                continue
+            while watcher.wait(debounce):
+                pass
+            refresh()
+    finally:
+        watcher.close()
+
+
+def main(argv=None):
+    "Run vcversioner from the command line."
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog='python -m vcversioner',
+        description='Find versions from version control.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    watch_parser = subparsers.add_parser(
+        'watch', help='keep version files and modules up to date',
+        description='Rewrite the version file and version modules whenever '
+        "the repository's refs change.")
+    watch_parser.add_argument(
+        '--root', default='%(pwd)s', help='the project root')
+    watch_parser.add_argument(
+        '--version-file', default='%(root)s/version.txt',
+        help='the version file to write')
+    watch_parser.add_argument(
+        '--no-version-file', dest='version_file', action='store_const',
+        const=None, help="don't write a version file")
+    watch_parser.add_argument(
+        '--version-module', action='append', dest='version_module_paths',
+        default=[], metavar='PATH',
+        help='a version module to write; may be given more than once')
+    watch_parser.add_argument(
+        '--no-dev-version', dest='include_dev_version', action='store_false',
+        help="don't include a .dev suffix for untagged commits")
+    watch_parser.add_argument(
+        '--tag-prefix', default='', help='only use tags with this prefix')
+    watch_parser.add_argument(
+        '--in-process', action='store_true',
+        help='read the repository without spawning git')
+    watch_parser.add_argument(
+        '--debounce', type=float, default=0.2,
+        help='seconds to wait for a burst of changes to settle')
+    watch_parser.add_argument(
+        '--poll-interval', type=float, default=1.0,
+        help='seconds between checks, when polling')
+    watch_parser.add_argument(
+        '--poll', dest='use_inotify', action='store_false',
+        help='poll for changes instead of using inotify')
+
+    fingerprint_parser = subparsers.add_parser(
+        'fingerprint', help='print a fingerprint of what the version is from',
+        description='Print a hash which changes whenever the version could '
+        'have, without finding the version.')
+    fingerprint_parser.add_argument(
+        '--root', default='%(pwd)s', help='the project root')
+    fingerprint_parser.add_argument(
+        '--version-file', default='%(root)s/version.txt',
+        help='the version file, for projects outside version control')
+    fingerprint_parser.add_argument(
+        '--stamp', metavar='PATH',
+        help='instead of printing the fingerprint, write it to this file, '
+        'leaving the file untouched if it already has that fingerprint')
+
+    args = vars(parser.parse_args(argv))
+    command = args.pop('command')
+    if command == 'fingerprint':
+        stamp = args.pop('stamp')
+        fingerprint = version_fingerprint(**args)
+        if stamp is None:
+            _print(fingerprint)
+        else:
+            _write_if_changed(stamp, fingerprint + '\n')
+    elif command == 'watch':
+        last = [None]
+
+        def report(found):
+            if isinstance(found, VersionNotFound):
+                for message in found.messages:
+                    print(message)
+            elif found != last[0]:
+                print(found.version)
+            last[0] = found
+
+        try:
+            watch(callback=report, **args)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
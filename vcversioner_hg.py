@@ -0,0 +1,347 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+"""Find versions in Mercurial repositories.
+
+This is the vcversioner backend for projects whose root has a ``.hg``
+directory. It's only imported once such a project is found, so projects using
+git never pay for it. See :data:`vcversioner.backends` for how backends are
+found, and :func:`describe`, :func:`command`, and :func:`fingerprint` for what
+a backend provides.
+
+Versions are described the way ``hg log -r . --template
+'{latesttag}-{changessincelatesttag}-h{node|short}'`` would describe them:
+the most recent global tag in the ancestors of the working directory's parent,
+how many changesets aren't ancestors of that tag, and the abbreviated node of
+the working directory's parent.
+
+"""
+
+from __future__ import unicode_literals
+
+import binascii
+import os
+import struct
+import zlib
+
+
+_nullid = b'\0' * 20
+_index_entry = struct.Struct('>Qiiiiii20s12x')
+
+
+class _ReadError(Exception):
+    "The repository couldn't be read without spawning hg."
+
+
+_read_errors = (
+    _ReadError, EnvironmentError, ValueError, IndexError, KeyError,
+    struct.error, zlib.error)
+
+
+def _read_bytes(path):
+    with open(path, 'rb') as infile:
+        return infile.read()
+
+
+def _patch(text, delta):
+    "Apply a binary delta from a revlog to *text*."
+    chunks = []
+    last = pos = 0
+    while pos < len(delta):
+        start, end, length = struct.unpack_from('>lll', delta, pos)
+        pos += 12
+        chunks.append(text[last:start])
+        chunks.append(delta[pos:pos + length])
+        pos += length
+        last = end
+    chunks.append(text[last:])
+    return b''.join(chunks)
+
+
+class _Changelog(object):
+    """Read a version 1 changelog revlog.
+
+    Only the index is read up front; revisions' texts (and thus dates) are
+    only read if they're needed.
+
+    """
+
+    def __init__(self, store):
+        self.index_path = os.path.join(store, '00changelog.i')
+        data = _read_bytes(self.index_path)
+        header, = struct.unpack_from('>I', data) if data else (1,)
+        if header & 0xffff != 1:
+            raise _ReadError('unsupported revlog version')
+        self.inline = bool(header & (1 << 16))
+        self.generaldelta = bool(header & (1 << 17))
+        self.data_path = os.path.join(store, '00changelog.d')
+        self._data = data if self.inline else None
+        self.entries = []
+        pos = 0
+        while pos < len(data):
+            offset_flags, length, _, base, _, p1, p2, node = (
+                _index_entry.unpack_from(data, pos))
+            pos += _index_entry.size
+            if self.inline:
+                start = pos
+                pos += length
+            else:
+                start = offset_flags >> 16 if self.entries else 0
+            self.entries.append((start, length, base, p1, p2, node))
+        self._revs = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def rev(self, node):
+        if self._revs is None:
+            self._revs = dict(
+                (entry[5], rev) for rev, entry in enumerate(self.entries))
+        return self._revs[node]
+
+    def node(self, rev):
+        return self.entries[rev][5]
+
+    def parents(self, rev):
+        "Return *rev*'s parents, as hg's changectx.parents() would."
+        _, _, _, p1, p2, _ = self.entries[rev]
+        return [p1] if p2 == -1 else [p1, p2]
+
+    def _chunk(self, rev):
+        start, length = self.entries[rev][:2]
+        if self._data is None:
+            self._data = _read_bytes(self.data_path)
+        chunk = self._data[start:start + length]
+        kind = chunk[:1]
+        if kind == b'x':
+            return zlib.decompress(chunk)
+        elif kind == b'u':
+            return chunk[1:]
+        elif kind in (b'', b'\0'):
+            return chunk
+        raise _ReadError('unsupported revlog compression %r' % (kind,))
+
+    def text(self, rev):
+        chain = []
+        while True:
+            chain.append(rev)
+            base = self.entries[rev][2]
+            if base == rev or base == -1:
+                break
+            rev = base if self.generaldelta else rev - 1
+        text = self._chunk(chain.pop())
+        for rev in reversed(chain):
+            text = _patch(text, self._chunk(rev))
+        return text
+
+    def date(self, rev):
+        if rev == -1:
+            return 0
+        return float(self.text(rev).split(b'\n', 3)[2].split(b' ', 1)[0])
+
+    def ancestors(self, rev):
+        "Return the set of *rev* and all of its ancestors."
+        ancestors = set()
+        todo = [rev]
+        while todo:
+            rev = todo.pop()
+            if rev == -1 or rev in ancestors:
+                continue
+            ancestors.add(rev)
+            todo.extend(self.entries[rev][3:5])
+        return ancestors
+
+
+def _requirements(hg_dir, store):
+    requirements = set()
+    for path in [hg_dir, store]:
+        try:
+            requirements.update(
+                _read_bytes(os.path.join(path, 'requires')).decode().split())
+        except EnvironmentError:
+            pass
+    return requirements
+
+
+def _shared_dir(hg_dir):
+    """Return the repository whose store and caches *hg_dir* uses.
+
+    This is *hg_dir* itself, unless it was made by ``hg share``.
+
+    """
+
+    requirements = _requirements(hg_dir, hg_dir)
+    if 'shared' in requirements or 'relshared' in requirements:
+        shared = _read_bytes(os.path.join(hg_dir, 'sharedpath')).decode()
+        return os.path.normpath(os.path.join(hg_dir, shared.strip()))
+    return hg_dir
+
+
+def _store(hg_dir, shared_dir):
+    "Return the store directory of the repository at *hg_dir*."
+    requirements = _requirements(hg_dir, hg_dir)
+    # with share-safe, the 'store' requirement is recorded in the store.
+    if 'store' in requirements or 'share-safe' in requirements:
+        return os.path.join(shared_dir, 'store')
+    return shared_dir
+
+
+def _working_parent(hg_dir):
+    dirstate = _read_bytes(os.path.join(hg_dir, 'dirstate'))
+    marker = b'dirstate-v2\n'
+    if dirstate.startswith(marker):
+        dirstate = dirstate[len(marker):]
+    if len(dirstate) < 20:
+        raise _ReadError('truncated dirstate')
+    return dirstate[:20]
+
+
+def _tags(shared_dir, changelog):
+    """Read the global tags from hg's tag cache.
+
+    Returns a mapping of revision to the names of the tags on it. If the cache
+    is out of date (or accounts for hidden changesets), it can't be trusted,
+    and ``_ReadError`` is raised.
+
+    """
+
+    lines = _read_bytes(
+        os.path.join(shared_dir, 'cache', 'tags2-visible')).splitlines()
+    valid = lines[0].split()
+    tip_rev = len(changelog) - 1
+    if (len(valid) != 2 or int(valid[0]) != tip_rev
+            or binascii.unhexlify(valid[1]) != changelog.node(tip_rev)):
+        raise _ReadError('the tag cache is out of date')
+    nodes = {}
+    for line in lines[1:]:
+        node, name = line.split(b' ', 1)
+        # later lines supersede earlier ones for the same tag.
+        nodes[name.decode('utf-8')] = binascii.unhexlify(node)
+    tags = {}
+    for name, node in nodes.items():
+        if node == _nullid:
+            continue
+        try:
+            rev = changelog.rev(node)
+        except KeyError:
+            continue
+        tags.setdefault(rev, []).append(name)
+    return tags
+
+
+def _latest_tag(changelog, tags, rev):
+    """Find the latest tag of *rev*, as hg's ``{latesttag}`` does.
+
+    Returns ``(tagged revision, distance, sorted tag names)``, where the names
+    are ``['null']`` if no ancestor is tagged.
+
+    """
+
+    latest = {-1: (-1, 0, ['null'])}
+    for ancestor in sorted(changelog.ancestors(rev)):
+        names = tags.get(ancestor)
+        if names:
+            latest[ancestor] = ancestor, 0, sorted(names)
+            continue
+        candidates = [latest[p] for p in changelog.parents(ancestor)]
+        best = candidates[0]
+        if len(candidates) > 1:
+            if candidates[0][2] == candidates[1][2]:
+                best = max(candidates, key=lambda c: c[1])
+            else:
+                # fewest changes since the tag wins, then the newest tag;
+                # dates are only read when needed, since that's slower.
+                ancestors = changelog.ancestors(ancestor)
+                changes = [
+                    len(ancestors - changelog.ancestors(candidate[0]))
+                    for candidate in candidates]
+                if changes[0] != changes[1]:
+                    best = candidates[changes.index(min(changes))]
+                elif (changelog.date(candidates[1][0])
+                        > changelog.date(candidates[0][0])):
+                    best = candidates[1]
+        latest[ancestor] = best[0], best[1] + 1, best[2]
+    return latest[rev]
+
+
+def describe(hg_dir, match=None):
+    """Describe the working directory's parent without spawning hg.
+
+    Returns ``'<tag>-<changes>-h<node>'``, or ``None`` if the repository
+    couldn't be read this way (for example, if hg's tag cache is out of date)
+    or has no tags. If *match* is specified, it's a compiled regex, and only
+    tags whose names it matches are considered.
+
+    """
+
+    try:
+        shared_dir = _shared_dir(hg_dir)
+        store = _store(hg_dir, shared_dir)
+        if _requirements(hg_dir, store) & set(['revlogv2', 'changelogv2']):
+            return None
+        node = _working_parent(hg_dir)
+        if node == _nullid:
+            return None
+        changelog = _Changelog(store)
+        rev = changelog.rev(node)
+        tags = _tags(shared_dir, changelog)
+        if match is not None:
+            tags = dict(
+                (tagged, [name for name in names if match.match(name)])
+                for tagged, names in tags.items())
+        tagged, _, names = _latest_tag(changelog, tags, rev)
+        if names == ['null']:
+            return None
+        changes = len(changelog.ancestors(rev) - changelog.ancestors(tagged))
+    except _read_errors:
+        return None
+    return '%s-%d-h%s' % (
+        names[0], changes, binascii.hexlify(node)[:12].decode())
+
+
+def fingerprint(hg_dir):
+    """Return the stat data of the dirstate and the changelog.
+
+    The dirstate changes whenever the working directory's parent does, and
+    the changelog whenever there's a new commit (including one which adds a
+    tag), so :func:`describe`'s result can't change unless one of them does.
+
+    """
+
+    try:
+        store = _store(hg_dir, _shared_dir(hg_dir))
+    except _read_errors:
+        return None
+    fingerprint = []
+    for path in [os.path.join(hg_dir, 'dirstate'),
+                 os.path.join(store, '00changelog.i')]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            fingerprint.append(None)
+        else:
+            fingerprint.append([st.st_mtime_ns, st.st_size, st.st_ino])
+    return fingerprint
+
+
+def command(hg_dir, match=None):
+    """Return the hg command which describes the working directory's parent.
+
+    Its output is the same as :func:`describe`'s, or nothing if there's no
+    tag.
+
+    """
+
+    if match is None:
+        latest = 'latesttag'
+        changes = 'changessincelatesttag'
+    else:
+        latest = "latesttag(r're:^%s')" % (match.pattern,)
+        changes = 'word(0, %s %% "{changes} ")' % (latest,)
+    tag = 'word(0, %s, ":")' % (latest,)
+    template = (
+        "{ifeq(%s, 'null', '', '{%s}-{%s}-h{node|short}')}" % (
+            tag.replace('"', "'"), tag, changes))
+    return [
+        'hg', '--repository', os.path.dirname(hg_dir), 'log', '--rev', '.',
+        '--template', template]